@@ -0,0 +1,302 @@
+import contextlib
+import io
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from DataLoader import DataLoader
+from TripleManager import TripleManager, SampledManager
+from CompatibleRelationsGenerator import CompatibleRelationsGenerator
+import GenerateQrels
+import IrMeasure
+import DatasetUtils
+import KGGenerator
+import PathUtils as pu
+
+CORRUPTION_MODES = ["LCWA", "sensical", "nonsensical", "one-hop sensical", "one-hop nonsensical"]
+SIMILARITY_METHODS = ["overlap", "jaccard", "dice", "cosine", "tversky"]
+PERCENTILES = [5, 25, 50, 75, 95]
+
+# A benchmark regresses when its median is this much slower than in the baseline
+REGRESSION_THRESHOLD = 0.10
+
+# Fixed inputs, so every run of the suite times exactly the same work
+SEED = 0
+SAMPLE_SIZE = 200
+RUN_DEPTH = 500
+BENCHMARK_TEST_FILE = "0_resplit_test2id.txt"
+
+
+def summarize_times(times):
+    """
+    Summary statistics of repeated timings.
+
+    :param times: List of durations in seconds
+    :return: Dictionary with repeats, min, mean, median, percentiles, max and the raw times
+    """
+    times = np.asarray(times, dtype=np.float64)
+    summary = {"repeats": len(times), "min": float(times.min()), "mean": float(times.mean()),
+               "median": float(np.median(times))}
+    for p, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+        summary[f"p{p}"] = float(value)
+    summary["max"] = float(times.max())
+    summary["times"] = [float(t) for t in times]
+    return summary
+
+
+def measure(function, warmups=1, repeats=5):
+    """
+    Times a function after some untimed warmup calls. Its printed output is discarded, so
+    logging does not end up in the timings or the benchmark report.
+
+    :param function: Function without arguments
+    :param warmups: Untimed calls before measuring (caches, lazy imports, allocator)
+    :param repeats: Timed calls
+    :return: Tuple (summary of the timings, result of the last call)
+    """
+    result = None
+    times = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(warmups):
+            result = function()
+
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start_time)
+
+    return summarize_times(times), result
+
+
+def corrupt_all(manager, triples, mode, lazy=False):
+    for h, r, t in triples:
+        manager.get_corrupted(h, r, t, 'head', mode, lazy)
+        manager.get_corrupted(h, r, t, 'tail', mode, lazy)
+
+
+def compute_compatibility(manager, method):
+    generator = CompatibleRelationsGenerator(manager.head_dict, manager.tail_dict, manager.domain, manager.range)
+    generator.compute_compatible_relations(threshold=0.75, method=method)
+    return generator
+
+
+def write_synthetic_runs(qrels, entities, run_folder, depth=RUN_DEPTH, seed=SEED):
+    """
+    Writes one seeded random run over the queries of the qrels, named like the real run files.
+
+    :param qrels: Qrels dictionary as returned by GenerateQrels.generate_qrels_tsv
+    :param entities: Entity ids to rank
+    :param run_folder: Folder to write the run file to
+    :param depth: Number of ranked entities per query
+    :param seed: Seed of the random scores
+    """
+    rng = np.random.default_rng(seed)
+    entities = np.asarray(entities)
+    query_ids = sorted({row[0] for row in next(iter(qrels.values()))})
+
+    reshuffle = pu.get_only_id(pu.get_reshuffleId(BENCHMARK_TEST_FILE, "test"))
+    with open(os.path.join(run_folder, f"benchmark_resplit__{reshuffle}_top.tsv"), "w", newline='') as f:
+        for query_id in query_ids:
+            picked = rng.choice(entities, size=min(depth, len(entities)), replace=False)
+            scores = rng.random(len(picked))
+            f.writelines(f"{query_id}\t{e}\t{s:.6f}\n" for e, s in zip(picked, scores))
+
+
+def run_suite(dataset_path, dataset_name, sample_size=SAMPLE_SIZE, warmups=1, repeats=5):
+    """
+    Times the hot paths of the pipeline on one dataset: get_corrupted per mode (and LCWA as a
+    complement view), compute_compatible_relations per method, generate_qrels_tsv, generate_qrels_by_relation
+    and calculate_ir_measures.
+
+    :param dataset_path: Folder prefix of the train/valid/test splits (as passed to DataLoader)
+    :param dataset_name: Name of the dataset, stored in the report
+    :param sample_size: Number of test triples the corruption and qrels benchmarks run on
+    :param warmups: Untimed calls before each benchmark
+    :param repeats: Timed calls of each benchmark
+    :return: Dictionary {"metadata": ..., "benchmarks": {name: summary}}
+    """
+    train_loader = DataLoader(dataset_path, "train")
+    val_loader = DataLoader(dataset_path, "valid")
+    test_loader = DataLoader(dataset_path, "test")
+    manager = TripleManager(test_loader, train_loader, val_loader)
+
+    triples = manager.get_triples()
+    sample = random.Random(SEED).sample(triples, min(sample_size, len(triples)))
+
+    benchmarks = {}
+
+    for mode in CORRUPTION_MODES:
+        print(f"\tBenchmarking get_corrupted ({mode})")
+        benchmarks[f"get_corrupted[{mode}]"], _ = measure(lambda: corrupt_all(manager, sample, mode),
+                                                          warmups, repeats)
+
+    print("\tBenchmarking get_corrupted (LCWA, complement view)")
+    benchmarks["get_corrupted[LCWA lazy]"], _ = measure(lambda: corrupt_all(manager, sample, "LCWA", True),
+                                                        warmups, repeats)
+
+    for method in SIMILARITY_METHODS:
+        print(f"\tBenchmarking compute_compatible_relations ({method})")
+        benchmarks[f"compute_compatible_relations[{method}]"], _ = measure(
+            lambda: compute_compatibility(manager, method), warmups, repeats)
+
+    print("\tBenchmarking generate_qrels_tsv")
+    sampled_manager = SampledManager(manager, sample)
+    output_files = [f"benchmark_Qrels_{policy}.tsv" for policy in ["Max", "Min", "Avg_Floor", "Avg_Ciel"]]
+    benchmarks["generate_qrels_tsv"], qrels = measure(
+        lambda: GenerateQrels.generate_qrels_tsv(sampled_manager, output_files), warmups, repeats)
+
+    print("\tBenchmarking generate_qrels_by_relation")
+    benchmarks["generate_qrels_by_relation"], _ = measure(
+        lambda: GenerateQrels.generate_qrels_by_relation(sampled_manager, output_files), warmups, repeats)
+
+    print("\tBenchmarking calculate_ir_measures")
+    # Trailing separator, run files are found by concatenating the folder and the file name
+    run_folder = tempfile.mkdtemp(prefix="benchmark_runs_") + os.sep
+    try:
+        write_synthetic_runs(qrels, manager.entity_ids, run_folder)
+        output_json_path = os.path.join(run_folder, "benchmark_IR_results.json")
+        benchmarks["calculate_ir_measures"], _ = measure(
+            lambda: IrMeasure.calculate_ir_measures(BENCHMARK_TEST_FILE, run_folder, qrels, dataset_name,
+                                                    output_json_path, 0.75, "overlap", []),
+            warmups, repeats)
+    finally:
+        shutil.rmtree(run_folder, ignore_errors=True)
+
+    return {"metadata": get_metadata(dataset_name, len(triples), len(sample), warmups, repeats),
+            "benchmarks": benchmarks}
+
+
+def get_metadata(dataset_name, triple_count, sample_size, warmups, repeats):
+    """Describes the machine and code a benchmark ran on, so reports can be told apart later."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        "dataset": dataset_name,
+        "test_triples": triple_count,
+        "sample_size": sample_size,
+        "seed": SEED,
+        "warmups": warmups,
+        "repeats": repeats,
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def compare_to_baseline(report, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares the medians of a report against a baseline report.
+
+    :param report: Report returned by run_suite
+    :param baseline: Earlier report of the same dataset
+    :param threshold: Allowed relative slowdown of the median
+    :return: List of (name, baseline median, median, relative change) that regressed
+    """
+    if baseline["metadata"].get("platform") != report["metadata"].get("platform"):
+        print("\tWarning: the baseline was recorded on a different platform, timings may not be comparable")
+
+    regressions = []
+    for name, summary in report["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            print(f"\t{name}: no baseline")
+            continue
+
+        before = baseline["benchmarks"][name]["median"]
+        after = summary["median"]
+        change = (after - before) / before if before > 0 else 0.0
+
+        status = "REGRESSION" if change > threshold else "ok"
+        print(f"\t{name}: {before:.4f}s -> {after:.4f}s ({change:+.1%}) {status}")
+
+        if change > threshold:
+            regressions.append((name, before, after, change))
+
+    return regressions
+
+
+def print_report(report):
+    for name, summary in report["benchmarks"].items():
+        print(f"\t{name}: median {summary['median']:.4f}s, p5 {summary['p5']:.4f}s, "
+              f"p95 {summary['p95']:.4f}s over {summary['repeats']} repeats")
+
+
+def main():
+    # Datasets to benchmark, see DatasetUtils.py for the numbers
+    benchmark_datasets = [5]
+
+    # Synthetic datasets to benchmark as well, by number of triples (generated once by KGGenerator)
+    synthetic_sizes = []
+
+    # Write the results as the new baseline instead of comparing against it?
+    WRITE_BASELINE = False
+
+    folder = "D:\\Masters\\RIT\\Semesters\\Sem 4\\RA\\Augmented KGE\\"
+    benchmark_folder = folder + "General Tests\\Benchmarks\\"
+    os.makedirs(benchmark_folder, exist_ok=True)
+
+    regressed = False
+
+    runs = [(f"{dataset}_{DatasetUtils.get_dataset_name(dataset)}",
+             folder + "Datasets\\" + DatasetUtils.get_dataset_name(dataset) + "\\") for dataset in benchmark_datasets]
+
+    for num_triples in synthetic_sizes:
+        synthetic_folder = benchmark_folder + f"Synthetic_{num_triples}\\"
+        if not pu.check_folder_existence(synthetic_folder):
+            KGGenerator.generate_dataset(synthetic_folder, num_triples, max(100, num_triples // 10),
+                                         max(10, min(1000, num_triples // 1000)))
+        runs.append((f"Synthetic_{num_triples}", synthetic_folder))
+
+    for dataset_name, dataset_path in runs:
+        print(f"Benchmarking {dataset_name}")
+
+        start_time = time.time()
+
+        report = run_suite(dataset_path, dataset_name)
+        print_report(report)
+
+        report_path = benchmark_folder + f"{dataset_name}_benchmark.json"
+        baseline_path = benchmark_folder + f"{dataset_name}_baseline.json"
+        pu.write_json_file(report_path, report)
+
+        if WRITE_BASELINE:
+            pu.write_json_file(baseline_path, report)
+            print(f"\tBaseline written to {baseline_path}")
+        else:
+            baseline = pu.read_json_file(baseline_path)
+            if baseline is None:
+                print(f"\tNo baseline at {baseline_path}, run with WRITE_BASELINE = True first")
+            elif compare_to_baseline(report, baseline):
+                regressed = True
+
+        end_time(start_time)
+
+    # Non-zero exit code, so the suite can gate a change
+    sys.exit(1 if regressed else 0)
+
+
+def end_time(start_time):
+    # Print the total execution time of the entire code
+    total_time = time.time() - start_time
+    time_taken = (f"\tTime Taken: "
+                  f"{total_time // 3600} Hours, "
+                  f"{(total_time % 3600) // 60} Minutes, "
+                  f"and {(total_time % 3600) % 60} seconds.")
+    print(time_taken)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import numpy as np
+
+# Upper bound on the number of entries in one block of resampling weights (~32 MB of int64)
+MAX_WEIGHT_ENTRIES = 2 ** 22
+
+
+def bootstrap_means(matrix, n_resamples=10000, seed=None):
+    """
+    Bootstrap distribution of the column means of a queries x measures matrix.
+
+    Each resample is turned into a vector of counts over the queries, so a whole block of
+    resamples is a single (resamples x queries) @ (queries x measures) product.
+
+    :param matrix: NumPy array of per-query values (queries x measures)
+    :param n_resamples: Number of bootstrap resamples
+    :param seed: Seed for numpy.random.default_rng
+    :return: NumPy array (n_resamples x measures) of resampled means
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    n_queries, n_measures = matrix.shape
+    means = np.zeros((n_resamples, n_measures))
+
+    if n_queries == 0:
+        return means
+
+    rng = np.random.default_rng(seed)
+    block = max(1, min(n_resamples, MAX_WEIGHT_ENTRIES // n_queries))
+
+    for start in range(0, n_resamples, block):
+        size = min(block, n_resamples - start)
+
+        # Draw size x n_queries query indices and turn each row into per-query counts
+        picks = rng.integers(0, n_queries, size=(size, n_queries))
+        picks += np.arange(size)[:, None] * n_queries
+        weights = np.bincount(picks.ravel(), minlength=size * n_queries).reshape(size, n_queries)
+
+        means[start:start + size] = weights.astype(np.float64) @ matrix / n_queries
+
+    return means
+
+
+def bootstrap_ci(matrix, confidence=0.95, n_resamples=10000, seed=None):
+    """
+    Percentile bootstrap confidence intervals for every measure at once.
+
+    :param matrix: NumPy array of per-query values (queries x measures)
+    :param confidence: Confidence level of the interval
+    :param n_resamples: Number of bootstrap resamples
+    :param seed: Seed for numpy.random.default_rng
+    :return: Tuple (lower, upper), NumPy arrays aligned with the matrix columns
+    """
+    means = bootstrap_means(matrix, n_resamples, seed)
+    tail = (1.0 - confidence) / 2 * 100
+
+    lower, upper = np.percentile(means, [tail, 100 - tail], axis=0)
+    return lower, upper
+
+
+def paired_bootstrap_test(matrix_a, matrix_b, n_resamples=10000, seed=None):
+    """
+    Two-sided paired bootstrap test of mean(a) == mean(b) for every measure at once.
+
+    The per-query differences are shifted to have zero mean (the null hypothesis) and
+    resampled; the p-value is the share of resampled means at least as extreme as the
+    observed one. Rows of both matrices must refer to the same queries.
+
+    :param matrix_a: NumPy array of per-query values of the first run (queries x measures)
+    :param matrix_b: NumPy array of per-query values of the second run, same shape
+    :param n_resamples: Number of bootstrap resamples
+    :param seed: Seed for numpy.random.default_rng
+    :return: Tuple (mean_difference, p_value), NumPy arrays aligned with the matrix columns
+    """
+    matrix_a = np.asarray(matrix_a, dtype=np.float64)
+    matrix_b = np.asarray(matrix_b, dtype=np.float64)
+    if matrix_a.shape != matrix_b.shape:
+        raise ValueError(f"Per-query matrices are not aligned: {matrix_a.shape} vs {matrix_b.shape}")
+
+    diffs = matrix_a - matrix_b
+    if len(diffs) == 0:
+        return np.zeros(diffs.shape[1]), np.ones(diffs.shape[1])
+
+    observed = diffs.mean(axis=0)
+    null_means = bootstrap_means(diffs - observed, n_resamples, seed)
+
+    # Small tolerance so floating point noise on ties does not count as "less extreme"
+    extreme = np.abs(null_means) >= np.abs(observed) - 1e-12
+    return observed, extreme.mean(axis=0)
+
+
+def pairwise_tests(matrices, n_resamples=10000, seed=None):
+    """
+    Runs paired_bootstrap_test between every pair of runs.
+
+    :param matrices: Dictionary {run name: per-query matrix}, all aligned on the same queries
+    :param n_resamples: Number of bootstrap resamples
+    :param seed: Seed for numpy.random.default_rng
+    :return: Dictionary {(name_a, name_b): (mean_difference, p_value)}
+    """
+    names = list(matrices)
+    results = {}
+
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            results[(names[i], names[j])] = paired_bootstrap_test(matrices[names[i]], matrices[names[j]],
+                                                                  n_resamples, seed)
+
+    return results
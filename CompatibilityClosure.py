@@ -0,0 +1,109 @@
+import numpy as np
+
+try:
+    from scipy import sparse
+except ImportError:  # Optional, the products fall back to dense NumPy matrices
+    sparse = None
+
+# Side of a relation a compatibility links, node 2 * r + SIDES.index(side) of the compatibility graph
+SIDES = ["domain", "range"]
+
+
+class CompatibilityClosure:
+    """
+    k-hop compatibility of (relation, side) pairs. The pairs are the nodes of a graph with an edge
+    (r, side) -> (r', side') for every entry of compatible_relations (the dom-dom, dom-ran, ran-dom and ran-ran
+    compatibilities), so the pairs reachable in at most k hops are the non-zero entries of A + A^2 + ... + A^k.
+
+    These are computed as boolean sparse matrix products, one per extra hop, instead of walking the lists;
+    without SciPy the same products run on dense NumPy matrices. Reachability is computed once per number of
+    hops and kept. One hop is exactly compatible_relations.
+    """
+
+    def __init__(self, compatible_relations, relation_count=0):
+        """
+        :param compatible_relations: Dictionary {(r, elem_type): [(r', elem_type'), ...]}
+        :param relation_count: Number of relations (raised to cover every relation of compatible_relations)
+        """
+        sources, targets = [], []
+        for (r, side), compatible in compatible_relations.items():
+            for r_prime, side_prime in compatible:
+                sources.append(_node(r, side))
+                targets.append(_node(r_prime, side_prime))
+
+        self.relation_count = max([relation_count] + [node // 2 + 1 for node in sources + targets])
+        self.adjacency = _matrix(np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64),
+                                 2 * self.relation_count)
+        # _reach[k]: pairs reachable in at most k hops
+        self._reach = [None, self.adjacency]
+
+    def reach(self, hops):
+        """
+        :param hops: Maximum number of compatibility links, at least 1
+        :return: (2 * relation_count) square 0/1 matrix, the row of (r, side) is 2 * r + SIDES.index(side)
+            (int32 CSR with SciPy, a boolean array without)
+        """
+        if hops < 1:
+            raise ValueError(f"hops must be at least 1, got {hops}")
+
+        while len(self._reach) <= hops:
+            previous = self._reach[-1]
+            current = _boolean(previous + _product(previous, self.adjacency))
+            # Once a hop adds nothing the closure is complete, every further hop is the same matrix
+            self._reach.append(previous if _count(current) == _count(previous) else current)
+        return self._reach[hops]
+
+    def reachable(self, relation, elem_type, hops):
+        """
+        :param relation: Relation ID
+        :param elem_type: 'domain' or 'range'
+        :param hops: Maximum number of compatibility links
+        :return: List of (r', elem_type') reachable from (relation, elem_type) in at most hops links
+        """
+        node = _node(relation, elem_type)
+        if node >= 2 * self.relation_count:
+            return []
+
+        reach = self.reach(hops)
+        if sparse is not None:
+            nodes = reach.indices[reach.indptr[node]:reach.indptr[node + 1]]
+        else:
+            nodes = np.flatnonzero(reach[node])
+        return [(node_prime // 2, SIDES[node_prime % 2]) for node_prime in np.sort(nodes).tolist()]
+
+
+def _node(relation, elem_type):
+    if elem_type not in SIDES:
+        raise ValueError("elem_type must be 'domain' or 'range'")
+    return 2 * relation + SIDES.index(elem_type)
+
+
+def _matrix(sources, targets, size):
+    if sparse is not None:
+        return _boolean(sparse.csr_matrix((np.ones(len(sources), dtype=np.int32), (sources, targets)),
+                                          shape=(size, size)))
+    matrix = np.zeros((size, size), dtype=bool)
+    matrix[sources, targets] = True
+    return matrix
+
+
+def _product(a, b):
+    if sparse is not None:
+        return a @ b
+    # float32 products go through BLAS, boolean and integer ones do not
+    return a.astype(np.float32) @ b.astype(np.float32) > 0
+
+
+def _boolean(matrix):
+    if sparse is not None:
+        # Path counts become 1, entries stay int32 so products never overflow
+        matrix = matrix.tocsr()
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        matrix.data = np.ones_like(matrix.data)
+        return matrix
+    return matrix.astype(bool)
+
+
+def _count(matrix):
+    return matrix.nnz if sparse is not None else int(np.count_nonzero(matrix))
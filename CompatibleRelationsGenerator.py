@@ -2,6 +2,8 @@ import numpy as np
 import json
 import ast
 import os
+import SetAlgebra
+from DataLoader import TripleArray, read_triples
 
 
 class CompatibleRelationsGenerator:
@@ -20,6 +22,8 @@ class CompatibleRelationsGenerator:
         self.domain = domain
         self.range = range
         self.threshold = threshold
+        # Largest entity id + 1, set by compute_compatible_relations, lets SetAlgebra use bitsets
+        self.universe = None
 
         self.domDomCompatible = {}
         self.domRanCompatible = {}
@@ -42,6 +46,8 @@ class CompatibleRelationsGenerator:
         # Convert dictionary sets to NumPy arrays for faster computations
         domain_arrays = {r: np.array(list(self.domain[r])) for r in self.domain}
         range_arrays = {r: np.array(list(self.range[r])) for r in self.range}
+        self.universe = 1 + max([int(array.max()) for array in (*domain_arrays.values(), *range_arrays.values())
+                                 if array.size] + [-1])
 
         for r1 in relation_list:
             self.domDomCompatible[r1] = []
@@ -95,7 +101,7 @@ class CompatibleRelationsGenerator:
         """ Compute overlap coefficient between two NumPy arrays. """
         if array1.size == 0 or array2.size == 0:
             return 0.0
-        intersection = np.intersect1d(array1, array2).size
+        intersection = SetAlgebra.intersect_count(array1, array2, self.universe)
         return intersection / min(array1.size, array2.size)
 
     def _compute_similarity(self, array1, array2, method="overlap", alpha=0.5, beta=0.5):
@@ -115,7 +121,7 @@ class CompatibleRelationsGenerator:
         if array1.size == 0 or array2.size == 0:
             return 0.0
 
-        intersection_size = np.intersect1d(array1, array2).size
+        intersection_size = SetAlgebra.intersect_count(array1, array2, self.universe)
         len_a = array1.size
         len_b = array2.size
         union_size = len_a + len_b - intersection_size
@@ -196,55 +202,6 @@ class CompatibleRelationsGenerator:
         self.save_to_file()
 
 
-class Triple():
-    """
-        Triple is the class that contains functionality for triples
-    """
-    __slots__ = "h", "r", "t"
-
-    def __init__(self, h, r, t):
-        """
-            Initialise a triples
-        Args:
-            h (int): Head entity
-            r (int): Relation entity
-            t (int): Tail entity
-        """
-        self.h = h
-        self.r = r
-        self.t = t
-
-    def __eq__(self, other):
-        """
-            Checks for equality between two triples
-        Args:
-            other (Triple): Triple object to be compared to
-
-        Returns:
-            bool: Returns true if triples are equal, false otherwise
-        """
-        return (self.h, self.r, self.t) == (other.h, other.r, other.t)
-
-    def __str__(self):
-        """
-        Converts triple into a string
-
-        Returns:
-            str: [h,r,t]
-        """
-        return "[" + str(self.h) + "," + str(self.r) + "," + str(self.t) + "]"
-
-    def __hash__(self):
-        return int(self.pi(self.pi(self.h, self.r), self.t))
-
-    def __str__(self):
-        return str(self.h) + " " + str(self.r) + " " + str(self.t)
-
-    # https://en.wikipedia.org/wiki/Pairing_function#Cantor_pairing_function
-    def pi(self, k1, k2):
-        return .5 * (k1 + k2) * (k1 + k2 + 1) + k2
-
-
 class DataLoader(object):
 
     def __init__(self, path, type):
@@ -335,53 +292,41 @@ class DataLoader(object):
         Returns:
 
         """
-        list = []
-        with open(filePath) as fp:
-            fp.readline()
-            line = fp.readline()
-            while line:
-                triple = line.strip().split()
-                h = int(triple[0])
-                t = int(triple[1])
-                r = int(triple[2])
-
-                self.headEntities.add(h)
-                self.tailEntities.add(t)
-                self.relations.add(r)
-
-                if r not in self.headDict:
-                    self.headDict[r] = {}
-                    self.domain[r] = set()
-                if r not in self.tailDict:
-                    self.tailDict[r] = {}
-                    self.range[r] = set()
-                if r not in self.triple_count_by_pred:
-                    self.triple_count_by_pred[r] = 0
-
-                if t not in self.headDict[r]:
-                    self.headDict[r][t] = set()
-                if h not in self.tailDict[r]:
-                    self.tailDict[r][h] = set()
-
-                self.headDict[r][t].add(h)
-                self.tailDict[r][h].add(t)
-                self.domain[r].add(h)
-                self.range[r].add(t)
-
-                self.triple_count_by_pred[r] += 1
-
-                triple = Triple(h, r, t)
-                list.append(triple)
-                line = fp.readline()
-
-        return list
+        heads, tails, relations = read_triples(filePath)
+        for h, t, r in zip(heads.tolist(), tails.tolist(), relations.tolist()):
+            self.headEntities.add(h)
+            self.tailEntities.add(t)
+            self.relations.add(r)
+
+            if r not in self.headDict:
+                self.headDict[r] = {}
+                self.domain[r] = set()
+            if r not in self.tailDict:
+                self.tailDict[r] = {}
+                self.range[r] = set()
+            if r not in self.triple_count_by_pred:
+                self.triple_count_by_pred[r] = 0
+
+            if t not in self.headDict[r]:
+                self.headDict[r][t] = set()
+            if h not in self.tailDict[r]:
+                self.tailDict[r][h] = set()
+
+            self.headDict[r][t].add(h)
+            self.tailDict[r][h].add(t)
+            self.domain[r].add(h)
+            self.range[r].add(t)
+
+            self.triple_count_by_pred[r] += 1
+
+        return TripleArray.from_columns(heads, relations, tails)
 
     def getTriples(self):
         """
-        Returns the list of triples
+        Returns the triples
 
         Returns:
-            list (list): List of all triples
+            list (TripleArray): All triples, iterating gives Triple(h, r, t) named tuples
 
         """
         return self.list
@@ -1,14 +1,206 @@
+import os
+import tempfile
+from collections import namedtuple
+from collections.abc import Sequence
 import numpy as np
 import PathUtils
+import TripleStore
+
+
+# Triples are stored as int32, ids must stay below this
+MAX_ID = np.iinfo(np.int32).max
+
+Triple = namedtuple("Triple", ["h", "r", "t"])
+
+
+class TripleArray(Sequence):
+    """
+    Triples held in one int32 (n, 3) array with columns h, r, t (12 bytes per triple instead of a tuple of
+    three ints). heads, relations and tails are zero-copy views of the columns for vectorized code; indexing
+    and iterating give Triple(h, r, t) named tuples of Python ints, so code written for a list of (h, r, t)
+    tuples keeps working.
+    """
+
+    def __init__(self, array):
+        """
+        :param array: Array-like of shape (n, 3), columns h, r, t
+        """
+        array = np.asarray(array).reshape(-1, 3)
+        if len(array) and (array.min() < 0 or array.max() > MAX_ID):
+            raise ValueError(f"Triple ids must be in [0, {MAX_ID}]")
+        self.array = np.ascontiguousarray(array, dtype=np.int32)
+
+    @classmethod
+    def from_columns(cls, heads, relations, tails):
+        return cls(np.column_stack((heads, relations, tails)))
+
+    @property
+    def heads(self):
+        return self.array[:, 0]
+
+    @property
+    def relations(self):
+        return self.array[:, 1]
+
+    @property
+    def tails(self):
+        return self.array[:, 2]
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        # Slices and index arrays give a TripleArray, a single index gives a Triple
+        if isinstance(index, (slice, np.ndarray, list)):
+            return TripleArray(self.array[index])
+        return Triple(*self.array[index].tolist())
+
+    def __iter__(self):
+        return map(Triple._make, self.array.tolist())
+
+
+def triples_to_array(triples):
+    """
+    :param triples: TripleArray, (n, 3) array or any iterable of (h, r, t)
+    :return: (n, 3) int64 array
+    """
+    if isinstance(triples, TripleArray):
+        return triples.array.astype(np.int64)
+    if isinstance(triples, np.ndarray):
+        return triples.astype(np.int64).reshape(-1, 3)
+    return np.array([tuple(triple) for triple in triples], dtype=np.int64).reshape(-1, 3)
+
+
+def iter_triple_chunks(file_path, chunk_bytes=-1):
+    """
+    Reads a split file, an optional count line then one "h t r" line per triple, in chunks of whole lines.
+
+    :param file_path: Path to the split file
+    :param chunk_bytes: About how much text is parsed at once (-1 reads the whole file)
+    :return: Generator of tuples of int64 arrays (heads, tails, relations), in file order
+    """
+    with open(file_path) as fp:
+        first_line = fp.readline()
+        # The first line is the number of triples, unless the file has no count line
+        text = first_line if len(first_line.split()) == 3 else ""
+
+        while True:
+            chunk = fp.read(chunk_bytes)
+            if chunk and not chunk.endswith("\n"):
+                chunk += fp.readline()
+            text += chunk
+            if not text:
+                break
+
+            ids = np.fromstring(text, dtype=np.int64, sep=" ") if text.strip() else np.zeros(0, dtype=np.int64)
+            if len(ids) % 3 != 0:
+                raise ValueError(f"{file_path}: every line must have exactly 3 ids (h t r)")
+            ids = ids.reshape(-1, 3)
+            yield ids[:, 0], ids[:, 1], ids[:, 2]
+
+            text = ""
+            if not chunk:
+                break
+
+
+def read_triples(file_path):
+    """
+    Reads a whole split file.
+
+    :param file_path: Path to the split file
+    :return: Tuple of int64 arrays (heads, tails, relations), in file order
+    """
+    chunks = list(iter_triple_chunks(file_path))
+    if not chunks:
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(3))
+    return tuple(np.concatenate(column) for column in zip(*chunks))
+
+
+def to_dense(ids, values, file_path):
+    """
+    Maps ids of a file to dense ids 0..N-1.
+
+    :param ids: Sorted array of the ids listed in entity2id.txt/relation2id.txt
+    :param values: Array of ids read from a split file
+    :param file_path: Split file, for the error message
+    :return: int64 array of dense ids
+    """
+    if len(values) == 0:
+        return values
+    if len(ids) and ids[0] == 0 and ids[-1] == len(ids) - 1:
+        # Already dense, nothing to remap
+        positions = values
+        missing = (values < 0) | (values >= len(ids))
+    else:
+        positions = np.minimum(np.searchsorted(ids, values), max(len(ids) - 1, 0))
+        missing = ids[positions] != values if len(ids) else np.ones(len(values), dtype=bool)
+
+    if missing.any():
+        raise ValueError(f"{file_path}: id {values[missing][0]} is not listed in entity2id.txt/relation2id.txt")
+    return positions
+
+
+def group_unique(keys, values):
+    """
+    Groups values by key, vectorized (one sort instead of one set per key).
+
+    :param keys: int array
+    :param values: int array, same length
+    :return: Dictionary {key: sorted int64 array of the distinct values paired with it}, keys in ascending order
+    """
+    if len(keys) == 0:
+        return {}
+
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], np.asarray(values[order], dtype=np.int64)
+    distinct = np.concatenate(([True], (keys[1:] != keys[:-1]) | (values[1:] != values[:-1])))
+    keys, values = keys[distinct], values[distinct]
+
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return dict(zip(keys[starts].tolist(), np.split(values, starts[1:])))
+
+
+def group_unique_nested(outer_keys, inner_keys, values):
+    """
+    Two-level group_unique, e.g. {r: {t: heads}} from the relation, tail and head columns.
+
+    :return: Dictionary {outer key: {inner key: sorted int64 array of the distinct values}}
+    """
+    if len(outer_keys) == 0:
+        return {}
+
+    order = np.lexsort((values, inner_keys, outer_keys))
+    outer_keys, inner_keys = outer_keys[order], inner_keys[order]
+    values = np.asarray(values[order], dtype=np.int64)
+    new_pair = np.concatenate(([True], (outer_keys[1:] != outer_keys[:-1]) | (inner_keys[1:] != inner_keys[:-1])))
+    distinct = new_pair | np.concatenate(([True], values[1:] != values[:-1]))
+    outer_keys, inner_keys, values, new_pair = outer_keys[distinct], inner_keys[distinct], values[distinct], new_pair[distinct]
+
+    pair_starts = np.flatnonzero(new_pair)
+    groups = np.split(values, pair_starts[1:])
+    pair_outer, pair_inner = outer_keys[pair_starts].tolist(), inner_keys[pair_starts].tolist()
+
+    nested = {}
+    for outer, inner, group in zip(pair_outer, pair_inner, groups):
+        if outer not in nested:
+            nested[outer] = {}
+        nested[outer][inner] = group
+    return nested
 
 
 class DataLoader(object):
 
-    def __init__(self, path, split_type):
+    def __init__(self, path, split_type, storage_folder=None, memory_budget=TripleStore.MEMORY_BUDGET):
         # rather than path just the function to read the folder
         # split_type (str): Type of split to load. Type can be "train", "test", "valid"
+        # storage_folder (str): Out-of-core mode, triples and dictionaries are kept in memory-mapped files in this
+        #   folder (see TripleStore.py) instead of in memory. None keeps everything in memory
+        # memory_budget (int): Working memory in bytes of the out-of-core mode
         self.path = path
         self.split_type = split_type
+        self.storage_folder = storage_folder
+        self.memory_budget = memory_budget
+        self.store = None
         self.head_entities = set()
         self.tail_entities = set()
         self.relations = set()
@@ -22,58 +214,110 @@ class DataLoader(object):
         self.ranRanCompatible = {}
         self.triple_count_by_pred = {}
 
-        self.entities = PathUtils.get_entities(self.path)
+        # Entities and relations are remapped to dense ids 0..N-1 at load time, so everything downstream can index
+        #   arrays with them. entity_ids[i] / relation_ids[i] give back the id used in the files (for the output).
+        #   The mapping only depends on entity2id.txt / relation2id.txt, so all the splits share it.
+        self.entity_ids = np.array(sorted(PathUtils.get_entities(self.path)), dtype=np.int64)
+        relations = PathUtils.get_relations(self.path)
+        self.relation_ids = np.array(sorted(relations), dtype=np.int64) if relations is not None else None
 
-        self.triple_list = []
-        self.import_file(path + split_type + "2id.txt")
+        self.entities = set(range(len(self.entity_ids)))
+
+        self.triples = TripleArray(np.zeros((0, 3), dtype=np.int32))
+        if storage_folder is None:
+            self.import_file(path + split_type + "2id.txt")
+        else:
+            self.import_file_out_of_core(path + split_type + "2id.txt")
+
+        # Without relation2id.txt, relation ids are kept as they are
+        if self.relation_ids is None:
+            self.relation_ids = np.arange(max(self.relations, default=-1) + 1, dtype=np.int64)
 
         # print(f"DL {split_type} Created")
 
     def import_file(self, file_path):
-        with open(file_path) as fp:
-            for line in fp:
-                triple = line.strip().split()
-                if len(triple) != 3:
-                    continue
-
-                h, t, r = triple
-                h, t, r = int(h), int(t), int(r)
-
-                self.head_entities.add(h)
-                self.tail_entities.add(t)
-                self.relations.add(r)
-
-                if r not in self.head_dict:
-                    self.head_dict[r] = {}
-                    self.domain[r] = set()
-                if r not in self.tail_dict:
-                    self.tail_dict[r] = {}
-                    self.range[r] = set()
-                if r not in self.triple_count_by_pred:
-                    self.triple_count_by_pred[r] = 0
-
-                if t not in self.head_dict[r]:
-                    self.head_dict[r][t] = set()
-                if h not in self.tail_dict[r]:
-                    self.tail_dict[r][h] = set()
-
-                self.head_dict[r][t].add(h)
-                self.tail_dict[r][h].add(t)
-                self.domain[r].add(h)
-                self.range[r].add(t)
-
-                self.triple_count_by_pred[r] += 1
-
-                self.triple_list.append((h, r, t))
-
-        # Transform all to numpy arrays.
-        self.head_dict = {r: {t: np.array(list(self.head_dict[r][t]))
-                              for t in self.head_dict[r]} for r in self.head_dict}
-        self.tail_dict = {r: {h: np.array(list(self.tail_dict[r][h]))
-                              for h in self.tail_dict[r]} for r in self.tail_dict}
-
-        self.domain = {r: np.array(list(self.domain[r])) for r in self.domain}
-        self.range = {r: np.array(list(self.range[r])) for r in self.range}
+        h, t, r = read_triples(file_path)
+
+        h, t = to_dense(self.entity_ids, h, file_path), to_dense(self.entity_ids, t, file_path)
+        if self.relation_ids is not None:
+            r = to_dense(self.relation_ids, r, file_path)
+
+        self.triples = TripleArray.from_columns(h, r, t)
+
+        self.head_entities = set(np.unique(h).tolist())
+        self.tail_entities = set(np.unique(t).tolist())
+        self.relations = set(np.unique(r).tolist())
+
+        # Grouped by sorting, the arrays hold the distinct entities in ascending order
+        self.head_dict = group_unique_nested(r, t, h)
+        self.tail_dict = group_unique_nested(r, h, t)
+        self.domain = group_unique(r, h)
+        self.range = group_unique(r, t)
+
+        relations, counts = np.unique(r, return_counts=True)
+        self.triple_count_by_pred = dict(zip(relations.tolist(), counts.tolist()))
+
+    def import_file_out_of_core(self, file_path):
+        """
+        Out-of-core import: the file is parsed in chunks straight to disk, then grouped and indexed by relation in
+        a TripleStore. head_dict, tail_dict, domain and range are read-only mappings over the store, and the
+        triples are grouped by relation (file order within a relation), so walking them pages in one relation at
+        a time.
+        """
+        os.makedirs(self.storage_folder, exist_ok=True)
+        entity_count = len(self.entity_ids)
+        heads_seen = np.zeros(entity_count, dtype=bool)
+        tails_seen = np.zeros(entity_count, dtype=bool)
+        relation_count = len(self.relation_ids) if self.relation_ids is not None else 0
+
+        raw_file, raw_path = tempfile.mkstemp(prefix=f"{self.split_type}_", suffix=".bin", dir=self.storage_folder)
+        parsed = None
+        try:
+            with os.fdopen(raw_file, "wb") as raw:
+                for h, t, r in iter_triple_chunks(file_path, max(1 << 16, self.memory_budget // 16)):
+                    h, t = to_dense(self.entity_ids, h, file_path), to_dense(self.entity_ids, t, file_path)
+                    if self.relation_ids is not None:
+                        r = to_dense(self.relation_ids, r, file_path)
+
+                    raw.write(TripleArray.from_columns(h, r, t).array.tobytes())
+                    heads_seen[h] = True
+                    tails_seen[t] = True
+                    relation_count = max(relation_count, int(r.max(initial=-1)) + 1)
+
+            parsed = (np.memmap(raw_path, dtype=np.int32, mode="r").reshape(-1, 3) if os.path.getsize(raw_path)
+                      else np.zeros((0, 3), dtype=np.int32))
+            self.store = TripleStore.TripleStore.build([parsed], entity_count, relation_count, self.storage_folder,
+                                                       self.memory_budget)
+        finally:
+            # Unmapped first, Windows cannot remove a mapped file
+            parsed = None
+            os.remove(raw_path)
+
+        self.triples = TripleArray(self.store.triples)
+
+        self.head_entities = set(np.flatnonzero(heads_seen).tolist())
+        self.tail_entities = set(np.flatnonzero(tails_seen).tolist())
+        counts = np.diff(self.store.triple_offsets)
+        self.relations = set(np.flatnonzero(counts).tolist())
+
+        self.head_dict = self.store.head_dict
+        self.tail_dict = self.store.tail_dict
+        self.domain = self.store.domain
+        self.range = self.store.range
+
+        self.triple_count_by_pred = {r: int(counts[r]) for r in sorted(self.relations)}
 
     def get_triples(self):
-        return self.triple_list
+        return self.triples
+
+    def close(self):
+        """
+        Out-of-core mode: drops the views over the TripleStore and removes it from disk. The loader is empty
+        afterwards. Does nothing for in-memory loaders.
+        """
+        if self.store is None:
+            return
+        self.triples = TripleArray(np.zeros((0, 3), dtype=np.int32))
+        self.head_dict, self.tail_dict, self.domain, self.range = {}, {}, {}, {}
+        self.store.close()
+        self.store = None
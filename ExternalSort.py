@@ -0,0 +1,318 @@
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# Bytes of qrels parsed, sorted and spilled to disk at once (about a million lines), bounds the memory of a pass
+CHUNK_BYTES = 1 << 25
+
+# Rows read from all the runs together per merge step, shared out between the runs
+MERGE_BLOCK = 1_000_000
+
+# Keys are query_code * DOC_SPACE + doc_code
+DOC_SPACE = 2 ** 32
+
+
+def count_lines(file_path, block_size=1 << 24):
+    """
+    Counts the lines of a text file by reading it as binary blocks, without decoding or splitting it.
+
+    :param file_path: Path to the file
+    :param block_size: Bytes read at once
+    :return: Number of lines (a last line without a trailing newline counts too)
+    """
+    lines = 0
+    last = b"\n"
+    with open(file_path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            lines += block.count(b"\n")
+            last = block[-1:]
+    return lines + (last != b"\n")
+
+
+class _Codes(dict):
+    """Dictionary giving every new id the next code, and remembering the ids in code order."""
+
+    def __init__(self):
+        super().__init__()
+        self.values = []
+
+    def __missing__(self, token):
+        self[token] = len(self.values)
+        self.values.append(token)
+        return self[token]
+
+
+class _Relevances(dict):
+    """Cache of parsed relevance scores, there are only a few distinct ones."""
+
+    def __missing__(self, token):
+        self[token] = int(token)
+        return self[token]
+
+
+class QrelsEncoder:
+    """
+    Integer codes of the query and document ids of a qrels file, in order of first appearance.
+
+    Only the distinct ids are kept (one entry per query and per document, not per line), so a file of
+    hundreds of millions of lines needs about as much memory as its queries and documents.
+    """
+
+    def __init__(self):
+        self.query_codes = _Codes()
+        self.doc_codes = _Codes()
+        self.relevances = _Relevances()
+
+    @property
+    def queries(self):
+        return self.query_codes.values
+
+    @property
+    def docs(self):
+        return self.doc_codes.values
+
+    def encode(self, text):
+        """
+        Encodes a chunk of qrels lines ("query doc relevance").
+
+        :param text: Whole lines of a qrels file
+        :return: Tuple (int64 keys, int64 relevances)
+        """
+        tokens = text.split()
+        if len(tokens) % 3 != 0:
+            raise ValueError("Every qrels line must have exactly 3 fields: query, document and relevance")
+
+        count = len(tokens) // 3
+        query_codes = np.fromiter(map(self.query_codes.__getitem__, tokens[0::3]), dtype=np.int64, count=count)
+        doc_codes = np.fromiter(map(self.doc_codes.__getitem__, tokens[1::3]), dtype=np.int64, count=count)
+        relevances = np.fromiter(map(self.relevances.__getitem__, tokens[2::3]), dtype=np.int64, count=count)
+        if len(self.docs) > DOC_SPACE:
+            raise ValueError(f"More than {DOC_SPACE} distinct documents cannot be encoded")
+
+        return query_codes * DOC_SPACE + doc_codes, relevances
+
+    def decode(self, keys):
+        """
+        :param keys: Array of keys
+        :return: List of (query id, document id) strings
+        """
+        return [(self.queries[key // DOC_SPACE], self.docs[key % DOC_SPACE]) for key in np.asarray(keys).tolist()]
+
+
+def _read_chunks(file_path, chunk_bytes):
+    # About chunk_bytes of text at a time, completed up to the end of its last line
+    with open(file_path, "r", encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                break
+            if not chunk.endswith("\n"):
+                chunk += f.readline()
+            yield chunk
+
+
+def spill_sorted_runs(file_path, encoder, run_folder, chunk_bytes=CHUNK_BYTES):
+    """
+    Reads a qrels file in chunks, sorts every chunk by (key, relevance) and writes it to disk as a run.
+
+    :param file_path: Path of the qrels file
+    :param encoder: QrelsEncoder filled while reading
+    :param run_folder: Folder the runs are written to
+    :param chunk_bytes: Size of the text read per run
+    :return: List of (keys .npy path, relevances .npy path), one per run
+    """
+    runs = []
+    for i, chunk in enumerate(_read_chunks(file_path, chunk_bytes)):
+        keys, relevances = encoder.encode(chunk)
+        order = np.lexsort((relevances, keys))
+
+        run = (os.path.join(run_folder, f"run_{i}_keys.npy"), os.path.join(run_folder, f"run_{i}_relevances.npy"))
+        np.save(run[0], keys[order])
+        np.save(run[1], relevances[order])
+        runs.append(run)
+    return runs
+
+
+def merge_runs(runs, block=MERGE_BLOCK):
+    """
+    Merges sorted runs block by block. Runs are memory-mapped and every run gets an equal share of the
+    block per step, so about `block` rows are in memory at once however many runs there are (a key
+    repeated across more than a share is read whole). A key is never split across two yielded batches.
+
+    :param runs: List of (keys .npy path, relevances .npy path) written by spill_sorted_runs
+    :param block: Rows read from all the runs together per step
+    :return: Generator of (keys, relevances) batches, sorted by (key, relevance)
+    """
+    arrays = [(np.load(keys_path, mmap_mode="r"), np.load(relevances_path, mmap_mode="r"))
+              for keys_path, relevances_path in runs]
+    positions = [0] * len(arrays)
+    share = max(1, block // max(len(arrays), 1))
+    step = share
+
+    while any(position < len(keys) for position, (keys, _) in zip(positions, arrays)):
+        ends = [min(position + step, len(keys)) for position, (keys, _) in zip(positions, arrays)]
+
+        # Rows up to the smallest last key of the runs that continue past this block are complete;
+        #   that key itself may continue in the next block, so it waits for the next step
+        limits = [keys[end - 1] for (keys, _), end in zip(arrays, ends) if end < len(keys)]
+        cutoff = min(limits) if limits else None
+
+        takes = []
+        for (keys, _), position, end in zip(arrays, positions, ends):
+            take = end if cutoff is None else position + int(np.searchsorted(keys[position:end], cutoff, "left"))
+            takes.append(take)
+
+        if all(take == position for take, position in zip(takes, positions)):
+            # One key fills a whole block, read further
+            step *= 2
+            continue
+        step = share
+
+        keys = np.concatenate([run_keys[position:take] for (run_keys, _), position, take
+                               in zip(arrays, positions, takes)])
+        relevances = np.concatenate([run_relevances[position:take] for (_, run_relevances), position, take
+                                     in zip(arrays, positions, takes)])
+        positions = takes
+
+        order = np.lexsort((relevances, keys))
+        yield keys[order], relevances[order]
+
+
+def iter_sorted_qrels(file_path, temp_folder=None, chunk_bytes=CHUNK_BYTES, block=MERGE_BLOCK):
+    """
+    External sort of a qrels file: yields its rows sorted by (query, document, relevance) with bounded memory.
+
+    :param file_path: Path of the qrels file
+    :param temp_folder: Folder for the temporary runs (default: the system temporary folder)
+    :param chunk_bytes: Size of the text read per run
+    :param block: Rows read from all the runs together per merge step
+    :return: Generator of (encoder, keys, relevances) batches; a key is never split across batches
+    """
+    encoder = QrelsEncoder()
+    run_folder = tempfile.mkdtemp(prefix="qrels_runs_", dir=temp_folder)
+    try:
+        runs = spill_sorted_runs(file_path, encoder, run_folder, chunk_bytes)
+        for keys, relevances in merge_runs(runs, block):
+            yield encoder, keys, relevances
+    finally:
+        shutil.rmtree(run_folder, ignore_errors=True)
+
+
+def measure_merge_memory(run_counts=(4, 16, 64, 256), rows=4_000_000, block=MERGE_BLOCK, temp_folder=None,
+                         seed=0):
+    """
+    Peak memory of merge_runs over the same rows split into more and more runs. It should stay flat: the
+    runs are memory-mapped and only the share of every run read per step is copied into memory (the
+    mapped pages are file cache and are not counted).
+
+    :param run_counts: Numbers of runs to merge
+    :param rows: Rows in total, split evenly between the runs
+    :param block: Rows read from all the runs together per merge step
+    :param temp_folder: Folder for the temporary runs
+    :param seed: Seed of the random keys
+    :return: Dictionary {run count: peak bytes allocated while merging}
+    """
+    rng = np.random.default_rng(seed)
+    peaks = {}
+    for run_count in run_counts:
+        run_folder = tempfile.mkdtemp(prefix="qrels_runs_", dir=temp_folder)
+        try:
+            runs = []
+            for i, keys in enumerate(np.array_split(rng.integers(0, DOC_SPACE * 1000, rows), run_count)):
+                run = (os.path.join(run_folder, f"run_{i}_keys.npy"),
+                       os.path.join(run_folder, f"run_{i}_relevances.npy"))
+                np.save(run[0], np.sort(keys))
+                np.save(run[1], np.zeros(len(keys), dtype=np.int64))
+                runs.append(run)
+
+            tracemalloc.start()
+            for _ in merge_runs(runs, block):
+                pass
+            peaks[run_count] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        finally:
+            shutil.rmtree(run_folder, ignore_errors=True)
+    return peaks
+
+
+def _group_starts(keys):
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+
+def find_conflicts(file_path, temp_folder=None, chunk_bytes=CHUNK_BYTES):
+    """
+    Query-document pairs that appear more than once in a qrels file.
+
+    :param file_path: Path of the qrels file
+    :param temp_folder: Folder for the temporary runs
+    :param chunk_bytes: Size of the text read per run
+    :return: Generator of (query id, document id, sorted list of all its relevance scores)
+    """
+    for encoder, keys, relevances in iter_sorted_qrels(file_path, temp_folder, chunk_bytes):
+        starts = _group_starts(keys)
+        counts = np.diff(np.append(starts, len(keys)))
+        for start, count in zip(starts[counts > 1].tolist(), counts[counts > 1].tolist()):
+            (query_id, doc_id), = encoder.decode(keys[start:start + 1])
+            yield query_id, doc_id, relevances[start:start + count].tolist()
+
+
+def dedup_qrels(file_path, output_file, keep="max", temp_folder=None, chunk_bytes=CHUNK_BYTES):
+    """
+    Writes a qrels file with one line per query-document pair, sorted by query and document.
+
+    :param file_path: Path of the qrels file
+    :param output_file: Path of the deduplicated qrels file
+    :param keep: Relevance kept for repeated pairs, "max" or "min"
+    :param temp_folder: Folder for the temporary runs
+    :param chunk_bytes: Size of the text read per run
+    :return: Tuple (lines read, lines written)
+    """
+    if keep not in ["max", "min"]:
+        raise ValueError(f"keep must be 'max' or 'min', got {keep}")
+
+    lines_read, lines_written = 0, 0
+    with open(output_file, "w", encoding="utf-8", newline='') as out_file:
+        for encoder, keys, relevances in iter_sorted_qrels(file_path, temp_folder, chunk_bytes):
+            starts = _group_starts(keys)
+            # Rows of a pair are sorted by relevance: the first is the min, the last the max
+            picks = starts if keep == "min" else np.append(starts[1:], len(keys)) - 1
+
+            out_file.writelines(f"{query_id}\t{doc_id}\t{relevance}\n" for (query_id, doc_id), relevance
+                                in zip(encoder.decode(keys[picks]), relevances[picks].tolist()))
+            lines_read += len(keys)
+            lines_written += len(picks)
+
+    return lines_read, lines_written
+
+
+def main():
+    qrels_file = "D:\\Masters\\RIT\\Semesters\\Sem 4\\RA\\Augmented KGE\\General Tests\\Generated_Qrels_TSV\\" \
+                 "3_NELL-995\\3_NELL-995_0_resplit_qrels_Avg_Ceil.tsv"
+
+    start_time = time.time()
+
+    print(f"{count_lines(qrels_file)} lines")
+    lines_read, lines_written = dedup_qrels(qrels_file, qrels_file.replace(".tsv", "_dedup.tsv"))
+    print(f"{lines_read - lines_written} repeated query-document pairs removed")
+
+    end_time(start_time)
+
+
+def end_time(start_time):
+    # Print the total execution time of the entire code
+    total_time = time.time() - start_time
+    time_taken = (f"\tTime Taken: "
+                  f"{total_time // 3600} Hours, "
+                  f"{(total_time % 3600) // 60} Minutes, "
+                  f"and {(total_time % 3600) % 60} seconds.")
+    print(time_taken)
+
+
+if __name__ == "__main__":
+    main()
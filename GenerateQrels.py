@@ -1,7 +1,28 @@
 import PathUtils as pu
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import Instrumentation
+from DataLoader import triples_to_array
 import time
 
+RELEVANCE_MAP = {
+    "LCWA": 0,
+    "nonsensical": 1,
+    "one-hop nonsensical": 2,
+    "one-hop sensical": 3,
+    "sensical": 4,
+    "positive": 5
+}
+
+CORRUPTION_STRATEGIES = [
+    "LCWA", "nonsensical", "one-hop nonsensical", "one-hop sensical", "sensical"
+]
+
+STRATEGY_IDX = {strategy: idx for idx, strategy in enumerate(CORRUPTION_STRATEGIES)}
+
+POLICIES = ["max", "min", "avg_floor", "avg_ceil"]
+POLICY_IDX = {p: i for i, p in enumerate(POLICIES)}
+
 
 def resolve_policies(row):
     max_val = np.max(row)
@@ -10,6 +31,7 @@ def resolve_policies(row):
     return int(max_val), int(min_val), int(np.floor(avg_val)), int(np.ceil(avg_val))
 
 
+@Instrumentation.timed("qrels")
 def generate_qrels_tsv(manager, output_files, WRITE=False):
     """
     Generates a TSV file containing qrels based on different corruption strategies.
@@ -27,26 +49,8 @@ def generate_qrels_tsv(manager, output_files, WRITE=False):
     #     "positive": 5
     # }
 
-    RELEVANCE_MAP = {
-        "LCWA": 0,
-        "nonsensical": 1,
-        "one-hop nonsensical": 2,
-        "one-hop sensical": 3,
-        "sensical": 4,
-        "positive": 5
-    }
-
-    CORRUPTION_STRATEGIES = [
-        "LCWA", "nonsensical", "one-hop nonsensical", "one-hop sensical", "sensical"
-    ]
-
     # POLICIES = ["max", "min", "avg"]
 
-    STRATEGY_IDX = {strategy: idx for idx, strategy in enumerate(CORRUPTION_STRATEGIES)}
-
-    POLICIES = ["max", "min", "avg_floor", "avg_ceil"]
-    POLICY_IDX = {p: i for i, p in enumerate(POLICIES)}
-
     # dataset_name = DatasetUtils.get_dataset_name(dataset)
 
     # print(f"\nGenerating Qrels for dataset {dataset}.{dataset_name}")
@@ -132,19 +136,16 @@ def generate_qrels_tsv(manager, output_files, WRITE=False):
 
     i = 1
 
-    entity_list = manager.entities
-    entity_count = len(entity_list)
-    ent_idx_map = {e: i for i, e in enumerate(entity_list)}
+    # Entity ids are dense (0..N-1) from the loader, so they index the columns directly; entity_ids maps them
+    #   back to the ids of the dataset files, which the queries and documents are written with
+    entity_ids = manager.entity_ids
+    relation_ids = manager.relation_ids
+    entity_count = len(entity_ids)
     num_strategies = len(CORRUPTION_STRATEGIES)
 
     # Preallocate reusable relevance matrix
     rel_matrix = np.zeros((num_strategies, entity_count), dtype=int)
 
-    # Clear all qrels files at the beginning, this won't work if we want to resume
-    for file in output_files:
-        with open(file, "w", newline='') as f:
-            pass  # just truncates the file
-
     # Prepare in-memory storage
     result_dict = {
         output_files[0]: [],  # max
@@ -244,7 +245,8 @@ def generate_qrels_tsv(manager, output_files, WRITE=False):
     # f_ceil.close()
     # print("All qrels written with masking and tie-breaking applied.")
     # print(f"\tQrels file generated at: {os.path.basename(output_tsv)}")
-        queries = [(f"({h},{r},{t})-h", "head", h), (f"({h},{r},{t})-t", "tail", t)]
+        triple_id = f"({entity_ids[h]},{relation_ids[r]},{entity_ids[t]})"
+        queries = [(triple_id + "-h", "head", h), (triple_id + "-t", "tail", t)]
 
         for query_id, direction, true_entity in queries:
             # Reset rel_matrix in-place to zero
@@ -253,16 +255,13 @@ def generate_qrels_tsv(manager, output_files, WRITE=False):
             for strategy in CORRUPTION_STRATEGIES:
                 if strategy == "LCWA":
                     continue
-                corrupted = manager.get_corrupted(h, r, t, direction, strategy)
                 row_idx = STRATEGY_IDX[strategy]
-                for e in corrupted:
-                    col_idx = ent_idx_map.get(e, -1)
-                    if col_idx != -1:
-                        rel_matrix[row_idx][col_idx] = RELEVANCE_MAP[strategy]
+                # Scattered chunk by chunk, the full array of corruptions is never built
+                for corrupted in manager.iter_corrupted(h, r, t, direction, strategy):
+                    rel_matrix[row_idx, corrupted] = RELEVANCE_MAP[strategy]
 
-            if true_entity in ent_idx_map:
-                for file in result_dict:
-                    result_dict[file].append([query_id, true_entity, RELEVANCE_MAP['positive']])
+            for file in result_dict:
+                result_dict[file].append([query_id, int(entity_ids[true_entity]), RELEVANCE_MAP['positive']])
 
             # Vectorized resolution
             nonzero_mask = np.any(rel_matrix > 0, axis=0)
@@ -279,51 +278,133 @@ def generate_qrels_tsv(manager, output_files, WRITE=False):
 
             # compute this like a cube
             for idx, e_idx in enumerate(col_indices):
-                e = entity_list[e_idx]
+                e = int(entity_ids[e_idx])
                 result_dict[output_files[0]].append([query_id, e, int(max_vals[idx])])
                 result_dict[output_files[1]].append([query_id, e, int(min_vals[idx])])
                 result_dict[output_files[2]].append([query_id, e, int(avg_vals[idx])])
                 result_dict[output_files[3]].append([query_id, e, int(avg_vals_ceil[idx])])
 
     if WRITE:
-        # Write all results after computation
+        # Write all results after computation, each file replaced atomically so an
+        # interrupted run never leaves a truncated qrels file behind
         for file, rows in result_dict.items():
-            pu.write_qrel_rows(file, rows)
+            pu.write_qrel_file(file, rows)
 
     # print("Qrels Generated successfully.")
 
     return result_dict
 
 
-def generate_qrels_tsv_cube(manager, output_files):
+def resolve_relation(manager, r, direction):
     """
-    Generates a TSV file containing qrels based on different corruption strategies.
+    Policy values of every candidate of a relation in one direction, before any known answer is removed.
+    Candidate pools only depend on the relation, so this is the part of generate_qrels_tsv that all the
+    queries of a relation share.
+
+    :param manager: TripleManager
+    :param r: Relation
+    :param direction: 'head' or 'tail'
+    :return: Tuple (sorted array of candidate entities, int64 array (4, candidates) of the POLICIES values)
+    """
+    rel_matrix = np.zeros((len(CORRUPTION_STRATEGIES), len(manager.entity_ids)), dtype=int)
+    for strategy in CORRUPTION_STRATEGIES:
+        if strategy == "LCWA":
+            continue
+        pool = np.asarray(manager.get_candidate_pool(r, direction, strategy), dtype=np.int64)
+        rel_matrix[STRATEGY_IDX[strategy], pool] = RELEVANCE_MAP[strategy]
+
+    # Same resolution as generate_qrels_tsv, the LCWA row (always 0) included
+    col_indices = np.flatnonzero(np.any(rel_matrix > 0, axis=0))
+    rel_matrix_nonzero = rel_matrix[:, col_indices]
+    sums, counts = np.sum(rel_matrix_nonzero, axis=0), np.count_nonzero(rel_matrix_nonzero, axis=0)
+    values = np.vstack((np.max(rel_matrix_nonzero, axis=0), np.min(rel_matrix_nonzero, axis=0),
+                        np.floor(sums / np.maximum(counts, 1)), np.ceil(sums / np.maximum(counts, 1))))
+    return col_indices, values.astype(np.int64)
+
+
+def _relation_rows(manager, r, indexes, triples):
+    """Qrels rows of the triples of one relation, as a list of (triple index, [rows per policy])."""
+    entity_ids, relation_ids = manager.entity_ids, manager.relation_ids
+    rows = {i: [[] for _ in POLICIES] for i in indexes.tolist()}
+
+    for direction, anchor_column, answer_column in (("head", 2, 0), ("tail", 0, 2)):
+        col_indices, values = resolve_relation(manager, r, direction)
+
+        # Queries sharing an anchor entity share their known answers, hence their candidates
+        anchor_rows = {}
+        for i in indexes.tolist():
+            h, _, t = triples[i].tolist()
+            anchor, answer = triples[i, anchor_column], triples[i, answer_column]
+
+            if anchor not in anchor_rows:
+                keep = ~np.isin(col_indices, np.asarray(manager.get_known(h, r, t, direction), dtype=np.int64))
+                anchor_rows[anchor] = (entity_ids[col_indices[keep]].tolist(),
+                                       [policy_values[keep].tolist() for policy_values in values])
+            entities, policy_values = anchor_rows[anchor]
+
+            query_id = f"({entity_ids[h]},{relation_ids[r]},{entity_ids[t]})" + ("-h" if direction == "head" else "-t")
+            positive = int(entity_ids[answer])
+            for file_rows, scores in zip(rows[i], policy_values):
+                file_rows.append([query_id, positive, RELEVANCE_MAP['positive']])
+                file_rows.extend([query_id, e, score] for e, score in zip(entities, scores))
+
+    # Head query rows then tail query rows, like generate_qrels_tsv
+    return list(rows.items())
+
+
+@Instrumentation.timed("qrels")
+def generate_qrels_by_relation(manager, output_files, WRITE=False, KEEP_ORDER=True, workers=1):
+    """
+    Same qrels as generate_qrels_tsv, generated relation by relation instead of in triple order: the candidate
+    pools and their policy values are resolved once per relation and direction, then every query only removes
+    its known answers (once per anchor entity). A relation's working set is built, used and released before the
+    next one, which keeps it in cache and lets relations run in parallel.
+
+    :param manager: TripleManager object
     :param output_files: All the policy related output files
-    :param manager: Triple Manager object.
+    :param WRITE: Flag to decide if we want to write the file or just return the dictionary
+    :param KEEP_ORDER: Put the rows back in the order of manager.get_triples(), as generate_qrels_tsv does.
+        Otherwise they are grouped by relation
+    :param workers: Threads processing relations in parallel
+    :return: Dictionary {output file: rows}
     """
-    RELEVANCE_MAP = {
-        "LCWA": 0,
-        "nonsensical": 1,
-        "one-hop nonsensical": 2,
-        "one-hop sensical": 3,
-        "sensical": 4,
-        "positive": 5
-    }
+    triples = triples_to_array(manager.get_triples())
+    order = np.argsort(triples[:, 1], kind="stable")
+    starts = np.flatnonzero(np.concatenate(([True], triples[order[1:], 1] != triples[order[:-1], 1]))) \
+        if len(order) else np.zeros(0, dtype=np.int64)
+    groups = [(int(triples[order[start], 1]), order[start:end])
+              for start, end in zip(starts.tolist(), [*starts[1:].tolist(), len(order)])]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        relation_rows = list(executor.map(lambda group: _relation_rows(manager, group[0], group[1], triples), groups))
 
-    CORRUPTION_STRATEGIES = [
-        "LCWA", "nonsensical", "one-hop nonsensical", "one-hop sensical", "sensical"
-    ]
+    triple_rows = [item for items in relation_rows for item in items]
+    if KEEP_ORDER:
+        triple_rows.sort(key=lambda item: item[0])
 
-    STRATEGY_IDX = {strategy: idx for idx, strategy in enumerate(CORRUPTION_STRATEGIES)}
+    result_dict = {file: [] for file in output_files[:len(POLICIES)]}
+    for _, rows in triple_rows:
+        for file, file_rows in zip(result_dict, rows):
+            result_dict[file].extend(file_rows)
 
-    POLICIES = ["max", "min", "avg_floor", "avg_ceil"]
-    POLICY_IDX = {p: i for i, p in enumerate(POLICIES)}
+    if WRITE:
+        for file, rows in result_dict.items():
+            pu.write_qrel_file(file, rows)
+
+    return result_dict
 
+
+def generate_qrels_tsv_cube(manager, output_files):
+    """
+    Generates a TSV file containing qrels based on different corruption strategies.
+    :param output_files: All the policy related output files
+    :param manager: Triple Manager object.
+    """
     print(f"\tFinding corrupted Qrels for {len(manager.get_triples())} triples")
 
-    entity_list = manager.entities
-    entity_count = len(entity_list)
-    ent_idx_map = {e: i for i, e in enumerate(entity_list)}
+    entity_ids = manager.entity_ids
+    relation_ids = manager.relation_ids
+    entity_count = len(entity_ids)
     num_strategies = len(CORRUPTION_STRATEGIES)
 
     rel_matrix = np.zeros((num_strategies, entity_count), dtype=int)
@@ -333,7 +414,8 @@ def generate_qrels_tsv_cube(manager, output_files):
     for i, (h, r, t) in enumerate(manager.get_triples(), 1):
         print(f"Positive {i}: ({h}, {r}, {t})")
 
-        queries = [(f"({h},{r},{t})-h", "head", h), (f"({h},{r},{t})-t", "tail", t)]
+        triple_id = f"({entity_ids[h]},{relation_ids[r]},{entity_ids[t]})"
+        queries = [(triple_id + "-h", "head", h), (triple_id + "-t", "tail", t)]
 
         for query_id, direction, true_entity in queries:
             rel_matrix.fill(0)
@@ -343,16 +425,11 @@ def generate_qrels_tsv_cube(manager, output_files):
                     continue
                 corrupted = manager.get_corrupted(h, r, t, direction, strategy)
                 row_idx = STRATEGY_IDX[strategy]
-                for e in corrupted:
-                    col_idx = ent_idx_map.get(e, -1)
-                    if col_idx != -1:
-                        rel_matrix[row_idx][col_idx] = RELEVANCE_MAP[strategy]
+                rel_matrix[row_idx, np.asarray(corrupted, dtype=np.int64)] = RELEVANCE_MAP[strategy]
 
             cube = np.zeros((4, num_strategies, entity_count), dtype=int)
-            if true_entity in ent_idx_map:
-                true_idx = ent_idx_map[true_entity]
-                for policy in POLICY_IDX:
-                    cube[POLICY_IDX[policy], :, true_idx] = RELEVANCE_MAP['positive']
+            for policy in POLICY_IDX:
+                cube[POLICY_IDX[policy], :, true_entity] = RELEVANCE_MAP['positive']
 
             nonzero_mask = np.any(rel_matrix > 0, axis=0)
             rel_matrix_nonzero = rel_matrix[:, nonzero_mask]
@@ -379,7 +456,7 @@ def generate_qrels_tsv_cube(manager, output_files):
             for s in range(num_strategies):
                 for e_idx, score in enumerate(cube[idx][s]):
                     if score > 0:
-                        result_dict[output_files[idx]].append([query_id, entity_list[e_idx], score])
+                        result_dict[output_files[idx]].append([query_id, int(entity_ids[e_idx]), score])
 
     for file, rows in result_dict.items():
         pu.write_qrel_rows(file, rows)
@@ -0,0 +1,217 @@
+import contextlib
+import functools
+import os
+import sys
+import time
+import tracemalloc
+import PathUtils as pu
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:  # Optional, the current RSS is read from /proc without it (Linux only)
+    psutil = None
+
+MB = 1024 ** 2
+
+# Stage recording is on by default, it costs a few microseconds per stage
+ENABLED = True
+
+# Root of the stage tree of this process and the stages currently open
+_root = None
+_open_stages = []
+
+
+def _new_node(name):
+    return {"name": name, "calls": 0, "wall_s": 0.0, "cpu_s": 0.0,
+            "rss_mb": None, "rss_delta_mb": None, "lifetime_peak_rss_mb": None,
+            "traced_delta_mb": None, "traced_peak_mb": None, "children": {}}
+
+
+def reset():
+    """Drops everything recorded so far, e.g. at the start of a new unit of work."""
+    global _root
+    _root = _new_node("total")
+    _open_stages.clear()
+    _open_stages.append(_root)
+
+
+reset()
+
+
+def get_current_rss():
+    """
+    Current resident set size of this process, in bytes.
+
+    :return: Current RSS, or None if it cannot be read on this platform
+    """
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of this process so far, in bytes. This is a lifetime peak: in a pool worker it covers
+    every unit the worker ran before, so it does not measure a single stage or unit (see get_current_rss).
+
+    :return: Peak RSS, or None if it cannot be read on this platform
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    if psutil is not None:
+        info = psutil.Process(os.getpid()).memory_info()
+        return getattr(info, "peak_wset", info.rss)
+
+    return None
+
+
+def start_tracing():
+    """Starts tracemalloc, so stages also record the Python allocations made inside them (slower)."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def _fold_traced_peak():
+    """Folds the tracemalloc peak since the last stage boundary into every open stage."""
+    current, peak = tracemalloc.get_traced_memory()
+    for open_stage in _open_stages:
+        open_stage["_traced_peak"] = max(open_stage.get("_traced_peak", 0), peak)
+    tracemalloc.reset_peak()
+    return current
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Records wall time, CPU time and memory of the code inside, as a child of the stage
+    currently open. Entering the same stage name again under the same parent adds to it.
+
+    Memory is the current RSS sampled when the stage is entered and left: rss_mb is the highest RSS on exit and
+    rss_delta_mb the summed change, so neither sees a peak inside the stage that is freed before it ends.
+    lifetime_peak_rss_mb is the process peak when the stage ended, which includes earlier stages and units.
+    When tracemalloc is running, the net Python allocations and their peak inside the stage are recorded too.
+
+    :param name: Name of the stage, e.g. "load", "aggregate", "compat", "qrels", "eval"
+    """
+    if not ENABLED:
+        yield
+        return
+
+    parent = _open_stages[-1]
+    node = parent["children"].setdefault(name, _new_node(name))
+
+    tracing = tracemalloc.is_tracing()
+    traced_start = _fold_traced_peak() if tracing else None
+    rss_start = get_current_rss()
+
+    open_stage = {"_traced_peak": traced_start or 0, "children": node["children"]}
+    _open_stages.append(open_stage)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        node["wall_s"] += time.perf_counter() - wall_start
+        node["cpu_s"] += time.process_time() - cpu_start
+        node["calls"] += 1
+
+        rss_end = get_current_rss()
+        if rss_end is not None:
+            node["rss_mb"] = max(node["rss_mb"] or 0, rss_end / MB)
+            node["rss_delta_mb"] = (node["rss_delta_mb"] or 0) + (rss_end - rss_start) / MB
+
+        peak_rss = get_peak_rss()
+        if peak_rss is not None:
+            node["lifetime_peak_rss_mb"] = max(node["lifetime_peak_rss_mb"] or 0, peak_rss / MB)
+
+        if tracing and tracemalloc.is_tracing():
+            traced_end = _fold_traced_peak()
+            node["traced_delta_mb"] = (node["traced_delta_mb"] or 0) + (traced_end - traced_start) / MB
+            node["traced_peak_mb"] = max(node["traced_peak_mb"] or 0,
+                                         (open_stage["_traced_peak"] - traced_start) / MB)
+
+        _open_stages.pop()
+
+
+def timed(name):
+    """
+    Decorator recording every call of a function as a stage.
+
+    :param name: Name of the stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _to_report(node, parent_wall=None):
+    report = {key: (round(value, 4) if isinstance(value, float) else value)
+              for key, value in node.items() if key != "children" and not key.startswith("_")}
+    if parent_wall:
+        report["share_of_parent"] = round(node["wall_s"] / parent_wall, 4)
+
+    report["children"] = [_to_report(child, node["wall_s"]) for child in node["children"].values()]
+    return report
+
+
+def get_report(metadata=None):
+    """
+    Stage tree recorded since the last reset, as a JSON-serializable dictionary.
+
+    :param metadata: Optional dictionary stored with the report (dataset, reshuffle, config, ...)
+    :return: Dictionary {"metadata": ..., "stages": [...]}
+    """
+    # The root is never entered as a stage, its totals are those of its children
+    _root["wall_s"] = sum(child["wall_s"] for child in _root["children"].values())
+    _root["cpu_s"] = sum(child["cpu_s"] for child in _root["children"].values())
+    _root["rss_mb"] = (get_current_rss() or 0) / MB or None
+    _root["lifetime_peak_rss_mb"] = (get_peak_rss() or 0) / MB or None
+
+    return {
+        "metadata": {**(metadata or {}), "pid": os.getpid(), "tracemalloc": tracemalloc.is_tracing(),
+                     "rss": "current RSS sampled at stage boundaries, lifetime_peak_rss_mb is the process peak"},
+        "stages": _to_report(_root)["children"],
+        "total": {key: value for key, value in _to_report(_root).items() if key != "children"}
+    }
+
+
+def write_report(file_path, metadata=None):
+    """
+    Writes the stage report to a JSON file.
+
+    :param file_path: Path of the JSON file
+    :param metadata: Optional dictionary stored with the report
+    """
+    pu.write_json_file(file_path, get_report(metadata))
+
+
+def print_report(metadata=None):
+    """Prints the stage tree, one line per stage, indented by nesting level."""
+    def print_node(node, depth):
+        print(f"\t{'  ' * depth}{node['name']}: {node['wall_s']:.2f}s wall, {node['cpu_s']:.2f}s CPU, "
+              f"{node['calls']} call(s), RSS {node['rss_mb'] or 0:.0f} MB ({node['rss_delta_mb'] or 0:+.0f} MB), "
+              f"lifetime peak RSS {node['lifetime_peak_rss_mb'] or 0:.0f} MB"
+              + (f", traced peak {node['traced_peak_mb']:.0f} MB" if node["traced_peak_mb"] is not None else ""))
+        for child in node["children"]:
+            print_node(child, depth + 1)
+
+    for node in get_report(metadata)["stages"]:
+        print_node(node, 0)
@@ -1,5 +1,6 @@
 from collections import defaultdict
 import ir_measures
+import numpy as np
 import random
 import time
 from TripleManager import TripleManager
@@ -7,10 +8,19 @@ from DataLoader import DataLoader
 import DatasetUtils
 import PathUtils as pu
 import GenerateQrels
+import RankEvaluator
+import BootstrapStats
+import Instrumentation
+import ExternalSort
+from ResultsStore import ResultsStore
 import sys
 # import os
 import csv
 
+# Fixed seed so confidence intervals and p-values are reproducible between sweeps
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_RESAMPLES = 10000
+
 
 def generate_queries_and_qrels_old(dataset_path, sample_size=10):
     """
@@ -315,20 +325,12 @@ def evaluate_ir_from_top_k_old(run_path, qrel_path):
         print(f"IR Evaluation Results saved to {output_file}")
 
 
-def calculate_ir_measures(test_file,
-                          run_path,
-                          qrels,
-                          dataset_name,
-                          output_json_path,
-                          threshold,
-                          method,
-                          models,
-                          WRITE=False):
-    models = set(models)
-
-    reshuffle_ID = pu.get_reshuffleId(test_file, "test")
+def get_measures():
+    """
+    Defines the measures every run is evaluated with.
 
-    # Define evaluation measures
+    :return: Tuple (base_measures, k_values)
+    """
     base_measures = [
         ir_measures.AP, ir_measures.BPref, ir_measures.MAP, ir_measures.MRR, ir_measures.RR
     ]
@@ -348,6 +350,66 @@ def calculate_ir_measures(test_file,
         for measure in at_k_measures:
             base_measures.append(measure @ k)
 
+    return base_measures, k_values
+
+
+def get_pending_units(test_file, run_path, output_files, output_json_path, models, PER_QUERY=False):
+    """
+    Lists the (policy, run) units of one (reshuffle, config) that have no saved result yet,
+    so a restarted pipeline can skip qrels generation for configs that are already done.
+
+    :param test_file: Reshuffled test file of the config
+    :param run_path: Folder with the run score files
+    :param output_files: Qrels output files, one per policy
+    :param output_json_path: IR results JSON of the config
+    :param models: Models to evaluate (empty means all)
+    :param PER_QUERY: Whether per-query matrices are required for a unit to count as done
+    :return: List of result keys ("<policy>_<run filename>") still to compute
+    """
+    base_measures, _ = get_measures()
+    completed, _ = _load_completed(output_json_path, [str(m) for m in base_measures], PER_QUERY)
+
+    run_files = _select_run_files(run_path, pu.get_reshuffleId(test_file, "test"), set(models))
+
+    return [f"{pu.get_policy_from_filename(output_file)}_{filename}"
+            for output_file in output_files
+            for filename, _ in run_files
+            if f"{pu.get_policy_from_filename(output_file)}_{filename}" not in completed]
+
+
+def is_config_finished(test_file, run_path, output_files, output_json_path, models, PER_QUERY=False):
+    """
+    Whether every unit of one (reshuffle, config) has a saved result. A reshuffle without run files yet is
+    never finished, its qrels still have to be generated.
+
+    :return: True if there are run files and none of their units is pending (see get_pending_units)
+    """
+    if not _select_run_files(run_path, pu.get_reshuffleId(test_file, "test"), set(models)):
+        return False
+    return not get_pending_units(test_file, run_path, output_files, output_json_path, models, PER_QUERY)
+
+
+@Instrumentation.timed("eval")
+def calculate_ir_measures(test_file,
+                          run_path,
+                          qrels,
+                          dataset_name,
+                          output_json_path,
+                          threshold,
+                          method,
+                          models,
+                          WRITE=False,
+                          TRUNCATE=False,
+                          PER_QUERY=False,
+                          store_path=None,
+                          RESUME=False):
+    models = set(models)
+
+    reshuffle_ID = pu.get_reshuffleId(test_file, "test")
+
+    # Define evaluation measures
+    base_measures, k_values = get_measures()
+
     results_json = {
         "metadata": {
             "dataset": dataset_name,
@@ -381,24 +443,82 @@ def calculate_ir_measures(test_file,
     # print("METADATA", json.dumps(metadata, separators=(',', ':')))
     # print(results_json["metadata"])
 
+    # Per-query matrices of every evaluated run, only kept when asked for
+    per_query = {} if PER_QUERY else None
+
+    # Pick up the units a previous, interrupted run of this config already finished
+    if RESUME and WRITE:
+        completed, completed_per_query = _load_completed(output_json_path, results_json["metadata"]["metrics"],
+                                                         PER_QUERY)
+        results_json["results"].update(completed)
+        if PER_QUERY:
+            per_query.update(completed_per_query)
+
     for output_file, qrel in qrels.items():
         results_json = _evaluate_ir_from_top_k(reshuffle_ID, run_path, output_file, qrel,
                                                results_json, base_measures, output_json_path,
-                                               models, WRITE)
+                                               models, WRITE, TRUNCATE, per_query)
+
+    if PER_QUERY:
+        results_json["significance"] = _compare_models(per_query)
 
     if WRITE:
         pu.write_json_file(output_json_path, results_json)
         print(f"IR Evaluation Results written to {output_json_path}")
 
+        if PER_QUERY:
+            per_query_path = pu.get_per_query_path(output_json_path)
+            pu.write_npz_file(per_query_path, _per_query_arrays(per_query))
+            print(f"Per-query metrics written to {per_query_path}")
 
-def _evaluate_ir_from_top_k(reshuffle_ID, run_path, output_file, qrel,
-                            results_json, base_measures, output_json_path,
-                            models, WRITE=False):
-    # qrels_dict = load_qrels(qrel)
-    qrels_dict = load_qrels_from_dict(qrel)
+    # Also keep every value in the cross-reshuffle store, if one is used
+    if store_path:
+        store = ResultsStore(store_path)
+        store.add_results_json(results_json)
+        store.close()
 
-    policy = pu.get_policy_from_filename(output_file)
 
+def _load_completed(output_json_path, metrics, PER_QUERY=False):
+    """
+    Reads the units already saved for a config by an earlier run.
+
+    A saved file only counts if it was evaluated with the same metrics. When per-query
+    matrices are required, a unit without its matrix in the .npz is not considered done.
+
+    :param output_json_path: IR results JSON of the config
+    :param metrics: Metric names of the current evaluation
+    :param PER_QUERY: Whether per-query matrices are required
+    :return: Tuple (results, per_query) of the completed units
+    """
+    existing = pu.read_json_file(output_json_path)
+    if not existing or existing.get("metadata", {}).get("metrics") != metrics:
+        return {}, {}
+
+    results = existing.get("results", {})
+    per_query = {}
+
+    if PER_QUERY:
+        arrays = pu.read_npz_file(pu.get_per_query_path(output_json_path))
+        for key, entry in results.items():
+            if f"{key}__matrix" in arrays:
+                per_query[key] = {
+                    **{k: v for k, v in entry.items() if k not in ("metrics", "confidence_intervals")},
+                    "measures": [str(m) for m in arrays["measures"]],
+                    "query_ids": [str(q) for q in arrays[f"{key}__queries"]],
+                    "matrix": arrays[f"{key}__matrix"].astype(np.float64)
+                }
+        results = {key: entry for key, entry in results.items() if key in per_query}
+
+    return results, per_query
+
+
+def _select_run_files(run_path, reshuffle_ID, models):
+    """
+    Run score files of one reshuffle, restricted to the requested models.
+
+    :return: List of (filename, parsed filename) tuples
+    """
+    selected = []
     for filename in pu.get_run_files(run_path):
 
         if not filename.endswith(".tsv"):
@@ -411,9 +531,87 @@ def _evaluate_ir_from_top_k(reshuffle_ID, run_path, output_file, qrel,
         if models and model not in models or parsed["resplit"] != pu.get_only_id(reshuffle_ID):
             continue
 
+        selected.append((filename, parsed))
+
+    return selected
+
+
+@Instrumentation.timed("significance")
+def _compare_models(per_query):
+    """
+    Paired bootstrap tests between the models evaluated on the same policy and partition.
+
+    :param per_query: Dictionary filled by _evaluate_ir_from_top_k
+    :return: Dictionary {"<run a> vs <run b>": {"mean_difference": {...}, "p_value": {...}}}
+    """
+    groups = defaultdict(dict)
+    for key, entry in per_query.items():
+        groups[(entry["policy"], entry["partition"])][key] = entry["matrix"]
+
+    significance = {}
+    for matrices in groups.values():
+        tests = BootstrapStats.pairwise_tests(matrices, BOOTSTRAP_RESAMPLES, BOOTSTRAP_SEED)
+
+        for (key_a, key_b), (mean_difference, p_value) in tests.items():
+            measures = per_query[key_a]["measures"]
+            significance[f"{key_a} vs {key_b}"] = {
+                "mean_difference": {m: float(f"{v:.4f}") for m, v in zip(measures, mean_difference)},
+                "p_value": {m: float(f"{v:.4f}") for m, v in zip(measures, p_value)}
+            }
+
+    return significance
+
+
+def _per_query_arrays(per_query):
+    """Flattens the per-query results into the named arrays stored in the .npz file."""
+    arrays = {}
+    for key, entry in per_query.items():
+        arrays["measures"] = np.array(entry["measures"])
+        arrays[f"{key}__queries"] = np.array(entry["query_ids"])
+        # Full precision, so tests rerun on resumed matrices give the same p-values
+        arrays[f"{key}__matrix"] = entry["matrix"].astype(np.float64)
+    return arrays
+
+
+def _evaluate_ir_from_top_k(reshuffle_ID, run_path, output_file, qrel,
+                            results_json, base_measures, output_json_path,
+                            models, WRITE=False, TRUNCATE=False, per_query=None):
+    policy = pu.get_policy_from_filename(output_file)
+
+    # Units finished earlier (when resuming) are not evaluated again
+    pending = [(filename, parsed) for filename, parsed in _select_run_files(run_path, reshuffle_ID, models)
+               if f"{policy}_" + filename not in results_json["results"]]
+    if not pending:
+        return results_json
+
+    # qrels_dict = load_qrels(qrel)
+    qrels_dict = load_qrels_from_dict(qrel)
+
+    # Cutoff mode: runs are cut to the largest k as they are read, qrels summarized once per policy
+    if TRUNCATE:
+        evaluator = RankEvaluator.CutoffEvaluator(base_measures)
+        qrels_summary = evaluator.summarize_qrels(qrels_dict)
+
+    for filename, parsed in pending:
+
         # print(f"Processing {filename}...")
-        run_dict = load_run(run_path + filename)
-        eval_result = ir_measures.calc_aggregate(base_measures, qrels_dict, run_dict)
+        matrix = None
+        if TRUNCATE:
+            truncated_run = evaluator.load_run(run_path + filename, qrels_dict)
+            query_ids, matrix = evaluator.calc_per_query(qrels_summary, truncated_run)
+            measures = evaluator.measures
+        elif per_query is not None:
+            run_dict = load_run(run_path + filename)
+            query_ids, matrix = RankEvaluator.calc_per_query(base_measures, qrels_dict, run_dict)
+            measures = base_measures
+        else:
+            run_dict = load_run(run_path + filename)
+            # One sort per query serves every @k measure
+            eval_result = RankEvaluator.calc_aggregate(base_measures, qrels_dict, run_dict)
+
+        if matrix is not None:
+            means = matrix.mean(axis=0) if len(matrix) else np.zeros(len(measures))
+            eval_result = dict(zip(measures, means))
 
         results_json["results"][f"{policy}_" + filename] = {
             **parsed,
@@ -423,9 +621,32 @@ def _evaluate_ir_from_top_k(reshuffle_ID, run_path, output_file, qrel,
             }
         }
 
+        if per_query is not None:
+            lower, upper = BootstrapStats.bootstrap_ci(matrix, n_resamples=BOOTSTRAP_RESAMPLES, seed=BOOTSTRAP_SEED)
+            results_json["results"][f"{policy}_" + filename]["confidence_intervals"] = {
+                str(measure): [float(f"{lo:.4f}"), float(f"{hi:.4f}")]
+                for measure, lo, hi in zip(measures, lower, upper)
+            }
+
+            per_query[f"{policy}_" + filename] = {
+                **parsed,
+                "policy": policy,
+                "measures": [str(measure) for measure in measures],
+                "query_ids": query_ids,
+                "matrix": matrix
+            }
+
         pu.print_json(f"Results_{policy}_{filename}", results_json["results"][f"{policy}_" + filename])
         # print(results_json["results"][f"{policy}_" + filename])
 
+        # Checkpoint after every unit, so an interrupted sweep only redoes unfinished work
+        if WRITE:
+            pu.write_json_file(output_json_path, results_json)
+
+    # Units whose matrices did not reach this file are recomputed when resuming
+    if WRITE and per_query is not None:
+        pu.write_npz_file(pu.get_per_query_path(output_json_path), _per_query_arrays(per_query))
+
     # pu.write_json_file(output_json_path, results_json)
     # print(f"IR Evaluation Results written to {output_json_path}")
 
@@ -457,44 +678,32 @@ def qrel_file_path_generate(dataset):
 
 def count_lines_in_tsv(file_path):
     """Counts the number of lines in a TSV file."""
-    with open(file_path, 'r', encoding='utf-8') as file:
-        return sum(1 for line in file)
+    return ExternalSort.count_lines(file_path)
 
 
-def analyze_qrels_conflicts(qrels_file, output_summary):
+def analyze_qrels_conflicts(qrels_file, output_summary, temp_folder=None):
     """
-    Identifies cases where the same query-document pair appears with different relevance scores.
+    Identifies cases where the same query-document pair appears more than once, with all its relevance scores.
     Writes a summary of these conflicts to a text file.
 
+    The qrels are sorted externally (chunks sorted and spilled to disk, then merged), so memory stays
+    bounded whatever the size of the file.
+
     :param qrels_file: Path to the qrels TSV file.
     :param output_summary: Path to the summary text file.
+    :param temp_folder: Folder for the temporary sorted runs (default: the system temporary folder).
     """
     print("Finding conflicting pairs...")
-    conflicts = {}
-    conflicting_pairs = {}
-
-    with open(qrels_file, 'r', encoding='utf-8') as file:
-        for line in file:
-            parts = line.strip().split()
-            query_id, doc_id, relevance = parts
-            key = (query_id, doc_id)
-
-            if key in conflicts:
-                conflicting_pairs[key] = [conflicts[key], relevance]
-            else:
-                conflicts[key] = relevance
-
-    print(f"Found {len(conflicting_pairs)} conflicting pairs...")
-
-    # Identify conflicting entries
-    # conflicting_pairs = {k: v for k, v in conflicts.items() if len(v) > 1}
+    conflicts = 0
 
     # Write summary
     with open(output_summary, 'w', encoding='utf-8') as out_file:
         out_file.write("Conflicting Qrels Summary:\n\n")
-        for (query_id, doc_id), scores in conflicting_pairs.items():
-            out_file.write(f"Query: {query_id}, Document: {doc_id}, Relevance Scores: {sorted(scores)}\n")
+        for query_id, doc_id, scores in ExternalSort.find_conflicts(qrels_file, temp_folder):
+            out_file.write(f"Query: {query_id}, Document: {doc_id}, Relevance Scores: {[str(s) for s in scores]}\n")
+            conflicts += 1
 
+    print(f"Found {conflicts} conflicting pairs...")
     print(f"Summary of conflicts saved to: {output_summary}")
 
 
@@ -0,0 +1,248 @@
+import os
+import time
+import numpy as np
+
+# Width of the triple-count header, rewritten in place once the file is complete
+HEADER_WIDTH = 20
+
+# Extra draws per batch to replace duplicate triples
+MAX_TOP_UPS = 20
+
+
+def power_law_cdf(size, exponent):
+    """
+    Cumulative distribution of a Zipf-like law over ranks 0..size-1, p(rank) ~ (rank + 1)^-exponent.
+
+    :param size: Number of ranks
+    :param exponent: Exponent of the law, 0 gives a uniform distribution
+    :return: NumPy array of cumulative probabilities, last value 1
+    """
+    weights = np.arange(1, size + 1, dtype=np.float64) ** -exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def _sample_range(cdf, rng, size, low=0, high=None):
+    """Inverse-CDF sampling of ranks restricted to [low, high), following the same law."""
+    high = len(cdf) if high is None else high
+    cdf_low = cdf[low - 1] if low > 0 else 0.0
+    u = cdf_low + rng.random(size) * (cdf[high - 1] - cdf_low)
+    return np.clip(np.searchsorted(cdf, u, side="right"), low, high - 1)
+
+
+def _split_ranks(cdf, parts):
+    """Splits the ranks into at most `parts` contiguous ranges of about equal probability mass."""
+    bounds = np.unique(np.searchsorted(cdf, np.arange(1, parts) / parts, side="right"))
+    bounds = bounds[(bounds > 0) & (bounds < len(cdf))]
+    edges = np.concatenate(([0], bounds, [len(cdf)]))
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _open_split(file_path):
+    f = open(file_path, "w", newline='')
+    f.write(" " * HEADER_WIDTH + "\n")
+    return f
+
+
+def _close_split(f, count):
+    f.seek(0)
+    f.write(f"{count:<{HEADER_WIDTH}}")
+    f.close()
+
+
+def _write_triples(f, triples):
+    # One format call for the whole batch, several times faster than np.savetxt
+    f.write(("%d %d %d\n" * len(triples)) % tuple(triples.ravel().tolist()))
+
+
+def _write_names(file_path, prefix, count, chunk_size):
+    with open(file_path, "w", newline='') as f:
+        f.write(f"{count}\n")
+        for start in range(0, count, chunk_size):
+            f.writelines(f"{prefix}{i}\t{i}\n" for i in range(start, min(start + chunk_size, count)))
+
+
+def generate_dataset(output_folder,
+                     num_triples,
+                     num_entities,
+                     num_relations,
+                     num_types=None,
+                     type_noise=0.05,
+                     entity_exponent=1.0,
+                     relation_exponent=0.8,
+                     valid_fraction=0.05,
+                     test_fraction=0.05,
+                     num_reshuffles=0,
+                     seed=0,
+                     chunk_size=1_000_000):
+    """
+    Writes a synthetic knowledge graph in the OpenKE layout used by the real datasets:
+    entity2id.txt, relation2id.txt, train2id.txt, valid2id.txt, test2id.txt (lines "h t r"),
+    plus <i>_resplit_test2id.txt for every reshuffle.
+
+    Entities are split into num_types blocks and every relation gets a domain type and a range
+    type, so relations sharing a type have overlapping domains/ranges (fewer types means more
+    compatible relations). A type_noise share of heads and tails is drawn from any type, which
+    makes the overlaps partial. Entity degrees and relation frequencies follow power laws.
+
+    Triples are generated relation by relation, in batches of about chunk_size at most, and
+    streamed to the files, so memory stays bounded whatever the total. The batches of a relation
+    cover disjoint ranges of head ranks, so a triple can only repeat within its batch, where
+    duplicates are replaced by new draws. All triples are therefore distinct (a relation whose
+    type blocks are too small for its share of triples ends up with fewer).
+
+    Each reshuffled test split keeps every generated triple with probability test_fraction,
+    so its size matches the test split in expectation.
+
+    :param output_folder: Folder to write the files to (created if missing)
+    :param num_triples: Number of triples to generate
+    :param num_entities: Number of entities
+    :param num_relations: Number of relations
+    :param num_types: Number of entity types (default: half the relations, at least 2)
+    :param type_noise: Share of heads/tails drawn outside the relation's domain/range type
+    :param entity_exponent: Power-law exponent of the entity degrees within a type
+    :param relation_exponent: Power-law exponent of the relation frequencies
+    :param valid_fraction: Share of triples going to valid2id.txt
+    :param test_fraction: Share of triples going to test2id.txt
+    :param num_reshuffles: Number of reshuffled test splits to write
+    :param seed: Seed of numpy.random.default_rng
+    :param chunk_size: Number of triples generated and written at once
+    :return: Dictionary with the number of triples written per file
+    """
+    num_types = num_types or max(2, num_relations // 2)
+
+    if num_triples < 1 or num_relations < 1:
+        raise ValueError("num_triples and num_relations must be positive")
+    if num_entities < 2 * num_types:
+        raise ValueError(f"num_entities ({num_entities}) must be at least twice num_types ({num_types})")
+    if not 0 <= type_noise <= 1:
+        raise ValueError(f"type_noise must be in [0, 1], got {type_noise}")
+    if valid_fraction < 0 or test_fraction <= 0 or valid_fraction + test_fraction >= 1:
+        raise ValueError("valid_fraction and test_fraction must leave a non-empty train split")
+
+    os.makedirs(output_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # Type blocks of equal size, the few remainder entities are only listed in entity2id.txt
+    type_size = num_entities // num_types
+    type_start = np.arange(num_types) * type_size
+
+    # One shared popularity law per block, ids relabelled so popular entities are spread out
+    entity_cdf = power_law_cdf(type_size, entity_exponent)
+    relabel = rng.permutation(num_entities)
+
+    # Triples per relation, popular relations at random positions
+    relation_probs = np.empty(num_relations)
+    relation_probs[rng.permutation(num_relations)] = np.diff(power_law_cdf(num_relations, relation_exponent),
+                                                             prepend=0.0)
+    relation_counts = rng.multinomial(num_triples, relation_probs)
+
+    domain_type = rng.integers(0, num_types, num_relations)
+    range_type = rng.integers(0, num_types, num_relations)
+
+    def sample_entities(size, relation_type, low=0, high=None):
+        types = np.where(rng.random(size) < type_noise, rng.integers(0, num_types, size), relation_type)
+        return relabel[type_start[types] + _sample_range(entity_cdf, rng, size, low, high)].astype(np.int64)
+
+    def sample_keys(r, low, high, size):
+        # Heads only come from ranks [low, high), so different batches never share a head
+        heads = sample_entities(size, domain_type[r], low, high)
+        tails = sample_entities(size, range_type[r])
+        return heads * num_entities + tails
+
+    def sample_distinct_triples(r, low, high, size):
+        keys = np.unique(sample_keys(r, low, high, size))
+
+        # Popular (head, tail) pairs repeat, draw more until the batch is full
+        for _ in range(MAX_TOP_UPS):
+            missing = size - len(keys)
+            if missing <= 0:
+                break
+            keys = np.unique(np.concatenate((keys, sample_keys(r, low, high, int(missing * 1.25) + 16))))
+
+        keys = keys[rng.permutation(len(keys))[:size]]
+
+        # Columns in file order: head, tail, relation
+        return np.column_stack((keys // num_entities, keys % num_entities, np.full(len(keys), r)))
+
+    _write_names(os.path.join(output_folder, "entity2id.txt"), "entity_", num_entities, chunk_size)
+    _write_names(os.path.join(output_folder, "relation2id.txt"), "relation_", num_relations, chunk_size)
+
+    splits = {name: _open_split(os.path.join(output_folder, f"{name}2id.txt")) for name in ["train", "valid", "test"]}
+    reshuffles = [_open_split(os.path.join(output_folder, f"{i}_resplit_test2id.txt")) for i in range(num_reshuffles)]
+    counts = {name: 0 for name in splits}
+    reshuffle_counts = [0] * num_reshuffles
+
+    try:
+        for r, relation_count in enumerate(relation_counts):
+            if relation_count == 0:
+                continue
+
+            # Large relations are split into batches over head ranges of about equal mass
+            head_ranges = _split_ranks(entity_cdf, -(-relation_count // chunk_size))
+            masses = np.array([entity_cdf[high - 1] - (entity_cdf[low - 1] if low > 0 else 0.0)
+                               for low, high in head_ranges])
+            batch_counts = rng.multinomial(relation_count, masses / masses.sum())
+
+            for (low, high), size in zip(head_ranges, batch_counts):
+                if size == 0:
+                    continue
+
+                triples = sample_distinct_triples(r, low, high, size)
+
+                draw = rng.random(len(triples))
+                assignment = {"test": draw < test_fraction,
+                              "valid": (draw >= test_fraction) & (draw < test_fraction + valid_fraction),
+                              "train": draw >= test_fraction + valid_fraction}
+
+                for name, mask in assignment.items():
+                    _write_triples(splits[name], triples[mask])
+                    counts[name] += int(mask.sum())
+
+                for i, f in enumerate(reshuffles):
+                    mask = rng.random(len(triples)) < test_fraction
+                    _write_triples(f, triples[mask])
+                    reshuffle_counts[i] += int(mask.sum())
+    finally:
+        for name, f in splits.items():
+            _close_split(f, counts[name])
+        for f, count in zip(reshuffles, reshuffle_counts):
+            _close_split(f, count)
+
+    return {**counts, "reshuffles": reshuffle_counts}
+
+
+def main():
+    output_folder = "D:\\Masters\\RIT\\Semesters\\Sem 4\\RA\\Augmented KGE\\Datasets\\Synthetic\\"
+
+    # Scales to generate, from quick checks (10^3) to scaling tests (10^8)
+    scales = [10 ** 3, 10 ** 5, 10 ** 7]
+
+    for num_triples in scales:
+        start_time = time.time()
+
+        folder = output_folder + f"{num_triples}\\"
+        print(f"Generating {num_triples} triples in {folder}")
+
+        counts = generate_dataset(folder,
+                                  num_triples=num_triples,
+                                  num_entities=max(100, num_triples // 10),
+                                  num_relations=max(10, min(1000, num_triples // 1000)),
+                                  num_reshuffles=5)
+        print(f"\t{counts}")
+
+        end_time(start_time)
+
+
+def end_time(start_time):
+    # Print the total execution time of the entire code
+    total_time = time.time() - start_time
+    time_taken = (f"\tTime Taken: "
+                  f"{total_time // 3600} Hours, "
+                  f"{(total_time % 3600) // 60} Minutes, "
+                  f"and {(total_time % 3600) % 60} seconds.")
+    print(time_taken)
+
+
+if __name__ == "__main__":
+    main()
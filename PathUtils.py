@@ -1,5 +1,6 @@
 import os
 import glob
+import numpy as np
 import re
 import csv
 import json
@@ -110,6 +111,30 @@ def get_entities(path):
     return entities
 
 
+def get_relations(path):
+    """
+    Relation ids listed in relation2id.txt, next to entity2id.txt.
+
+    :param path: Dataset path, as passed to get_entities
+    :return: Set of relation ids, or None if there is no relation2id.txt
+    """
+    file_path = os.path.dirname(path) + "\\relation2id.txt"
+    if not os.path.isfile(file_path):
+        return None
+
+    relations = set()
+    with open(file_path, encoding='utf-8') as fp:
+        for line in fp:
+            relation_id = line.strip().split()
+
+            if len(relation_id) != 2:
+                continue
+
+            relations.add(int(relation_id[1]))
+
+    return relations
+
+
 def check_folder_existence(folder_path):
     """
     Checks if a folder exists at the given path.
@@ -163,7 +188,19 @@ def get_original_files(dataset_folder):
     return train_file, val_file, test_file
 
 
-def get_policy_output_files(dataset, test_file, output_folder):
+def get_policy_output_files(dataset, test_file, output_folder, method, threshold):
+    """
+    Qrels files of every policy for one reshuffle and config, e.g.
+    '3_NELL-995_0_ABC(0.5)_Qrels_Max.tsv'. The config is part of the name (like in the IR results JSON),
+    so configs running in parallel never write to the same file.
+
+    :param dataset: Dataset number
+    :param test_file: Test file of the reshuffle
+    :param output_folder: Folder of the qrels files
+    :param method: Method of the config
+    :param threshold: Threshold of the config
+    :return: List of qrels file paths, one per policy
+    """
     dataset_name = DatasetUtils.get_dataset_name(dataset)
 
     reshuffle_ID = get_reshuffleId(test_file, "test")
@@ -173,7 +210,8 @@ def get_policy_output_files(dataset, test_file, output_folder):
     output_files = []
 
     for policy in policies:
-        output_file = output_folder + f"{dataset}_{dataset_name}_{reshuffle_ID}_Qrels_{policy}.tsv"
+        output_file = (output_folder + f"{dataset}_{dataset_name}_{reshuffle_ID}"
+                       + f"_{method}({threshold})_Qrels_{policy}.tsv")
 
         output_files.append(output_file)
 
@@ -192,16 +230,112 @@ def write_qrel_rows(file_path, rows):
         writer.writerows(rows)
 
 
+def atomic_write(file_path, write, mode="w", **open_kwargs):
+    """
+    Writes a file through a temporary file in the same folder that is then renamed over it,
+    so a crash mid-write never leaves a truncated or half-written file behind.
+
+    :param file_path: Path of the final file
+    :param write: Function taking the open temporary file and writing the contents
+    :param mode: Mode to open the temporary file with ("w" or "wb")
+    :param open_kwargs: Extra arguments for open (encoding, newline, ...)
+    """
+    folder = os.path.dirname(file_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    # Per-process name, so parallel units writing the same file never share a temporary file
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode, **open_kwargs) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, file_path)
+
+
+def write_qrel_file(file_path, rows):
+    """
+    Atomically replaces a qrels file with the given rows.
+
+    :param file_path: Path to the output TSV file
+    :param rows: List of rows, each row is [query_id, entity_id, score]
+    """
+    atomic_write(file_path, lambda f: csv.writer(f, delimiter='\t').writerows(rows), "w", newline='')
+
+
 def write_json_file(file_path, data):
     """
-    Writes a dictionary to a JSON file.
+    Atomically writes a dictionary to a JSON file.
 
     :param file_path: Path to the JSON output file
     :param data: Dictionary or JSON-serializable object to write
     """
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    atomic_write(file_path, lambda f: json.dump(data, f, indent=2), "w", encoding="utf-8")
+
+
+def read_json_file(file_path):
+    """
+    Reads a JSON file written by write_json_file.
+
+    :param file_path: Path to the JSON file
+    :return: The parsed object, or None if the file is missing, empty or not valid JSON
+    """
+    if not os.path.isfile(file_path) or os.path.getsize(file_path) == 0:
+        return None
+
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+
+def get_per_query_path(output_json_path):
+    """
+    Returns the .npz path that sits next to an IR results JSON and holds its per-query metrics.
+
+    :param output_json_path: Path of the IR results JSON file
+    :return: Path ending in '_per_query.npz'
+    """
+    return os.path.splitext(output_json_path)[0] + "_per_query.npz"
+
+
+def get_profile_path(output_json_path):
+    """
+    Returns the path of the stage timing report that sits next to an IR results JSON.
+
+    :param output_json_path: Path of the IR results JSON file
+    :return: Path ending in '_profile.json'
+    """
+    return os.path.splitext(output_json_path)[0] + "_profile.json"
+
+
+def write_npz_file(file_path, arrays):
+    """
+    Atomically writes named NumPy arrays to a compressed .npz file.
+
+    :param file_path: Path to the .npz output file
+    :param arrays: Dictionary {name: NumPy array}
+    """
+    atomic_write(file_path, lambda f: np.savez_compressed(f, **arrays), "wb")
+
+
+def read_npz_file(file_path):
+    """
+    Reads a .npz file written by write_npz_file.
+
+    :param file_path: Path to the .npz file
+    :return: Dictionary {name: NumPy array}, empty if the file is missing or unreadable
+    """
+    if not os.path.isfile(file_path):
+        return {}
+
+    try:
+        with np.load(file_path) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError):
+        return {}
 
 
 def parse_run_filename(filename):
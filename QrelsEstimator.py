@@ -0,0 +1,131 @@
+import random
+import time
+import tracemalloc
+import numpy as np
+from DataLoader import DataLoader, triples_to_array
+from TripleManager import TripleManager, SampledManager
+import GenerateQrels
+import DatasetUtils
+import SetAlgebra
+
+# Triples actually generated to measure the time and memory per row
+SAMPLE_SIZE = 200
+
+
+def count_qrel_rows(manager, triples=None):
+    """
+    Exact number of rows generate_qrels_tsv writes to every policy file, without generating them. A query has
+    a positive row plus one row per entity of the union of its non-LCWA candidate pools that is not a known
+    answer; the union only depends on the relation, so it is built once per relation and direction.
+
+    :param manager: TripleManager
+    :param triples: Triples to count (default: manager.get_triples())
+    :return: int64 array with the rows of every triple (head and tail query) in one policy file
+    """
+    triples = triples_to_array(manager.get_triples() if triples is None else triples)
+    modes = [strategy for strategy in GenerateQrels.CORRUPTION_STRATEGIES if strategy != "LCWA"]
+    rows = np.full(len(triples), 2, dtype=np.int64)
+
+    for r in np.unique(triples[:, 1]).tolist():
+        in_relation = np.flatnonzero(triples[:, 1] == r)
+        for direction, anchor_column in (("head", 2), ("tail", 0)):
+            union = SetAlgebra.union_many([manager.get_candidate_pool(r, direction, mode) for mode in modes],
+                                          manager.universe)
+            _, first, inverse = np.unique(triples[in_relation, anchor_column], return_index=True,
+                                          return_inverse=True)
+            candidates = np.array([len(union) - SetAlgebra.intersect_count(
+                union, manager.get_known(*triples[in_relation[j]].tolist(), direction), manager.universe)
+                for j in first.tolist()], dtype=np.int64)
+            rows[in_relation] += candidates[inverse.reshape(-1)]
+
+    return rows
+
+
+def estimate_qrels(manager, sample_size=SAMPLE_SIZE, seed=0):
+    """
+    Predicts the size and cost of generating the qrels of a manager before running it. Rows are counted
+    exactly (count_qrel_rows); time and memory per row are measured by generating the qrels of a seeded
+    sample of triples, then scaled to all the rows.
+
+    :param manager: TripleManager
+    :param sample_size: Number of triples generated to measure time and memory
+    :param seed: Seed of the sample
+    :return: Dictionary with triples, queries, rows_per_file, rows (all 4 policy files), bytes_per_row,
+        memory_bytes (the returned qrels dictionary) and seconds (generate_qrels_by_relation)
+    """
+    triples = triples_to_array(manager.get_triples())
+    rows_per_triple = count_qrel_rows(manager, triples)
+    rows_per_file = int(rows_per_triple.sum())
+
+    sample = sorted(random.Random(seed).sample(range(len(triples)), min(sample_size, len(triples))))
+    sample_manager = SampledManager(manager, triples[sample])
+    output_files = [f"estimate_{policy}.tsv" for policy in GenerateQrels.POLICIES]
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    qrels = GenerateQrels.generate_qrels_by_relation(sample_manager, output_files)
+    seconds = time.perf_counter() - start_time
+    sample_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    sample_rows = sum(len(rows) for rows in qrels.values())
+    del qrels
+
+    rows = rows_per_file * len(GenerateQrels.POLICIES)
+    bytes_per_row = sample_bytes / sample_rows if sample_rows else 0.0
+    # tracemalloc slows the sample run down a little, the time is an upper estimate
+    seconds_per_row = seconds / sample_rows if sample_rows else 0.0
+
+    return {"triples": len(triples), "queries": 2 * len(triples), "rows_per_file": rows_per_file, "rows": rows,
+            "bytes_per_row": bytes_per_row, "memory_bytes": int(rows * bytes_per_row),
+            "seconds": rows * seconds_per_row}
+
+
+def print_estimate(estimate):
+    print(f"\t{estimate['triples']} triples, {estimate['queries']} queries: "
+          f"{estimate['rows_per_file']:,} rows per policy file, {estimate['rows']:,} in total")
+    print(f"\tAbout {estimate['memory_bytes'] / 2 ** 30:.2f} GB in memory "
+          f"({estimate['bytes_per_row']:.0f} bytes per row) and {estimate['seconds'] / 60:.1f} minutes")
+
+
+def main():
+    # Datasets to estimate, see DatasetUtils.py for the numbers
+    test_datasets = [3]
+
+    # Reshuffled test split, or "" for the original test split
+    reshuffle_ID = "0_resplit_"
+
+    # Compatibility config, as in main.py
+    config = {"threshold": 0.75, "method": "overlap"}
+
+    folder = "D:\\Masters\\RIT\\Semesters\\Sem 4\\RA\\Augmented KGE\\General Tests\\Datasets_Reshuffling\\"
+
+    for dataset in test_datasets:
+        start_time = time.time()
+
+        dataset_name = DatasetUtils.get_dataset_name(dataset)
+        dataset_folder = folder + dataset_name + "\\"
+        print(f"Estimating the qrels of {dataset}_{dataset_name} {reshuffle_ID or 'original'} "
+              f"{config['method']}({config['threshold']})")
+
+        manager = TripleManager(DataLoader(dataset_folder + reshuffle_ID, "test"),
+                                DataLoader(dataset_folder, "train"), DataLoader(dataset_folder, "valid"),
+                                DataLoader(dataset_folder, "test"),
+                                compatible_threshold=config["threshold"], similarity_method=config["method"])
+        print_estimate(estimate_qrels(manager))
+
+        end_time(start_time)
+
+
+def end_time(start_time):
+    # Print the total execution time of the entire code
+    total_time = time.time() - start_time
+    time_taken = (f"\tTime Taken: "
+                  f"{total_time // 3600} Hours, "
+                  f"{(total_time % 3600) // 60} Minutes, "
+                  f"and {(total_time % 3600) % 60} seconds.")
+    print(time_taken)
+
+
+if __name__ == "__main__":
+    main()
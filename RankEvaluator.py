@@ -0,0 +1,435 @@
+import numpy as np
+import ir_measures
+
+
+# Measures that can be read straight out of the per-query prefix arrays
+CUTOFF_MEASURES = ["P", "nDCG", "R", "Success"]
+FULL_MEASURES = ["AP", "RR", "Bpref"]
+
+# Relevance value used for documents that appear in the run but not in the qrels
+UNJUDGED = -1
+
+
+def split_measures(measures):
+    """
+    Splits a list of ir_measures measures into the ones this module evaluates natively
+    and the ones that still need to go through ir_measures.
+
+    :param measures: List of ir_measures measure objects (e.g. AP, P@10, nDCG@10)
+    :return: Tuple (native, fallback), both lists of measures in their original order
+    """
+    native, fallback = [], []
+
+    for measure in measures:
+        params = dict(measure.params)
+        rel = params.pop("rel", 1)
+        cutoff = params.pop("cutoff", None)
+
+        if measure.NAME in CUTOFF_MEASURES and cutoff is not None and not params and rel == 1:
+            native.append(measure)
+        elif measure.NAME in FULL_MEASURES and cutoff is None and not params and rel == 1:
+            native.append(measure)
+        else:
+            fallback.append(measure)
+
+    return native, fallback
+
+
+def rank_query(qrel, run):
+    """
+    Sorts one query's run once and returns the relevance of every ranked document.
+
+    Ordering follows trec_eval: score descending, ties broken by document id descending.
+
+    :param qrel: Dictionary {doc_id: relevance} for the query
+    :param run: Dictionary {doc_id: score} for the query
+    :return: NumPy int array of relevance values in rank order (UNJUDGED for unknown docs)
+    """
+    doc_ids = list(run.keys())
+    count = len(doc_ids)
+
+    scores = np.fromiter(run.values(), dtype=np.float64, count=count)
+    rels = np.fromiter((qrel.get(doc, UNJUDGED) for doc in doc_ids), dtype=np.int64, count=count)
+
+    order = np.argsort(np.array(doc_ids), kind="stable")[::-1]
+    order = order[np.argsort(-scores[order], kind="stable")]
+
+    return rels[order]
+
+
+def summarize_qrel(qrel, depth=None, rel_level=1):
+    """
+    Reduces one query's judgments to what the measures need from them.
+
+    :param qrel: Dictionary {doc_id: relevance} for the query
+    :param depth: Keep the ideal DCG only up to this rank (None keeps all of it)
+    :param rel_level: Minimum relevance for a document to count as relevant
+    :return: Dictionary with num_rel, num_nonrel and the cumulative ideal_dcg
+    """
+    judged = np.fromiter(qrel.values(), dtype=np.int64, count=len(qrel))
+
+    ideal_gains = np.sort(judged[judged > 0])[::-1][:depth]
+    ideal_discounts = np.log2(np.arange(2, ideal_gains.size + 2))
+
+    return {
+        "num_rel": int(np.count_nonzero(judged >= rel_level)),
+        "num_nonrel": int(np.count_nonzero((judged >= 0) & (judged < rel_level))),
+        "ideal_dcg": np.cumsum(ideal_gains / ideal_discounts),
+    }
+
+
+def build_prefix_arrays(ranked_rels, qrel_summary, rel_level=1):
+    """
+    Builds the cumulative arrays that every @k measure of a query is read from.
+
+    :param ranked_rels: Relevance values in rank order, as returned by rank_query
+    :param qrel_summary: Dictionary returned by summarize_qrel
+    :param rel_level: Minimum relevance for a document to count as relevant
+    :return: Dictionary with is_rel, cum_rel and cum_dcg, plus the qrel summary fields
+    """
+    is_rel = ranked_rels >= rel_level
+    gains = np.where(ranked_rels > 0, ranked_rels, 0)
+    discounts = np.log2(np.arange(2, ranked_rels.size + 2))
+
+    return {
+        **qrel_summary,
+        "is_rel": is_rel,
+        "cum_rel": np.cumsum(is_rel),
+        "cum_dcg": np.cumsum(gains / discounts),
+    }
+
+
+def _at_cutoffs(cumulative, k_values):
+    """Reads a cumulative array at every cutoff, clamping k to the array length."""
+    if cumulative.size == 0:
+        return np.zeros(k_values.size)
+    return cumulative[np.minimum(k_values, cumulative.size) - 1]
+
+
+def evaluate_cutoffs(prefix, k_values):
+    """
+    Reads P, nDCG, R and Success at every cutoff by indexing into the prefix arrays.
+
+    :param prefix: Dictionary returned by build_prefix_arrays
+    :param k_values: NumPy int array of cutoffs
+    :return: Dictionary {measure name: NumPy array aligned with k_values}
+    """
+    rel_at_k = _at_cutoffs(prefix["cum_rel"], k_values)
+    dcg_at_k = _at_cutoffs(prefix["cum_dcg"], k_values)
+    ideal_at_k = _at_cutoffs(prefix["ideal_dcg"], k_values)
+    num_rel = prefix["num_rel"]
+
+    ndcg = np.divide(dcg_at_k, ideal_at_k, out=np.zeros(k_values.size), where=ideal_at_k > 0)
+
+    return {
+        "P": rel_at_k / k_values,
+        "nDCG": ndcg,
+        "R": rel_at_k / num_rel if num_rel else np.zeros(k_values.size),
+        "Success": (rel_at_k > 0).astype(np.float64),
+    }
+
+
+def _full_terms(ranked_rels, prefix):
+    """
+    Per relevant document contributions to AP and Bpref.
+
+    :return: Tuple (rel_ranks, ap_terms, bpref_terms), rel_ranks being 0-based positions
+    """
+    num_rel = prefix["num_rel"]
+    num_nonrel = prefix["num_nonrel"]
+    rel_ranks = np.flatnonzero(prefix["is_rel"])
+
+    ap_terms = prefix["cum_rel"][rel_ranks] / (rel_ranks + 1)
+
+    # Judged non-relevant documents ranked above each relevant one
+    is_nonrel = (ranked_rels >= 0) & ~prefix["is_rel"]
+    nonrel_above = np.cumsum(is_nonrel)[rel_ranks]
+    if num_nonrel:
+        penalty = np.minimum(nonrel_above, num_rel) / min(num_rel, num_nonrel)
+    else:
+        penalty = np.zeros(rel_ranks.size)
+    bpref_terms = np.where(nonrel_above > 0, 1.0 - penalty, 1.0)
+
+    return rel_ranks, ap_terms, bpref_terms
+
+
+def summarize_tail(ranked_rels, prefix, depth):
+    """
+    Compacts everything ranked below depth into the few numbers AP, RR and Bpref need.
+
+    :param ranked_rels: Full ranking, as returned by rank_query
+    :param prefix: Dictionary returned by build_prefix_arrays for the full ranking
+    :param depth: Rank at which the run is truncated
+    :return: Dictionary with rel_below, ap, bpref and first_rel_rank (0 when none) of the tail
+    """
+    rel_ranks, ap_terms, bpref_terms = _full_terms(ranked_rels, prefix)
+    below = rel_ranks >= depth
+
+    return {
+        "rel_below": int(np.count_nonzero(below)),
+        "ap": float(np.sum(ap_terms[below])),
+        "bpref": float(np.sum(bpref_terms[below])),
+        "first_rel_rank": int(rel_ranks[below][0] + 1) if below.any() else 0,
+    }
+
+
+def evaluate_full(ranked_rels, prefix, tail=None):
+    """
+    Computes the full-ranking measures (AP, RR, Bpref) from the same sorted ranking.
+
+    :param ranked_rels: Relevance values in rank order, as returned by rank_query
+    :param prefix: Dictionary returned by build_prefix_arrays
+    :param tail: Optional summary of a truncated tail, as returned by summarize_tail
+    :return: Dictionary {measure name: float}
+    """
+    num_rel = prefix["num_rel"]
+    if num_rel == 0:
+        return {"AP": 0.0, "RR": 0.0, "Bpref": 0.0}
+
+    rel_ranks, ap_terms, bpref_terms = _full_terms(ranked_rels, prefix)
+    ap_sum = float(np.sum(ap_terms))
+    bpref_sum = float(np.sum(bpref_terms))
+    first_rel_rank = int(rel_ranks[0] + 1) if rel_ranks.size else 0
+
+    if tail is not None:
+        ap_sum += tail["ap"]
+        bpref_sum += tail["bpref"]
+        first_rel_rank = first_rel_rank or tail["first_rel_rank"]
+
+    return {
+        "AP": ap_sum / num_rel,
+        "RR": 1.0 / first_rel_rank if first_rel_rank else 0.0,
+        "Bpref": bpref_sum / num_rel,
+    }
+
+
+def get_k_values(native):
+    """Returns the sorted distinct cutoffs used by a list of native measures."""
+    return np.array(sorted({m["cutoff"] for m in native if m.NAME in CUTOFF_MEASURES}), dtype=np.int64)
+
+
+def _values_from_ranking(native, k_values, ranked_rels, qrel_summary, tail=None):
+    """Evaluates every native measure of one query from its (possibly truncated) ranking."""
+    prefix = build_prefix_arrays(ranked_rels, qrel_summary)
+
+    at_k = evaluate_cutoffs(prefix, k_values) if k_values.size else {}
+    full = evaluate_full(ranked_rels, prefix, tail)
+    k_pos = {k: i for i, k in enumerate(k_values)}
+
+    values = np.empty(len(native))
+    for i, measure in enumerate(native):
+        if measure.NAME in CUTOFF_MEASURES:
+            values[i] = at_k[measure.NAME][k_pos[measure["cutoff"]]]
+        else:
+            values[i] = full[measure.NAME]
+    return values
+
+
+def calc_query_values(native, k_values, qrel, run):
+    """
+    Evaluates all natively supported measures for one query from a single sort.
+
+    :param native: List of measures accepted by split_measures
+    :param k_values: Cutoffs of native, as returned by get_k_values
+    :param qrel: Dictionary {doc_id: relevance} for the query
+    :param run: Dictionary {doc_id: score} for the query
+    :return: NumPy float array aligned with native
+    """
+    return _values_from_ranking(native, k_values, rank_query(qrel, run), summarize_qrel(qrel))
+
+
+def calc_per_query(measures, qrels_dict, run_dict):
+    """
+    Evaluates every judged query and keeps the values as a queries x measures matrix.
+
+    Rows follow the order of qrels_dict, so matrices of different runs evaluated against
+    the same qrels are aligned row by row (needed for paired tests).
+
+    :param measures: List of ir_measures measure objects
+    :param qrels_dict: Dictionary {query_id: {doc_id: relevance}}
+    :param run_dict: Dictionary {query_id: {doc_id: score}}
+    :return: Tuple (query_ids, matrix), matrix being a NumPy float array aligned with measures
+    """
+    native, fallback = split_measures(measures)
+    query_ids = list(qrels_dict)
+    matrix = np.zeros((len(query_ids), len(measures)))
+
+    native_cols = [i for i, measure in enumerate(measures) if measure in native]
+    if native_cols:
+        # Position of each native column in the values returned by calc_query_values
+        native_pos = [native.index(measures[i]) for i in native_cols]
+        k_values = get_k_values(native)
+
+        # Like trec_eval, every judged query counts and queries missing from the run score 0
+        for row, query_id in enumerate(query_ids):
+            if run_dict.get(query_id):
+                values = calc_query_values(native, k_values, qrels_dict[query_id], run_dict[query_id])
+                matrix[row, native_cols] = values[native_pos]
+
+    if fallback:
+        rows = {query_id: row for row, query_id in enumerate(query_ids)}
+        cols = {measure: i for i, measure in enumerate(measures)}
+        for metric in ir_measures.iter_calc(fallback, qrels_dict, run_dict):
+            if metric.query_id in rows:
+                matrix[rows[metric.query_id], cols[metric.measure]] = metric.value
+
+    return query_ids, matrix
+
+
+def calc_aggregate(measures, qrels_dict, run_dict):
+    """
+    Drop-in replacement for ir_measures.calc_aggregate.
+
+    Each query's run is sorted once and every cutoff of P, nDCG, R and Success is read from
+    the same prefix arrays, so adding cutoffs costs almost nothing. Measures this module
+    does not support are passed on to ir_measures unchanged.
+
+    :param measures: List of ir_measures measure objects
+    :param qrels_dict: Dictionary {query_id: {doc_id: relevance}}
+    :param run_dict: Dictionary {query_id: {doc_id: score}}
+    :return: Dictionary {measure: mean value over the evaluated queries}
+    """
+    native, fallback = split_measures(measures)
+    results = {}
+
+    if native:
+        # Like trec_eval, every judged query counts and queries missing from the run score 0
+        k_values = get_k_values(native)
+        totals = np.zeros(len(native))
+        for query_id, qrel in qrels_dict.items():
+            if run_dict.get(query_id):
+                totals += calc_query_values(native, k_values, qrel, run_dict[query_id])
+
+        means = totals / len(qrels_dict) if qrels_dict else totals
+        results.update({measure: float(value) for measure, value in zip(native, means)})
+
+    if fallback:
+        results.update(ir_measures.calc_aggregate(fallback, qrels_dict, run_dict))
+
+    # Keep the caller's measure order, as ir_measures does
+    return {measure: results[measure] for measure in measures if measure in results}
+
+
+class CutoffEvaluator:
+    def __init__(self, measures, rel_level=1):
+        """
+        Evaluation mode that declares its cutoffs up front and keeps only what they need.
+
+        Runs are truncated to the largest cutoff while they are read. Everything ranked
+        below it is folded into a small tail summary (relevant count, AP/Bpref
+        contributions, first relevant rank), so AP, RR and Bpref stay exact while memory
+        and time scale with the largest cutoff rather than with the candidate count.
+
+        :param measures: List of ir_measures measure objects, all supported by this module
+        :param rel_level: Minimum relevance for a document to count as relevant
+        """
+        native, fallback = split_measures(measures)
+        if fallback:
+            raise ValueError(f"Measures not supported in cutoff mode: {[str(m) for m in fallback]}")
+
+        self.measures = native
+        self.rel_level = rel_level
+        self.k_values = get_k_values(native)
+        self.depth = int(self.k_values[-1]) if self.k_values.size else 0
+
+    def summarize_qrels(self, qrels_dict):
+        """
+        Truncates every query's judgments to the summary needed at this depth.
+
+        :param qrels_dict: Dictionary {query_id: {doc_id: relevance}}
+        :return: Dictionary {query_id: summary}, see summarize_qrel
+        """
+        return {query_id: summarize_qrel(qrel, self.depth, self.rel_level)
+                for query_id, qrel in qrels_dict.items()}
+
+    def truncate_query(self, qrel, run):
+        """
+        Ranks one query's run and keeps only its head plus a tail summary.
+
+        :param qrel: Dictionary {doc_id: relevance} for the query
+        :param run: Dictionary {doc_id: score} for the query
+        :return: Tuple (head relevance values as int8, tail summary)
+        """
+        ranked_rels = rank_query(qrel, run)
+        prefix = build_prefix_arrays(ranked_rels, summarize_qrel(qrel, rel_level=self.rel_level), self.rel_level)
+        tail = summarize_tail(ranked_rels, prefix, self.depth)
+
+        return ranked_rels[:self.depth].astype(np.int8), tail
+
+    def truncate_run(self, run_dict, qrels_dict):
+        """
+        Truncates an in-memory run.
+
+        :param run_dict: Dictionary {query_id: {doc_id: score}}
+        :param qrels_dict: Dictionary {query_id: {doc_id: relevance}}
+        :return: Dictionary {query_id: (head, tail)}, only for judged queries
+        """
+        return {query_id: self.truncate_query(qrels_dict[query_id], run)
+                for query_id, run in run_dict.items() if query_id in qrels_dict and run}
+
+    def load_run(self, run_file, qrels_dict):
+        """
+        Streams a run file and truncates each query as soon as its block is complete.
+
+        Lines of one query must be contiguous, as in the TopK run files, so at most one
+        query's candidates are held in memory at a time.
+
+        :param run_file: Path to the run TSV file (query_id, doc_id, score)
+        :param qrels_dict: Dictionary {query_id: {doc_id: relevance}}
+        :return: Dictionary {query_id: (head, tail)}
+        """
+        truncated = {}
+        seen = set()
+        current_query, block = None, {}
+
+        def flush():
+            if current_query in qrels_dict and block:
+                truncated[current_query] = self.truncate_query(qrels_dict[current_query], block)
+
+        with open(run_file, 'r', encoding='utf-8') as file:
+            for line in file:
+                query_id, doc_id, score = line.strip().split()
+
+                if query_id != current_query:
+                    if query_id in seen:
+                        raise ValueError(f"Run file {run_file} is not grouped by query: {query_id} repeats")
+                    flush()
+                    seen.add(query_id)
+                    current_query, block = query_id, {}
+
+                block[str(int(float(doc_id)))] = float(score)
+
+        flush()
+        return truncated
+
+    def calc_per_query(self, qrels_summary, truncated_run):
+        """
+        Evaluates a truncated run query by query.
+
+        :param qrels_summary: Dictionary returned by summarize_qrels
+        :param truncated_run: Dictionary returned by load_run or truncate_run
+        :return: Tuple (query_ids, matrix), matrix being queries x self.measures
+        """
+        query_ids = list(qrels_summary)
+        matrix = np.zeros((len(query_ids), len(self.measures)))
+
+        for row, query_id in enumerate(query_ids):
+            if query_id in truncated_run:
+                head, tail = truncated_run[query_id]
+                matrix[row] = _values_from_ranking(self.measures, self.k_values, head,
+                                                   qrels_summary[query_id], tail)
+
+        return query_ids, matrix
+
+    def calc_aggregate(self, qrels_summary, truncated_run):
+        """
+        Evaluates a truncated run against summarized qrels.
+
+        :param qrels_summary: Dictionary returned by summarize_qrels
+        :param truncated_run: Dictionary returned by load_run or truncate_run
+        :return: Dictionary {measure: mean value over the judged queries}
+        """
+        _, matrix = self.calc_per_query(qrels_summary, truncated_run)
+
+        means = matrix.mean(axis=0) if len(matrix) else np.zeros(len(self.measures))
+        return {measure: float(value) for measure, value in zip(self.measures, means)}
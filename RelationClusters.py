@@ -0,0 +1,82 @@
+import hashlib
+import numpy as np
+import SetAlgebra
+
+
+class RelationClusters:
+    """
+    Index sharing the one-hop (and k-hop) candidate pools between relations. The pool of a (relation, side) is
+    the union of the domains/ranges of its compatible (relation, side) pairs, and many relations have the same
+    compatible pairs, or pairs with identical domains and ranges. Every distinct entity set gets an id, a
+    cluster is a distinct set of those ids (the signature of a pool), and its union is computed once, when
+    first asked for, and shared by every relation pointing to it.
+
+    Pools are read-only arrays, as they are shared.
+    """
+
+    def __init__(self, get_elements, universe=None):
+        """
+        :param get_elements: Function (relation, elem_type) -> array of entities, e.g. TripleManager._get_elements
+        :param universe: Number of possible entity ids, passed to SetAlgebra
+        """
+        self.get_elements = get_elements
+        self.universe = universe
+
+        # (relation, elem_type) -> id of its entity set, None when it is empty
+        self.set_ids = {}
+        # Distinct entity sets (sorted) and their ids by digest
+        self.sets = []
+        self._digests = {}
+
+        # Signature (frozenset of set ids) -> cluster id, and the signature and union (once computed) of every cluster
+        self.clusters = {}
+        self.signatures = []
+        self.pools = []
+
+    def __len__(self):
+        return len(self.pools)
+
+    def set_id(self, relation, elem_type):
+        """
+        :return: Id of the entity set of (relation, elem_type), shared with every pair holding the same entities,
+            or None for an empty set
+        """
+        key = (relation, elem_type)
+        if key not in self.set_ids:
+            elements = np.sort(np.asarray(self.get_elements(relation, elem_type), dtype=np.int64))
+            set_id = None
+            if len(elements):
+                digest = hashlib.blake2b(elements.tobytes(), digest_size=16).digest()
+                # Digests only narrow the candidates down, sets are compared in full
+                candidates = self._digests.setdefault(digest, [])
+                set_id = next((i for i in candidates if np.array_equal(self.sets[i], elements)), None)
+                if set_id is None:
+                    set_id = len(self.sets)
+                    self.sets.append(elements)
+                    candidates.append(set_id)
+            self.set_ids[key] = set_id
+        return self.set_ids[key]
+
+    def cluster(self, pairs):
+        """
+        :param pairs: List of (r', elem_type') whose entities are unioned, e.g. compatible_relations[(r, side)]
+        :return: Id of the cluster of pools with the same entity sets
+        """
+        signature = frozenset(self.set_id(r_prime, type_prime) for r_prime, type_prime in pairs) - {None}
+        if signature not in self.clusters:
+            self.clusters[signature] = len(self.pools)
+            self.signatures.append(signature)
+            self.pools.append(None)
+        return self.clusters[signature]
+
+    def pool(self, cluster_id):
+        """
+        :param cluster_id: Id returned by cluster
+        :return: Sorted, read-only array of the union of the cluster's entity sets
+        """
+        if self.pools[cluster_id] is None:
+            pool = SetAlgebra.union_many([self.sets[set_id] for set_id in sorted(self.signatures[cluster_id])],
+                                         self.universe)
+            pool.flags.writeable = False
+            self.pools[cluster_id] = pool
+        return self.pools[cluster_id]
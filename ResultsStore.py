@@ -0,0 +1,172 @@
+import sqlite3
+import json
+import glob
+import os
+import time
+import PathUtils as pu
+
+# Every stored value is identified by these columns, in this order
+KEY_COLUMNS = ["dataset", "reshuffle", "method", "threshold", "policy", "model", "partition", "metric"]
+
+
+class ResultsStore:
+    def __init__(self, db_path):
+        """
+        Single SQLite table holding every IR metric of every reshuffle, one row per value.
+
+        Rows are keyed by dataset, reshuffle, method, threshold, policy, model, partition and
+        metric, so re-evaluating a unit overwrites its rows instead of duplicating them.
+
+        :param db_path: Path of the SQLite database file (created if missing)
+        """
+        self.db_path = db_path
+        # Parallel units write to the same file, so wait for the lock instead of failing
+        self.connection = sqlite3.connect(db_path, timeout=300)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS ir_results ("
+            "dataset TEXT, reshuffle TEXT, method TEXT, threshold REAL, policy TEXT, "
+            "model TEXT, partition TEXT, metric TEXT, value REAL, "
+            f"PRIMARY KEY ({', '.join(KEY_COLUMNS)}))"
+        )
+        # Most summaries group by config and metric across reshuffles
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS ir_results_config "
+            "ON ir_results (dataset, method, threshold, policy, metric)"
+        )
+        self.connection.commit()
+
+    def add_results_json(self, results_json):
+        """
+        Stores every metric of an IR results dictionary, as built by IrMeasure.calculate_ir_measures.
+
+        :param results_json: Dictionary with "metadata" and "results"
+        :return: Number of rows written
+        """
+        metadata = results_json["metadata"]
+        hyperparameters = metadata.get("hyperparameters", {})
+        default_reshuffle = _normalize_reshuffle(metadata.get("reshuffle_id"))
+
+        rows = []
+        for entry in results_json["results"].values():
+            reshuffle = entry.get("resplit", "unknown")
+            if reshuffle == "unknown":
+                reshuffle = default_reshuffle
+
+            key = (metadata["dataset"], reshuffle,
+                   hyperparameters.get("similarity_method"), hyperparameters.get("compatible_threshold"),
+                   entry["policy"], entry["model"], entry["partition"])
+
+            rows.extend((*key, metric, value) for metric, value in entry["metrics"].items())
+
+        self.connection.executemany("INSERT OR REPLACE INTO ir_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+        return len(rows)
+
+    def import_json_file(self, file_path):
+        """
+        Stores the contents of one IR results JSON file. Empty files are skipped.
+
+        :param file_path: Path to the JSON file
+        :return: Number of rows written
+        """
+        if os.path.getsize(file_path) == 0:
+            return 0
+
+        with open(file_path, "r", encoding="utf-8") as f:
+            results_json = json.load(f)
+
+        if "metadata" not in results_json or "results" not in results_json:
+            return 0
+
+        return self.add_results_json(results_json)
+
+    def import_folder(self, folder):
+        """
+        Backfills the store from every *IR_results.json below a folder (e.g. IR_Measures/).
+
+        :param folder: Folder to search recursively
+        :return: Number of rows written
+        """
+        files = glob.glob(os.path.join(folder, "**", "*IR_results.json"), recursive=True)
+        return sum(self.import_json_file(file_path) for file_path in files)
+
+    def summarize(self, group_by=("dataset", "method", "threshold", "policy", "model", "partition", "metric"),
+                  where=None):
+        """
+        Mean, sample standard deviation, min and max of the stored values per group.
+
+        Grouping leaves out "reshuffle" by default, so each row summarizes a config across
+        all of its reshuffles.
+
+        :param group_by: Columns to group by, any of KEY_COLUMNS
+        :param where: Optional dictionary {column: value} to filter on
+        :return: List of dictionaries with the group columns plus n, mean, std, min and max
+        """
+        where = where or {}
+        for column in (*group_by, *where):
+            if column not in KEY_COLUMNS:
+                raise ValueError(f"Unknown column: {column}")
+
+        columns = ", ".join(group_by)
+        query = (f"SELECT {columns}, COUNT(value), AVG(value), "
+                 f"SUM(value * value), MIN(value), MAX(value) FROM ir_results")
+        if where:
+            query += " WHERE " + " AND ".join(f"{column} = ?" for column in where)
+        query += f" GROUP BY {columns} ORDER BY {columns}"
+
+        summary = []
+        for row in self.connection.execute(query, tuple(where.values())):
+            n, mean, sum_squares, minimum, maximum = row[len(group_by):]
+            variance = (sum_squares - n * mean * mean) / (n - 1) if n > 1 else 0.0
+
+            summary.append({
+                **dict(zip(group_by, row[:len(group_by)])),
+                "n": n,
+                "mean": mean,
+                "std": max(variance, 0.0) ** 0.5,
+                "min": minimum,
+                "max": maximum
+            })
+
+        return summary
+
+    def close(self):
+        self.connection.close()
+
+
+def _normalize_reshuffle(reshuffle_id):
+    """Older result files store '10_resplit_' where newer ones store '10'."""
+    if reshuffle_id and "resplit" in reshuffle_id:
+        return pu.get_only_id(reshuffle_id)
+    return reshuffle_id
+
+
+def main():
+    json_output_folder = "D:\\Masters\\RIT\\Semesters\\Sem 4\\RA\\Augmented KGE\\General Tests\\IR_Measures\\"
+
+    start_time = time.time()
+
+    store = ResultsStore(json_output_folder + "IR_results.sqlite")
+    print(f"Imported {store.import_folder(json_output_folder)} values")
+
+    for row in store.summarize(where={"metric": "AP"}):
+        pu.print_json("Summary", row)
+
+    store.close()
+
+    end_time(start_time)
+
+
+def end_time(start_time):
+    # Print the total execution time of the entire code
+    total_time = time.time() - start_time
+    time_taken = (f"\tTime Taken: "
+                  f"{total_time // 3600} Hours, "
+                  f"{(total_time % 3600) // 60} Minutes, "
+                  f"and {(total_time % 3600) % 60} seconds.")
+    print(time_taken)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import os
+import platform
+import time
+import numpy as np
+import PathUtils as pu
+
+OPERATIONS = ["union", "intersect", "difference", "intersect_count", "union_many"]
+BACKENDS = ["sorted", "hash", "bitset"]
+
+# Forces one backend for every call (None picks one per call from the calibrated thresholds)
+BACKEND = None
+
+# Crossover points of this machine, measured once by calibrate() and cached here
+CALIBRATION_FILE = os.path.join(os.path.expanduser("~"), ".set_algebra_calibration.json")
+
+# Used until calibrated, close to what calibrate() measures on a typical desktop
+DEFAULT_THRESHOLDS = {
+    "hash_max_size": {"union": 64, "intersect": 64, "difference": 256, "intersect_count": 64, "union_many": 64},
+    "bitset_min_density": {"union": 0.01, "intersect": 0.01, "difference": 0.01, "intersect_count": 0.01,
+                           "union_many": 0.01}
+}
+
+# Ids a Complement yields per chunk when iterated
+CHUNK_SIZE = 1 << 16
+
+_thresholds = None
+
+
+# ---------------------------------------------------------------
+# Operands are arrays of distinct entity ids. union, intersect and
+# union_many return sorted arrays; difference keeps the order of its
+# first operand, like np.setdiff1d(..., assume_unique=True). All
+# backends return exactly the same result.
+# ---------------------------------------------------------------
+
+def _as_ids(array):
+    # np.array([]) is float, ids must stay integers
+    array = np.asarray(array)
+    return array if array.dtype.kind in "iu" else array.astype(np.int64)
+
+
+def _sorted_union(a, b):
+    return np.union1d(a, b)
+
+
+def _sorted_intersect(a, b):
+    return np.intersect1d(a, b, assume_unique=True)
+
+
+def _sorted_difference(a, b):
+    return np.setdiff1d(a, b, assume_unique=True)
+
+
+def _sorted_intersect_count(a, b):
+    return np.intersect1d(a, b, assume_unique=True).size
+
+
+def _sorted_union_many(arrays):
+    return np.unique(np.concatenate(arrays)) if arrays else np.zeros(0, dtype=np.int64)
+
+
+def _from_set(elements):
+    array = np.fromiter(elements, dtype=np.int64, count=len(elements))
+    array.sort()
+    return array
+
+
+def _hash_union(a, b):
+    return _from_set(set(a.tolist()).union(b.tolist()))
+
+
+def _hash_intersect(a, b):
+    return _from_set(set(a.tolist()).intersection(b.tolist()))
+
+
+def _hash_difference(a, b):
+    b = set(b.tolist())
+    return np.array([x for x in a.tolist() if x not in b], dtype=np.int64)
+
+
+def _hash_intersect_count(a, b):
+    small, large = (a, b) if len(a) <= len(b) else (b, a)
+    return len(set(large.tolist()).intersection(small.tolist()))
+
+
+def _hash_union_many(arrays):
+    elements = set()
+    for array in arrays:
+        elements.update(array.tolist())
+    return _from_set(elements)
+
+
+def _mask(universe, *arrays):
+    mask = np.zeros(universe, dtype=bool)
+    for array in arrays:
+        mask[array] = True
+    return mask
+
+
+def _bitset_union(a, b, universe):
+    return np.flatnonzero(_mask(universe, a, b))
+
+
+def _bitset_intersect(a, b, universe):
+    small, large = (a, b) if len(a) <= len(b) else (b, a)
+    return np.sort(small[_mask(universe, large)[small]])
+
+
+def _bitset_difference(a, b, universe):
+    return a[~_mask(universe, b)[a]]
+
+
+def _bitset_intersect_count(a, b, universe):
+    small, large = (a, b) if len(a) <= len(b) else (b, a)
+    return int(np.count_nonzero(_mask(universe, large)[small]))
+
+
+def _bitset_union_many(arrays, universe):
+    return np.flatnonzero(_mask(universe, *arrays))
+
+
+_IMPLEMENTATIONS = {
+    "sorted": {"union": _sorted_union, "intersect": _sorted_intersect, "difference": _sorted_difference,
+               "intersect_count": _sorted_intersect_count, "union_many": _sorted_union_many},
+    "hash": {"union": _hash_union, "intersect": _hash_intersect, "difference": _hash_difference,
+             "intersect_count": _hash_intersect_count, "union_many": _hash_union_many},
+    "bitset": {"union": _bitset_union, "intersect": _bitset_intersect, "difference": _bitset_difference,
+               "intersect_count": _bitset_intersect_count, "union_many": _bitset_union_many}
+}
+
+
+def get_thresholds():
+    """
+    Crossover thresholds of this machine: the calibration file if it was written on this machine,
+    otherwise the defaults (run calibrate() once to measure them).
+
+    :return: Dictionary {"hash_max_size": {operation: size}, "bitset_min_density": {operation: density}}
+    """
+    global _thresholds
+    if _thresholds is None:
+        calibration = pu.read_json_file(CALIBRATION_FILE)
+        if calibration is not None and calibration.get("machine") == _get_machine():
+            _thresholds = calibration["thresholds"]
+        else:
+            _thresholds = DEFAULT_THRESHOLDS
+    return _thresholds
+
+
+def choose_backend(operation, size, universe=None):
+    """
+    Picks the backend of one call. Small operands go to Python sets (NumPy's per-call overhead dominates),
+    operands dense in their universe go to a bitset, everything else to sorted arrays.
+
+    :param operation: One of OPERATIONS
+    :param size: Total size of the operands
+    :param universe: Number of possible ids (None rules the bitset out)
+    :return: One of BACKENDS
+    """
+    if BACKEND is not None:
+        return BACKEND if BACKEND != "bitset" or universe else "sorted"
+
+    thresholds = get_thresholds()
+    if size <= thresholds["hash_max_size"][operation]:
+        return "hash"
+    if universe and size / universe >= thresholds["bitset_min_density"][operation]:
+        return "bitset"
+    return "sorted"
+
+
+def _run(operation, operands, universe, *args):
+    backend = choose_backend(operation, sum(len(operand) for operand in operands), universe)
+    if backend == "bitset":
+        return _IMPLEMENTATIONS[backend][operation](*args, universe)
+    return _IMPLEMENTATIONS[backend][operation](*args)
+
+
+def union(a, b, universe=None):
+    """
+    Union of two arrays of distinct ids.
+
+    :param a: Array of distinct ids
+    :param b: Array of distinct ids
+    :param universe: Number of possible ids, i.e. all ids are below it (optional, enables the bitset)
+    :return: Sorted array
+    """
+    a, b = _as_ids(a), _as_ids(b)
+    return _run("union", (a, b), universe, a, b)
+
+
+def intersect(a, b, universe=None):
+    """Intersection of two arrays of distinct ids, as a sorted array (see union for the parameters)."""
+    a, b = _as_ids(a), _as_ids(b)
+    return _run("intersect", (a, b), universe, a, b)
+
+
+def difference(a, b, universe=None):
+    """Ids of a that are not in b, in the order of a (see union for the parameters)."""
+    a, b = _as_ids(a), _as_ids(b)
+    return _run("difference", (a, b), universe, a, b)
+
+
+def intersect_count(a, b, universe=None):
+    """Size of the intersection of two arrays of distinct ids (see union for the parameters)."""
+    a, b = _as_ids(a), _as_ids(b)
+    return _run("intersect_count", (a, b), universe, a, b)
+
+
+def union_many(arrays, universe=None):
+    """Union of any number of arrays of distinct ids, as a sorted array (see union for the parameters)."""
+    arrays = [_as_ids(array) for array in arrays]
+    return _run("union_many", arrays, universe, arrays)
+
+
+class Complement:
+    """
+    Ids of range(universe) that are not in an exclusion set, e.g. the LCWA corruptions of a query (all entities
+    but its few known answers). Only the exclusion set is stored, so it costs O(|excluded|) instead of
+    O(universe); the ids are built on demand, in ascending order.
+
+    Supports len, membership (`in` and the vectorized contains), indexing by position (ints or int arrays, as
+    in the materialized array), iteration in chunks (iter_chunks) and conversion with to_array or np.asarray.
+    """
+
+    def __init__(self, universe, excluded):
+        """
+        :param universe: Number of possible ids
+        :param excluded: Ids left out, all below universe (duplicates and any order are fine)
+        """
+        self.universe = int(universe)
+        self.excluded = np.unique(_as_ids(excluded))
+        # Ids of the complement below every excluded id; the id at position p is p plus the number of
+        #   excluded ids whose gap is at most p
+        self._gaps = self.excluded - np.arange(len(self.excluded))
+
+    def __len__(self):
+        return self.universe - len(self.excluded)
+
+    def __contains__(self, e):
+        return bool(self.contains(np.array([e]))[0])
+
+    def contains(self, ids):
+        """
+        :param ids: Array of ids
+        :return: Boolean array, True for the ids in the complement
+        """
+        ids = _as_ids(ids)
+        positions = np.minimum(np.searchsorted(self.excluded, ids), max(len(self.excluded) - 1, 0))
+        excluded = self.excluded[positions] == ids if len(self.excluded) else np.zeros(len(ids), dtype=bool)
+        return (ids >= 0) & (ids < self.universe) & ~excluded
+
+    def __getitem__(self, positions):
+        scalar = np.ndim(positions) == 0
+        positions = np.asarray(positions, dtype=np.int64)
+        if np.any((positions < -len(self)) | (positions >= len(self))):
+            raise IndexError(f"position out of range for a complement of {len(self)} ids")
+        positions = np.where(positions < 0, positions + len(self), positions)
+        ids = positions + np.searchsorted(self._gaps, positions, "right")
+        return int(ids) if scalar else ids
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        :param chunk_size: Ids per chunk
+        :return: Generator of sorted int64 arrays of chunk_size ids (the last one may be shorter)
+        """
+        for start in range(0, len(self), chunk_size):
+            yield self[np.arange(start, min(start + chunk_size, len(self)))]
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk.tolist()
+
+    def to_array(self):
+        """:return: Sorted int64 array of the ids"""
+        mask = np.ones(self.universe, dtype=bool)
+        mask[self.excluded] = False
+        return np.flatnonzero(mask).astype(np.int64)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        return array if dtype is None else array.astype(dtype)
+
+
+def _get_machine():
+    return {"node": platform.node(), "processor": platform.processor(), "machine": platform.machine(),
+            "python": platform.python_version(), "numpy": np.__version__}
+
+
+def _time(function, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def _call(backend, operation, a, b, universe):
+    args = ([a, b, a[::2]],) if operation == "union_many" else (a, b)
+    function = _IMPLEMENTATIONS[backend][operation]
+    return (lambda: function(*args, universe)) if backend == "bitset" else (lambda: function(*args))
+
+
+def calibrate(sizes=(8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096),
+              densities=(0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3),
+              universe=1 << 18, repeats=20, seed=0, write=True):
+    """
+    Measures the crossover points of every operation on this machine and caches them in CALIBRATION_FILE.
+
+    hash_max_size is the largest operand size (in sizes) at which Python sets still beat sorted arrays.
+    bitset_min_density is the smallest density (total operand size / universe) at which a bitset beats
+    both other backends.
+
+    :param sizes: Operand sizes tried for the hash/sorted crossover
+    :param densities: Densities tried for the bitset crossover
+    :param universe: Number of possible ids in the bitset benchmark
+    :param repeats: Timed calls per measurement (the fastest counts)
+    :param seed: Seed of the random operands
+    :param write: Whether to write the calibration file
+    :return: Thresholds dictionary, as returned by get_thresholds
+    """
+    global _thresholds
+    rng = np.random.default_rng(seed)
+
+    def operands(size, id_count):
+        # Two operands sharing about half of their ids
+        ids = rng.permutation(id_count)[:size + size // 2]
+        return ids[:size], rng.permutation(ids[size // 2:])
+
+    thresholds = {"hash_max_size": {}, "bitset_min_density": {}}
+    for operation in OPERATIONS:
+        hash_max_size = 0
+        for size in sizes:
+            a, b = operands(size, size * 8)
+            if _time(_call("hash", operation, a, b, None), repeats) > _time(_call("sorted", operation, a, b, None),
+                                                                               repeats):
+                break
+            hash_max_size = 2 * size
+        thresholds["hash_max_size"][operation] = hash_max_size
+
+        bitset_min_density = 1.0
+        for density in sorted(densities, reverse=True):
+            a, b = operands(int(density * universe / 2), universe)
+            times = {backend: _time(_call(backend, operation, a, b, universe), max(repeats // 4, 3))
+                     for backend in BACKENDS}
+            if times["bitset"] > min(times["sorted"], times["hash"]):
+                break
+            bitset_min_density = density
+        thresholds["bitset_min_density"][operation] = bitset_min_density
+
+    if write:
+        pu.write_json_file(CALIBRATION_FILE, {"machine": _get_machine(), "thresholds": thresholds,
+                                              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")})
+    _thresholds = thresholds
+    return thresholds
+
+
+def main():
+    start_time = time.time()
+
+    thresholds = calibrate()
+    for operation in OPERATIONS:
+        print(f"\t{operation}: Python sets up to {thresholds['hash_max_size'][operation]} ids, "
+              f"bitset from a density of {thresholds['bitset_min_density'][operation]}")
+    print(f"\tCalibration written to {CALIBRATION_FILE}")
+
+    end_time(start_time)
+
+
+def end_time(start_time):
+    # Print the total execution time of the entire code
+    total_time = time.time() - start_time
+    time_taken = (f"\tTime Taken: "
+                  f"{total_time // 3600} Hours, "
+                  f"{(total_time % 3600) // 60} Minutes, "
+                  f"and {(total_time % 3600) % 60} seconds.")
+    print(time_taken)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class TripleIndex:
+    """
+    Membership index over known triples. Every (h, r, t) is packed into one int64 key,
+    (h * relation_count + r) * entity_count + t, and the keys are kept sorted, so millions of
+    candidate triples are checked at once with np.searchsorted instead of one set lookup each.
+    """
+
+    def __init__(self, heads, relations, tails, entity_count=None, relation_count=None):
+        """
+        :param heads: Array of head ids of the known triples
+        :param relations: Array of relation ids of the known triples
+        :param tails: Array of tail ids of the known triples
+        :param entity_count: Number of entity ids (default: largest id + 1)
+        :param relation_count: Number of relation ids (default: largest id + 1)
+        """
+        heads = np.asarray(heads, dtype=np.int64)
+        relations = np.asarray(relations, dtype=np.int64)
+        tails = np.asarray(tails, dtype=np.int64)
+
+        self.entity_count = int(entity_count if entity_count is not None
+                                else max(heads.max(initial=-1), tails.max(initial=-1)) + 1)
+        self.relation_count = int(relation_count if relation_count is not None else relations.max(initial=-1) + 1)
+
+        if self.entity_count ** 2 * max(self.relation_count, 1) >= 2 ** 63:
+            raise ValueError(f"{self.entity_count} entities and {self.relation_count} relations do not fit in int64 keys")
+
+        self.keys = np.unique(self.encode(heads, relations, tails))
+
+    @classmethod
+    def from_triples(cls, triples, entity_count=None, relation_count=None):
+        """
+        :param triples: Iterable of (h, r, t) tuples
+        :return: TripleIndex of the triples
+        """
+        array = np.array(list(triples), dtype=np.int64).reshape(-1, 3)
+        return cls(array[:, 0], array[:, 1], array[:, 2], entity_count, relation_count)
+
+    @classmethod
+    def from_manager(cls, manager):
+        """
+        Index of every triple known to a TripleManager, i.e. the triples of its main and secondary loaders.
+
+        :param manager: TripleManager
+        :return: TripleIndex of the known triples
+        """
+        heads, relations, tails = [], [], []
+        for r in manager.tail_dict:
+            for h, known_tails in manager.tail_dict[r].items():
+                known_tails = np.asarray(known_tails, dtype=np.int64)
+                heads.append(np.full(len(known_tails), h, dtype=np.int64))
+                relations.append(np.full(len(known_tails), r, dtype=np.int64))
+                tails.append(known_tails)
+
+        def concatenate(parts):
+            return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+        return cls(concatenate(heads), concatenate(relations), concatenate(tails),
+                   entity_count=max(len(manager.entities), int(manager.entities.max(initial=-1)) + 1))
+
+    def encode(self, heads, relations, tails):
+        """Packs triples into int64 keys."""
+        return ((np.asarray(heads, dtype=np.int64) * self.relation_count + np.asarray(relations, dtype=np.int64))
+                * self.entity_count + np.asarray(tails, dtype=np.int64))
+
+    def contains(self, heads, relations, tails):
+        """
+        Checks a batch of triples against the index. Scalars are broadcast, e.g. one (r, t) against many heads.
+
+        :param heads: Array (or scalar) of head ids
+        :param relations: Array (or scalar) of relation ids
+        :param tails: Array (or scalar) of tail ids
+        :return: Boolean NumPy array, True where the triple is known
+        """
+        keys = np.atleast_1d(self.encode(heads, relations, tails))
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[positions] == keys
+
+    def __len__(self):
+        return len(self.keys)
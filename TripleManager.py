@@ -1,18 +1,36 @@
 import numpy as np
 from collections import defaultdict
-from DataLoader import DataLoader
+from DataLoader import DataLoader, triples_to_array
 from CompatibleRelationsGenerator import CompatibleRelationsGenerator
+from CompatibilityClosure import CompatibilityClosure
+from RelationClusters import RelationClusters
 import DatasetUtils
+import Instrumentation
+import SetAlgebra
+import TripleStore
 import time
 
+# Entities each corruption mode draws from, by the position that is corrupted (LCWA draws from all entities).
+#   "<k>-hop sensical" and "<k>-hop nonsensical" draw like the sensical and nonsensical ones, through k
+#   compatibility links
+CANDIDATE_ELEMENTS = {
+    "sensical": {"head": "domain", "tail": "range"},
+    "nonsensical": {"head": "range", "tail": "domain"},
+    "one-hop sensical": {"head": "domain", "tail": "range"},
+    "one-hop nonsensical": {"head": "range", "tail": "domain"}
+}
+
 
 class TripleManager:
-    def __init__(self, main_loader, *secondary_loaders, compatible_threshold=0.75, similarity_method="overlap", alpha=0.5, beta=0.5):
+    def __init__(self, main_loader, *secondary_loaders, compatible_threshold=0.75, similarity_method="overlap", alpha=0.5, beta=0.5,
+                 compatibility_hops=1):
         """
         Initializes the TripleManager with a main data loader and optional secondary loaders.
 
         :param main_loader: The primary DataLoader instance
         :param secondary_loaders: Optional secondary DataLoader instances
+        :param compatibility_hops: k-hop compatibility precomputed up to this many links (the default only
+            has the one-hop links, more are computed when a "<k>-hop" mode first asks for them)
         """
         self.main_loader = main_loader
         self.secondary_loaders = secondary_loaders
@@ -23,34 +41,56 @@ class TripleManager:
         self.domain = defaultdict(set)
         self.range = defaultdict(set)
         self.entities = np.array(list(main_loader.entities))  # Convert to NumPy array for efficiency? Still testing
+        # Every entity id is below this, lets SetAlgebra use bitsets
+        self.universe = int(self.entities.max()) + 1 if len(self.entities) else 0
+        # Ids are dense from the loader, these give back the ids of the dataset files (for qrels and runs)
+        self.entity_ids = main_loader.entity_ids
+        self.relation_ids = main_loader.relation_ids
 
         # variables for compatibility stuff
         self.threshold = compatible_threshold
         self.similarity_method = similarity_method
 
-        # Unioning all structures
-        self._aggregate_structures()
-
-        # Convert sets to NumPy arrays for efficiency
-        self._convert_to_numpy()
-
-        # Generate compatible relations using existing dictionaries
-        generator = CompatibleRelationsGenerator(self.head_dict, self.tail_dict, self.domain, self.range)
-        # generator.generate() # This is for when we want to use the default values and save file
-        # This is where it takes the parameters for the compatible relations
-        # Parameters like Threshold and Method0
-        generator.compute_compatible_relations(threshold=compatible_threshold,
-                                               method=similarity_method,
-                                               alpha=alpha,
-                                               beta=beta)
-
-        self.dom_dom = generator.domDomCompatible
-        self.dom_ran = generator.domRanCompatible
-        self.ran_dom = generator.ranDomCompatible
-        self.ran_ran = generator.ranRanCompatible
-
-        # Get the pre-made compatible relations dictionaries
-        self.compatible_relations = self._build_compatible_relations()
+        # Out-of-core mode (set by the main loader), the union of the loaders is a TripleStore on disk
+        self.store = None
+
+        with Instrumentation.stage("aggregate"):
+            if main_loader.store is not None:
+                self._build_store()
+            else:
+                # Unioning all structures
+                self._aggregate_structures()
+
+                # Convert sets to NumPy arrays for efficiency
+                self._convert_to_numpy()
+
+        with Instrumentation.stage("compat"):
+            # Generate compatible relations using existing dictionaries
+            generator = CompatibleRelationsGenerator(self.head_dict, self.tail_dict, self.domain, self.range)
+            # generator.generate() # This is for when we want to use the default values and save file
+            # This is where it takes the parameters for the compatible relations
+            # Parameters like Threshold and Method0
+            generator.compute_compatible_relations(threshold=compatible_threshold,
+                                                   method=similarity_method,
+                                                   alpha=alpha,
+                                                   beta=beta)
+
+            self.dom_dom = generator.domDomCompatible
+            self.dom_ran = generator.domRanCompatible
+            self.ran_dom = generator.ranDomCompatible
+            self.ran_ran = generator.ranRanCompatible
+
+            # Get the pre-made compatible relations dictionaries
+            self.compatible_relations = self._build_compatible_relations()
+
+            # Transitive compatibility for the k-hop modes
+            self.compatibility_closure = CompatibilityClosure(self.compatible_relations, len(self.relation_ids))
+            self.compatibility_closure.reach(max(compatibility_hops, 1))
+
+            # One-hop and k-hop pools shared by the relations with the same entity sets,
+            #   cluster_of maps (hops, relation, elem_type) to its cluster
+            self.relation_clusters = RelationClusters(self._get_elements, self.universe)
+            self.cluster_of = {}
 
         # print(f"TM {main_loader.split_type} Created")
 
@@ -76,6 +116,30 @@ class TripleManager:
         # self.ran_dom = self.main_loader.ranDomCompatible
         # self.ran_ran = self.main_loader.ranRanCompatible
 
+    def _build_store(self):
+        """Out-of-core counterpart of _aggregate_structures and _convert_to_numpy, the union is built on disk."""
+        loaders = (self.main_loader, *self.secondary_loaders)
+        relation_count = max(len(loader.relation_ids) for loader in loaders)
+        self.store = TripleStore.TripleStore.build([loader.get_triples().array for loader in loaders],
+                                                   len(self.entity_ids), relation_count,
+                                                   self.main_loader.storage_folder, self.main_loader.memory_budget)
+
+        self.head_dict = self.store.head_dict
+        self.tail_dict = self.store.tail_dict
+        self.domain = self.store.domain
+        self.range = self.store.range
+
+    def close(self):
+        """
+        Out-of-core mode: removes the TripleStore of the union of the loaders from disk (the loaders keep
+        theirs, close them separately). Does nothing in memory.
+        """
+        if self.store is None:
+            return
+        self.head_dict, self.tail_dict, self.domain, self.range = {}, {}, {}, {}
+        self.store.close()
+        self.store = None
+
     def _convert_to_numpy(self):
         """Converts sets in dictionaries to NumPy arrays for optimized operations."""
         for r in self.head_dict:
@@ -143,13 +207,44 @@ class TripleManager:
 
         :param relation: Relation ID or name
         :param elem_type: 'domain' or 'range'
-        :return: Union of compatible elements (set)
+        :return: Union of compatible elements (sorted read-only array, shared through relation_clusters)
+        """
+        return self._get_cluster_elements(1, relation, elem_type)
+
+    def _get_k_hop_elements(self, relation, elem_type, hops):
+        """
+        Union of the elements of every (relation, side) reachable in at most `hops` compatibility links.
+
+        :param relation: Relation ID or name
+        :param elem_type: 'domain' or 'range'
+        :param hops: Number of compatibility links
+        :return: Sorted read-only array of entities, shared through relation_clusters
+        """
+        return self._get_cluster_elements(hops, relation, elem_type)
+
+    def _get_cluster_elements(self, hops, relation, elem_type):
+        """Pool of the cluster of (relation, elem_type) at hops compatibility links, assigned on first use."""
+        key = (hops, relation, elem_type)
+        if key not in self.cluster_of:
+            pairs = self.compatible_relations.get((relation, elem_type), []) if hops == 1 \
+                else self.compatibility_closure.reachable(relation, elem_type, hops)
+            self.cluster_of[key] = self.relation_clusters.cluster(pairs)
+        return self.relation_clusters.pool(self.cluster_of[key])
+
+    def build_relation_clusters(self, hops=1):
+        """
+        Assigns every (relation, side) to its cluster at the given number of compatibility links, and computes
+        the pool of every cluster once.
+
+        :param hops: Number of compatibility links
+        :return: Tuple (number of (relation, side) pairs, number of clusters)
         """
-        extended = set()
-        for (rel_prime, type_prime) in self.compatible_relations.get((relation, elem_type), []):
-            elems = self._get_elements(rel_prime, type_prime)
-            extended.update(elems)
-        return np.array(list(extended))
+        relations = sorted({r for r, _ in self.compatible_relations})
+        for r in relations:
+            for elem_type in ("domain", "range"):
+                self._get_cluster_elements(hops, r, elem_type)
+        return 2 * len(relations), len({self.cluster_of[(hops, r, side)] for r in relations
+                                         for side in ("domain", "range")})
 
     def get_corrupted_old(self, h, r, t, corruption_type='tail', corruption_mode='LCWA'):
         """
@@ -190,47 +285,140 @@ class TripleManager:
         else:
             raise ValueError("corruption_mode must be 'LCWA', 'sensical', or 'nonsensical'")
 
-    def get_corrupted(self, h, r, t, corruption_type='tail', corruption_mode='LCWA'):
+    def get_candidate_pool(self, r, corruption_type='tail', corruption_mode='LCWA'):
+        """
+        Entities a corruption mode draws from for a relation, before the known answers are removed. The pool only
+        depends on the relation, so code corrupting many triples of a relation can build it once.
+
+        :param r: Relation
+        :param corruption_type: Either 'head' or 'tail'
+        :param corruption_mode: 'LCWA', 'sensical', 'nonsensical', 'one-hop sensical', 'one-hop nonsensical',
+            or '<k>-hop sensical' / '<k>-hop nonsensical' for any k >= 1
+        :return: NumPy array of distinct entities
+        """
+        if corruption_type not in ("head", "tail"):
+            raise ValueError("corruption_type must be either 'head' or 'tail'")
+
         if corruption_mode == 'LCWA':
-            if corruption_type == 'tail':
-                return np.setdiff1d(self.entities, self.tail_dict[r].get(h, np.empty(0)), assume_unique=True)
-            elif corruption_type == 'head':
-                return np.setdiff1d(self.entities, self.head_dict[r].get(t, np.empty(0)), assume_unique=True)
+            return self.entities
 
-        elif corruption_mode == 'sensical':
-            if corruption_type == 'tail':
-                extended_range = self._get_elements(r, "range")
-                return np.setdiff1d(extended_range, self.tail_dict[r].get(h, np.array([])), assume_unique=True)
-            elif corruption_type == 'head':
-                extended_domain = self._get_elements(r, 'domain')
-                return np.setdiff1d(extended_domain, self.head_dict[r].get(t, np.array([])), assume_unique=True)
+        hops, base_mode = split_corruption_mode(corruption_mode)
+        elem_type = CANDIDATE_ELEMENTS[base_mode][corruption_type]
+        if hops == 1:
+            return self._get_extended_elements(r, elem_type)
+        if hops > 1:
+            return self._get_k_hop_elements(r, elem_type, hops)
+        return self._get_elements(r, elem_type)
 
-        elif corruption_mode == 'nonsensical':
-            if corruption_type == 'tail':
-                extended_domain = self._get_elements(r, 'domain')
-                return np.setdiff1d(extended_domain, self.tail_dict[r].get(h, np.array([])), assume_unique=True)
-            elif corruption_type == 'head':
-                extended_range = self._get_elements(r, 'range')
-                return np.setdiff1d(extended_range, self.head_dict[r].get(t, np.array([])), assume_unique=True)
+    def get_known(self, h, r, t, corruption_type='tail'):
+        """
+        Known answers of a query, i.e. the entities that are never negatives: the tails of (h, r, ?) or the heads
+        of (?, r, t) in all loaders.
 
-        elif corruption_mode == 'one-hop sensical':
-            if corruption_type == 'tail':
-                extended_range = self._get_extended_elements(r, 'range')
-                return np.setdiff1d(extended_range, self.tail_dict[r].get(h, np.array([])), assume_unique=True)
-            elif corruption_type == 'head':
-                extended_domain = self._get_extended_elements(r, 'domain')
-                return np.setdiff1d(extended_domain, self.head_dict[r].get(t, np.array([])), assume_unique=True)
+        :return: NumPy array of entities
+        """
+        if corruption_type == 'tail':
+            return self.tail_dict[r].get(h, np.empty(0))
+        elif corruption_type == 'head':
+            return self.head_dict[r].get(t, np.empty(0))
+        raise ValueError("corruption_type must be either 'head' or 'tail'")
 
-        elif corruption_mode == 'one-hop nonsensical':
-            if corruption_type == 'tail':
-                extended_domain = self._get_extended_elements(r, 'domain')
-                return np.setdiff1d(extended_domain, self.tail_dict[r].get(h, np.array([])), assume_unique=True)
-            elif corruption_type == 'head':
-                extended_range = self._get_extended_elements(r, 'range')
-                return np.setdiff1d(extended_range, self.head_dict[r].get(t, np.array([])), assume_unique=True)
+    def get_corrupted(self, h, r, t, corruption_type='tail', corruption_mode='LCWA', lazy=False):
+        """
+        Corrupts a given triple using the specified corruption mode: the candidate pool of the mode minus the
+        known answers of the query.
 
-        else:
-            raise ValueError("Unsupported corruption_mode: {}".format(corruption_mode))
+        :param h: Head entity
+        :param r: Relation
+        :param t: Tail entity
+        :param corruption_type: Either 'head' or 'tail'
+        :param corruption_mode: 'LCWA', 'sensical', 'nonsensical', 'one-hop sensical', 'one-hop nonsensical'
+            or a '<k>-hop' mode (see get_candidate_pool)
+        :param lazy: Return LCWA corruptions as a SetAlgebra.Complement of the known answers instead of an array
+            of nearly all entities (other modes always return arrays)
+        :return: A NumPy array of corrupted entities, or a SetAlgebra.Complement
+        """
+        if lazy and corruption_mode == 'LCWA':
+            if corruption_type not in ("head", "tail"):
+                raise ValueError("corruption_type must be either 'head' or 'tail'")
+            # Entity ids are dense, all entities are range(universe)
+            return SetAlgebra.Complement(self.universe, self.get_known(h, r, t, corruption_type))
+        pool = self.get_candidate_pool(r, corruption_type, corruption_mode)
+        return SetAlgebra.difference(pool, self.get_known(h, r, t, corruption_type), self.universe)
+
+    def iter_corrupted(self, h, r, t, corruption_type='tail', corruption_mode='LCWA', chunk_size=SetAlgebra.CHUNK_SIZE):
+        """
+        The entities of get_corrupted in ascending order, chunk by chunk. Every chunk is a slice of the sorted
+        candidate pool minus the known answers in its range (LCWA chunks come from a SetAlgebra.Complement), so
+        a query only holds one chunk of corruptions at a time besides its pool and known answers.
+
+        :param h: Head entity
+        :param r: Relation
+        :param t: Tail entity
+        :param corruption_type: Either 'head' or 'tail'
+        :param corruption_mode: 'LCWA', 'sensical', 'nonsensical', 'one-hop sensical', 'one-hop nonsensical'
+            or a '<k>-hop' mode (see get_candidate_pool)
+        :param chunk_size: Maximum number of entities per chunk
+        :return: Generator of sorted, non-empty int64 arrays of corrupted entities
+        """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+
+        known = np.unique(np.asarray(self.get_known(h, r, t, corruption_type), dtype=np.int64))
+        if corruption_mode == 'LCWA':
+            return SetAlgebra.Complement(self.universe, known).iter_chunks(chunk_size)
+
+        pool = np.asarray(self.get_candidate_pool(r, corruption_type, corruption_mode), dtype=np.int64)
+        # One-hop and out-of-core pools are already sorted, in-memory domains and ranges come from sets
+        if np.any(pool[1:] < pool[:-1]):
+            pool = np.sort(pool)
+        return _iter_difference(pool, known, chunk_size)
+
+    def count_corrupted(self, h, r, t, corruption_type='tail', corruption_mode='LCWA'):
+        """
+        Number of entities get_corrupted would return (|candidates| - |known answers among them|), without building
+        the array.
+
+        :return: int
+        """
+        known = self.get_known(h, r, t, corruption_type)
+        if corruption_mode == 'LCWA':
+            # Every known answer is an entity
+            return len(self.entities) - len(known)
+        pool = self.get_candidate_pool(r, corruption_type, corruption_mode)
+        return len(pool) - SetAlgebra.intersect_count(pool, known, self.universe)
+
+    def corruption_counts(self, corruption_modes=("LCWA", "sensical", "nonsensical", "one-hop sensical",
+                                                  "one-hop nonsensical"), triples=None):
+        """
+        count_corrupted for every triple, mode and direction. Pools are built once per relation and known answers
+        looked up once per anchor entity, so this is much cheaper than calling count_corrupted per triple.
+
+        :param corruption_modes: Corruption modes to count
+        :param triples: (n, 3) array or iterable of (h, r, t) (default: get_triples())
+        :return: Dictionary {(mode, 'head'/'tail'): int64 array with the count of every triple}
+        """
+        triples = triples_to_array(self.get_triples() if triples is None else triples)
+        counts = {(mode, direction): np.zeros(len(triples), dtype=np.int64)
+                  for mode in corruption_modes for direction in ("head", "tail")}
+
+        for r in np.unique(triples[:, 1]).tolist():
+            in_relation = np.flatnonzero(triples[:, 1] == r)
+            for direction, anchor_column in (("head", 2), ("tail", 0)):
+                anchors, first, inverse = np.unique(triples[in_relation, anchor_column], return_index=True,
+                                                    return_inverse=True)
+                known = [self.get_known(*triples[in_relation[j]].tolist(), direction) for j in first.tolist()]
+
+                for mode in corruption_modes:
+                    if mode == 'LCWA':
+                        anchor_counts = len(self.entities) - np.array([len(k) for k in known], dtype=np.int64)
+                    else:
+                        pool = self.get_candidate_pool(r, direction, mode)
+                        anchor_counts = len(pool) - np.array([SetAlgebra.intersect_count(pool, k, self.universe)
+                                                              for k in known], dtype=np.int64)
+                    counts[(mode, direction)][in_relation] = anchor_counts[inverse.reshape(-1)]
+
+        return counts
 
     # def get_corrupted_new_old(self, h, r, t, corruption_type='tail'):
     #     """
@@ -259,6 +447,50 @@ class TripleManager:
     #     return corrupted
 
 
+class SampledManager:
+    """
+    TripleManager view whose get_triples returns a fixed sample, everything else is delegated. Used to time or
+    estimate the qrels of a few triples (Benchmark, QrelsEstimator).
+    """
+
+    def __init__(self, manager, triples):
+        self._manager = manager
+        self._triples = triples
+
+    def get_triples(self):
+        return self._triples
+
+    def __getattr__(self, name):
+        return getattr(self._manager, name)
+
+
+def split_corruption_mode(corruption_mode):
+    """
+    :param corruption_mode: 'sensical' or 'nonsensical', optionally prefixed by 'one-hop ' or '<k>-hop '
+    :return: Tuple (number of compatibility links, 'sensical' or 'nonsensical'), 0 links for the direct modes
+    """
+    prefix, _, base_mode = corruption_mode.rpartition(" ")
+    hops = prefix[:-len("-hop")]
+    if base_mode in ("sensical", "nonsensical"):
+        if not prefix:
+            return 0, base_mode
+        if prefix == "one-hop":
+            return 1, base_mode
+        if prefix.endswith("-hop") and hops.isdigit() and int(hops) >= 1:
+            return int(hops), base_mode
+    raise ValueError("Unsupported corruption_mode: {}".format(corruption_mode))
+
+
+def _iter_difference(pool, known, chunk_size):
+    # pool and known are sorted, a window of the pool only meets the known answers between its first and last id
+    for start in range(0, len(pool), chunk_size):
+        window = pool[start:start + chunk_size]
+        low, high = np.searchsorted(known, window[0], "left"), np.searchsorted(known, window[-1], "right")
+        chunk = SetAlgebra.difference(window, known[low:high]) if high > low else window
+        if len(chunk):
+            yield chunk
+
+
 def end_time(start_time):
     # Print the total execution time of the entire code
     total_time = time.time() - start_time
@@ -0,0 +1,246 @@
+import os
+import shutil
+import tempfile
+import traceback
+import weakref
+from collections.abc import Mapping
+import numpy as np
+
+# Default working memory of the out-of-core mode, in bytes
+MEMORY_BUDGET = 1 << 30
+
+# Working memory per triple while a group of relations is sorted (the triples, the int64 keys, the sort and
+# the two pair arrays written out)
+BYTES_PER_TRIPLE = 64
+
+
+class TripleStore:
+    """
+    Out-of-core adjacency of a set of triples, for graphs (BioKG, Hetionet) whose dictionaries of sets do not
+    fit in memory. Everything lives in memory-mapped files in its own folder:
+
+    - triples: (n, 3) int32 array (h, r, t) grouped by relation, in input order within a relation
+    - by_head: distinct (h, t) pairs of every relation, sorted by head then tail
+    - by_tail: distinct (t, h) pairs of every relation, sorted by tail then head
+
+    head_dict, tail_dict, domain and range are read-only mappings over these arrays with the interface of the
+    in-memory dictionaries ({r: {t: heads}}, {r: {h: tails}}, {r: heads}, {r: tails}); a lookup only pages in
+    the slice of its relation. Building streams the input in chunks and sorts relations in groups that fit
+    the memory budget, so the working memory is bounded by the budget (or by the largest relation, which is
+    always sorted as a whole).
+    """
+
+    def __init__(self, folder, entity_count, triple_offsets, pair_offsets):
+        """
+        Opens the arrays written by build. Use build to create a store.
+
+        :param folder: Folder of the store, removed by close (or when the store is garbage collected)
+        :param entity_count: Number of entities
+        :param triple_offsets: Start of every relation in triples, plus the total (relation_count + 1 values)
+        :param pair_offsets: Start of every relation in by_head/by_tail, plus the total
+        """
+        self.folder = folder
+        self.entity_count = entity_count
+        self.triple_offsets = triple_offsets
+        self.pair_offsets = pair_offsets
+
+        self.triples = _open(os.path.join(folder, "triples.bin"), 3)
+        self.by_head = _open(os.path.join(folder, "by_head.bin"), 2)
+        self.by_tail = _open(os.path.join(folder, "by_tail.bin"), 2)
+
+        self.head_dict = _Adjacency(self.by_tail, pair_offsets)
+        self.tail_dict = _Adjacency(self.by_head, pair_offsets)
+        self.domain = _Distinct(self.by_head, pair_offsets)
+        self.range = _Distinct(self.by_tail, pair_offsets)
+
+        # Fallback for stores that are never closed; on Windows it only succeeds once nothing maps the files
+        self._finalizer = weakref.finalize(self, _remove_folder, folder)
+
+    @classmethod
+    def build(cls, triple_arrays, entity_count, relation_count, parent_folder=None, memory_budget=MEMORY_BUDGET):
+        """
+        :param triple_arrays: List of (n, 3) int arrays (h, r, t) with dense ids, e.g. memory-mapped splits
+        :param entity_count: Number of entities, every entity id is below it
+        :param relation_count: Number of relations, every relation id is below it
+        :param parent_folder: Folder the store folder is created in (default: the system temporary folder)
+        :param memory_budget: Working memory in bytes
+        :return: TripleStore of the distinct triples of all arrays
+        """
+        if (entity_count ** 2) * max(relation_count, 1) >= 2 ** 63:
+            raise ValueError(f"{entity_count} entities and {relation_count} relations do not fit in int64 keys")
+
+        chunk_rows = max(1, memory_budget // BYTES_PER_TRIPLE)
+        folder = tempfile.mkdtemp(prefix="triple_store_", dir=parent_folder)
+        try:
+            triple_offsets, pair_counts = cls._write(triple_arrays, entity_count, relation_count, folder, chunk_rows)
+        except BaseException as e:
+            # The traceback keeps the frames alive, drop their maps so the files can be removed
+            traceback.clear_frames(e.__traceback__)
+            triple_arrays = None
+            _remove_folder(folder)
+            raise
+
+        return cls(folder, entity_count, triple_offsets, np.concatenate(([0], np.cumsum(pair_counts))))
+
+    @staticmethod
+    def _write(triple_arrays, entity_count, relation_count, folder, chunk_rows):
+        """Writes the arrays of a store to its folder, returns (triple_offsets, pair count of every relation)."""
+        # Counting sort by relation: count, then scatter every chunk to the slices of its relations
+        counts = np.zeros(relation_count, dtype=np.int64)
+        for triples in triple_arrays:
+            for start in range(0, len(triples), chunk_rows):
+                counts += np.bincount(triples[start:start + chunk_rows, 1], minlength=relation_count)
+        triple_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        grouped = _create(os.path.join(folder, "triples.bin"), (int(triple_offsets[-1]), 3))
+        positions = triple_offsets[:-1].copy()
+        for triples in triple_arrays:
+            for start in range(0, len(triples), chunk_rows):
+                chunk = np.asarray(triples[start:start + chunk_rows], dtype=np.int32)
+                chunk = chunk[np.argsort(chunk[:, 1], kind="stable")]
+                relations, starts = np.unique(chunk[:, 1], return_index=True)
+                for r, begin, end in zip(relations.tolist(), starts.tolist(), [*starts[1:].tolist(), len(chunk)]):
+                    grouped[positions[r]:positions[r] + end - begin] = chunk[begin:end]
+                    positions[r] += end - begin
+        grouped.flush()
+
+        # Consecutive relations form one contiguous slice, sorted together while they fit the budget
+        pair_counts = np.zeros(relation_count, dtype=np.int64)
+        with open(os.path.join(folder, "by_head.bin"), "wb") as by_head, \
+                open(os.path.join(folder, "by_tail.bin"), "wb") as by_tail:
+            first = 0
+            while first < relation_count:
+                last = first + 1
+                while last < relation_count and triple_offsets[last + 1] - triple_offsets[first] <= chunk_rows:
+                    last += 1
+
+                group = np.asarray(grouped[triple_offsets[first]:triple_offsets[last]], dtype=np.int64)
+                h, r, t = group[:, 0], group[:, 1], group[:, 2]
+
+                keys = np.unique((r * entity_count + h) * entity_count + t)
+                pairs = np.column_stack(((keys // entity_count) % entity_count, keys % entity_count))
+                by_head.write(pairs.astype(np.int32).tobytes())
+                pair_counts += np.bincount(keys // (entity_count * entity_count), minlength=relation_count)
+
+                keys = np.unique((r * entity_count + t) * entity_count + h)
+                pairs = np.column_stack(((keys // entity_count) % entity_count, keys % entity_count))
+                by_tail.write(pairs.astype(np.int32).tobytes())
+
+                first = last
+        del grouped
+
+        return triple_offsets, pair_counts
+
+    def __len__(self):
+        return len(self.triples)
+
+    def close(self):
+        """
+        Unmaps the arrays and removes the folder of the store. Windows cannot remove mapped files, so the
+        mappings handed out (head_dict, tail_dict, domain, range) are emptied too; triples still referenced
+        elsewhere (e.g. a DataLoader's TripleArray) must be dropped before. Closing twice does nothing.
+        """
+        empty_triples, empty_pairs = np.zeros((0, 3), dtype=np.int32), np.zeros((0, 2), dtype=np.int32)
+        self.triples, self.by_head, self.by_tail = empty_triples, empty_pairs, empty_pairs
+        for mapping in (self.head_dict, self.tail_dict, self.domain, self.range):
+            mapping.release()
+        self._finalizer()
+
+
+def _remove_folder(folder):
+    try:
+        shutil.rmtree(folder)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"\tWarning: could not remove the triple store {folder}: {e}")
+
+
+def _create(file_path, shape):
+    if shape[0] == 0:
+        open(file_path, "wb").close()
+        return np.zeros(shape, dtype=np.int32)
+    return np.memmap(file_path, dtype=np.int32, mode="w+", shape=shape)
+
+
+def _open(file_path, columns):
+    if os.path.getsize(file_path) == 0:
+        return np.zeros((0, columns), dtype=np.int32)
+    return np.memmap(file_path, dtype=np.int32, mode="r").reshape(-1, columns)
+
+
+def _run_starts(keys):
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else np.zeros(0, dtype=np.int64)
+
+
+class _Adjacency(Mapping):
+    """{r: {key: values}} over pairs (key, value) sorted within every relation, e.g. {r: {h: tails}}."""
+
+    def __init__(self, pairs, offsets):
+        self.pairs = pairs
+        self.offsets = offsets
+
+    def release(self):
+        # Drops the memory map, the mapping is empty afterwards
+        self.pairs, self.offsets = np.zeros((0, 2), dtype=np.int32), np.zeros(1, dtype=np.int64)
+
+    def __getitem__(self, r):
+        if not 0 <= r < len(self.offsets) - 1 or self.offsets[r] == self.offsets[r + 1]:
+            raise KeyError(r)
+        return _RelationAdjacency(self.pairs[self.offsets[r]:self.offsets[r + 1]])
+
+    def __iter__(self):
+        return iter(np.flatnonzero(np.diff(self.offsets)).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.offsets)))
+
+
+class _RelationAdjacency(Mapping):
+    """{key: values} of one relation, values are int64 arrays in ascending order."""
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def __getitem__(self, key):
+        keys = self.pairs[:, 0]
+        low, high = np.searchsorted(keys, key, "left"), np.searchsorted(keys, key, "right")
+        if low == high:
+            raise KeyError(key)
+        return np.array(self.pairs[low:high, 1], dtype=np.int64)
+
+    def __iter__(self):
+        keys = np.asarray(self.pairs[:, 0])
+        return iter(keys[_run_starts(keys)].tolist())
+
+    def __len__(self):
+        return len(_run_starts(np.asarray(self.pairs[:, 0])))
+
+
+class _Distinct(Mapping):
+    """{r: distinct keys} of pairs sorted within every relation, e.g. the domain from the (h, t) pairs."""
+
+    def __init__(self, pairs, offsets):
+        self.pairs = pairs
+        self.offsets = offsets
+        # Lookups come relation by relation, only the last one is kept
+        self._last = (None, None)
+
+    def release(self):
+        # Drops the memory map, the mapping is empty afterwards
+        self.pairs, self.offsets = np.zeros((0, 2), dtype=np.int32), np.zeros(1, dtype=np.int64)
+        self._last = (None, None)
+
+    def __getitem__(self, r):
+        if not 0 <= r < len(self.offsets) - 1 or self.offsets[r] == self.offsets[r + 1]:
+            raise KeyError(r)
+        if self._last[0] != r:
+            keys = np.asarray(self.pairs[self.offsets[r]:self.offsets[r + 1], 0], dtype=np.int64)
+            self._last = (r, keys[_run_starts(keys)])
+        return self._last[1]
+
+    def __iter__(self):
+        return iter(np.flatnonzero(np.diff(self.offsets)).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.offsets)))
@@ -0,0 +1,160 @@
+import contextlib
+import io
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import psutil
+except ImportError:  # Optional, only used to read the available memory
+    psutil = None
+
+GB = 1024 ** 3
+
+
+def get_available_memory():
+    """
+    Memory currently available to new processes, in bytes.
+
+    Uses psutil when installed, otherwise sysconf on POSIX systems.
+
+    :return: Available memory in bytes, or None if it cannot be determined
+    """
+    if psutil is not None:
+        return psutil.virtual_memory().available
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_worker_count(max_workers=None, memory_per_worker_gb=None):
+    """
+    Number of worker processes to start, limited by the cores and the available memory.
+
+    :param max_workers: Upper bound on the workers (None means one per core)
+    :param memory_per_worker_gb: Peak memory of one unit in GB (None disables the memory limit)
+    :return: Number of workers, at least 1
+    """
+    workers = max_workers or os.cpu_count() or 1
+    workers = min(workers, os.cpu_count() or workers)
+
+    available = get_available_memory()
+    if memory_per_worker_gb and available is not None:
+        workers = min(workers, int(available // (memory_per_worker_gb * GB)))
+
+    return max(workers, 1)
+
+
+def run_captured(run_unit, args):
+    """
+    Runs one unit with its output (stdout and stderr) captured, so logs of concurrent units do not interleave.
+
+    :param run_unit: Function to run
+    :param args: Tuple of arguments of the function
+    :return: Tuple (succeeded, captured output, seconds taken)
+    """
+    start_time = time.time()
+    log = io.StringIO()
+
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            run_unit(*args)
+            succeeded = True
+        except Exception:
+            traceback.print_exc(file=log)
+            succeeded = False
+
+    return succeeded, log.getvalue(), time.time() - start_time
+
+
+def run_units(units, run_unit, workers=1, memory_per_worker_gb=None, initializer=None, initargs=(), label=str):
+    """
+    Runs every unit across a process pool and prints the log of each unit in one block
+    once it finishes.
+
+    At most `workers` units run at once. When a memory estimate is given, a new unit is only
+    started while at least that much memory is available (or when nothing else is running).
+    With a single worker the units run in this process, one after another, and their output is printed as it
+    comes instead of being captured.
+
+    A worker that dies (e.g. killed by the OOM killer) breaks the whole pool: the units running in it at the time fail
+    with the error, and the units not started yet continue in a new pool.
+
+    :param units: List of argument tuples, one per unit
+    :param run_unit: Top-level (picklable) function run on every unit
+    :param workers: Number of worker processes
+    :param memory_per_worker_gb: Peak memory of one unit in GB (None disables the memory limit)
+    :param initializer: Function run once in every worker, e.g. to load data shared by all units
+    :param initargs: Arguments of the initializer
+    :param label: Function giving the name of a unit for the logs
+    :return: List of the labels of the units that failed
+    """
+    failed = []
+
+    def report(unit, result):
+        succeeded, log, seconds = result
+        status = "Done" if succeeded else "FAILED"
+        # Sequential units printed their output already, only the status line is left
+        print(f"\t[{status}] {label(unit)} ({seconds:.1f}s)" + (f"\n{log}" if log else ""),
+              end="" if log.endswith("\n") else "\n", flush=True)
+        if not succeeded:
+            failed.append(label(unit))
+
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for unit in units:
+            start_time = time.time()
+            try:
+                run_unit(*unit)
+                result = (True, "", time.time() - start_time)
+            except Exception:
+                result = (False, traceback.format_exc(), time.time() - start_time)
+            report(unit, result)
+        return failed
+
+    pending = list(units)
+
+    while pending:
+        running = {}
+        broken = False
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            while (pending and not broken) or running:
+
+                # Fill the free slots while the memory allows another unit
+                while pending and not broken and len(running) < workers:
+                    available = get_available_memory()
+                    if (running and memory_per_worker_gb and available is not None
+                            and available < memory_per_worker_gb * GB):
+                        break
+
+                    unit = pending.pop(0)
+                    try:
+                        running[executor.submit(run_captured, run_unit, unit)] = (unit, time.time())
+                    except BrokenProcessPool as e:
+                        report(unit, (False, f"{type(e).__name__}: {e}\n", 0.0))
+                        broken = True
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    unit, start_time = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # The worker died instead of the unit raising, run_captured could not catch it
+                        result = (False, f"{type(e).__name__}: {e}\n", time.time() - start_time)
+                        broken = broken or isinstance(e, BrokenProcessPool)
+                    report(unit, result)
+
+        if broken and pending:
+            print(f"\tA worker died, restarting the pool for the {len(pending)} remaining units", flush=True)
+
+    return failed
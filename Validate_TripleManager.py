@@ -1,20 +1,32 @@
 import numpy as np
-import random
 from TripleManager import TripleManager
+from TripleIndex import TripleIndex
 from DataLoader import DataLoader
 import DatasetUtils
 import time
 import sys
 
 managers = ["train_manager", "valid_manager", "test_manager"]
+CORRUPTION_MODES = ["LCWA", "sensical", "nonsensical", "one-hop sensical", "one-hop nonsensical"]
 
 
-def validate_negatives(dataset_path, sample_size=float('inf'), negative_sample_size=float('inf')):
+def validate_negatives(dataset_path, sample_size=float('inf'), negative_sample_size=float('inf'),
+                       corruption_modes=CORRUPTION_MODES, chunk_size=5_000_000, max_examples=10, seed=0):
     """
     Validates the negatives generated by TripleManager by checking if they exist in the dataset.
+
+    The known triples of every manager (its main and secondary splits) are packed into a TripleIndex, and
+    the negatives are checked against it in chunks of millions at once. Violations are counted and reported
+    per manager and corruption mode instead of stopping at the first one.
+
     :param dataset_path: Path to the sample dataset.
     :param sample_size: Number of positive triples to check.
     :param negative_sample_size: Number of negatives to verify per triple.
+    :param corruption_modes: Corruption modes to validate.
+    :param chunk_size: Number of negatives checked at once.
+    :param max_examples: Number of violating negatives kept per manager and mode.
+    :param seed: Seed of the sampling of positives and negatives.
+    :return: Dictionary {manager: {mode: {"checked": ..., "violations": ..., "examples": [...]}}}
     """
     # Load the dataset
     train_loader = DataLoader(dataset_path, "train")
@@ -25,41 +37,64 @@ def validate_negatives(dataset_path, sample_size=float('inf'), negative_sample_s
     valid_manager = TripleManager(val_loader, train_loader)
     test_manager = TripleManager(test_loader, val_loader, train_loader)
 
-    for manager in [train_manager, valid_manager, test_manager]:
-        print(f"\tTesting TripleManager with", len(manager.get_triples()), "triples")
-        # manager = TripleManager(train_loader)
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    for i, manager in enumerate([train_manager, valid_manager, test_manager]):
+        print(f"\tTesting TripleManager {managers[i]} with", len(manager.get_triples()), "triples")
+        results[managers[i]] = {}
 
-        # Convert triples to a set for quick lookup
-        positive_triples = set(manager.get_triples())
-        print(f"Positive triples: {positive_triples}")
+        index = TripleIndex.from_manager(manager)
 
         # Randomly sample some triples to check
-        sample_triples = random.sample(manager.get_triples(), min(sample_size, len(manager.get_triples())))
-
-        for h, r, t in sample_triples:
-            print(f"Positive triple: ({h}, {r}, {t})")
-            corrupted_heads = manager.get_corrupted(h, r, t, 'head')
-            corrupted_tails = manager.get_corrupted(h, r, t, 'tail')
-
-            # Pick a random subset of negatives to check
-            heads_to_check = random.sample(list(corrupted_heads), min(negative_sample_size, len(corrupted_heads)))
-            tails_to_check = random.sample(list(corrupted_tails), min(negative_sample_size, len(corrupted_tails)))
-
-            print(f"New Corrupted Heads: {list(heads_to_check)[:5]}")
-            for h_neg in heads_to_check:
-                print(f"Checking ({h_neg}, {r}, {t})")
-                if (h_neg, r, t) in positive_triples:
-                    print(f"ERROR: Corrupted head ({h_neg}, {r}, {t}) is actually a positive triple!")
-                    sys.exit()
-
-            print(f"New Corrupted Tails: {list(tails_to_check)[:5]}")
-            for t_neg in tails_to_check:
-                print(f"Checking ({h}, {r}, {t_neg})")
-                if (h, r, t_neg) in positive_triples:
-                    print(f"ERROR: Corrupted tail ({h}, {r}, {t_neg}) is actually a positive triple!")
-                    sys.exit()
+        triples = manager.get_triples()
+        sample_triples = [triples[j] for j in rng.permutation(len(triples))[:min(sample_size, len(triples))]]
+
+        for mode in corruption_modes:
+            result = {"checked": 0, "violations": 0, "examples": []}
+            heads, relations, tails, pending = [], [], [], 0
+
+            def check():
+                h_array, r_array, t_array = np.concatenate(heads), np.concatenate(relations), np.concatenate(tails)
+                known = index.contains(h_array, r_array, t_array)
+                result["checked"] += len(known)
+                result["violations"] += int(known.sum())
+                for j in np.flatnonzero(known)[:max_examples - len(result["examples"])]:
+                    result["examples"].append((int(h_array[j]), int(r_array[j]), int(t_array[j])))
+                heads.clear(), relations.clear(), tails.clear()
+
+            for h, r, t in sample_triples:
+                for corruption_type in ['head', 'tail']:
+                    count = manager.count_corrupted(h, r, t, corruption_type, mode)
+                    if count > negative_sample_size:
+                        # Pick a random subset of negatives to check, LCWA negatives stay a complement view until then
+                        corrupted = manager.get_corrupted(h, r, t, corruption_type, mode, lazy=True)
+                        chunks = [np.asarray(corrupted[rng.choice(count, int(negative_sample_size), replace=False)],
+                                             dtype=np.int64)]
+                    else:
+                        # All of them, streamed so a query never holds more than a chunk of negatives
+                        chunks = manager.iter_corrupted(h, r, t, corruption_type, mode, chunk_size)
+
+                    for corrupted in chunks:
+                        heads.append(corrupted if corruption_type == 'head' else np.full(len(corrupted), h))
+                        relations.append(np.full(len(corrupted), r))
+                        tails.append(corrupted if corruption_type == 'tail' else np.full(len(corrupted), t))
+                        pending += len(corrupted)
+
+                        if pending >= chunk_size:
+                            check()
+                            pending = 0
+
+            if heads:
+                check()
+
+            status = "OK" if result["violations"] == 0 else "ERROR"
+            print(f"\t\t[{status}] {mode}: {result['violations']} of {result['checked']} negatives are positive "
+                  f"triples" + (f", e.g. {result['examples']}" if result["examples"] else ""))
+            results[managers[i]][mode] = result
 
     print("Validation complete.")
+    return results
 
 
 def benchmark_corruption_modes(dataset_path, sample_size=1000):
@@ -5,17 +5,62 @@ from TripleManager import TripleManager
 import GenerateQrels
 import IrMeasure
 import DatasetUtils
+import UnitScheduler
+import QrelsEstimator
+import Instrumentation
 import PathUtils as pu
 import os
 import glob
+import multiprocessing.util
 import re
 
 # Write Qrels to file?
 WRITE_QREL_TO_FILE = False
 
+# Generate the qrels relation by relation? Same qrels, but every relation's candidate sets are built once
+QRELS_BY_RELATION = True
+
+# Threads generating the qrels of different relations in parallel (with QRELS_BY_RELATION)
+QRELS_WORKERS = 1
+
+# Print the predicted qrel rows, memory and time of every unit before generating its qrels (see QrelsEstimator.py)?
+ESTIMATE_QRELS = False
+
 # Write ir-measure jsons to files?
 WRITE_JSON_TO_FILE = False
 
+# Skip (reshuffle, config) units whose results are already in the json files? Needs WRITE_JSON_TO_FILE
+RESUME_FINISHED_UNITS = True
+
+# Truncate runs to the largest evaluated cutoff while reading them? AP, RR and Bpref stay exact
+TRUNCATE_RUNS_TO_MAX_CUTOFF = False
+
+# Keep per-query metric matrices? Adds bootstrap confidence intervals and paired tests between models
+KEEP_PER_QUERY_METRICS = False
+
+# Also write every metric to the single SQLite store used for cross-reshuffle summaries?
+WRITE_RESULTS_TO_STORE = False
+
+# Record wall/CPU time and RSS of every stage (load, aggregate, compat, qrels, eval) of each unit?
+# Always printed, and written as *_profile.json next to the IR results json when WRITE_JSON_TO_FILE is on
+PROFILE_STAGES = True
+
+# Also record the Python allocations of every stage with tracemalloc? Noticeably slower
+TRACE_ALLOCATIONS = False
+
+# Worker processes running (reshuffle, config) units in parallel. None means one per core, 1 runs sequentially
+MAX_WORKERS = None
+
+# Rough peak memory of one unit in GB. Fewer workers are started, and new units wait, when memory is short
+MEMORY_PER_WORKER_GB = 4
+
+# Folder for the memory-mapped files of the out-of-core mode (see TripleStore.py), for graphs like BioKG and
+# Hetionet whose dictionaries do not fit in memory. None keeps every split in memory
+OUT_OF_CORE_FOLDER = None
+
+# Working memory in GB of the out-of-core mode while a split or a manager is indexed
+OUT_OF_CORE_MEMORY_GB = 1
+
 # Datasets to run it on. Check the DatasetUtils.py file to see all the dataset names and
 # confirm whether all these datasets do exist in the reshuffle folder below and in the run scores folder
 datasets = [3]
@@ -35,6 +80,9 @@ qrel_output_folder = main_folder + f"Generated_Qrels_TSV\\"
 # Folder where the json outputs will be stored if things are printed to files
 json_output_folder = main_folder + f"IR_Measures\\"
 
+# SQLite store with the results of every dataset, reshuffle and config
+results_store_path = json_output_folder + "IR_results.sqlite"
+
 # Check if the base folder for the reshuffled datasets exists - needs to exist
 if not pu.check_folder_existence(reshuffled_all_datasets_folder):
     print(f"Dataset Folder {reshuffled_all_datasets_folder} not found")
@@ -54,12 +102,12 @@ thresholds_to_run = [0.75, ]
 methods_to_run = ["overlap", ] # or dice/jaccard/cosine, etc.
 
 
-def generate_qrels_and_calculate_ir(dataset):
+# Original-split loaders shared by every unit a process runs, see load_og_loaders
+og_loaders = None
 
-    policies = ["Max", "Min", "Avg_Floor", "Avg_Ciel"]
 
+def get_dataset_folders(dataset):
     dataset_name = DatasetUtils.get_dataset_name(dataset)
-    # print(f"\nGenerating Qrels for dataset {dataset}.{dataset_name}")
 
     # Dataset folder
     reshuffled_dataset_folder = reshuffled_all_datasets_folder + dataset_name + "\\"
@@ -73,6 +121,40 @@ def generate_qrels_and_calculate_ir(dataset):
     # Json dataset output folder
     json_dataset_output_folder = json_output_folder + f"{str(dataset)}_{dataset_name}" + "\\"
 
+    return reshuffled_dataset_folder, run_scores_dataset_folder, qrel_dataset_output_folder, json_dataset_output_folder
+
+
+def load_og_loaders(dataset_folder):
+    """
+    Loads the original train/valid/test splits once per process. Forked workers inherit the
+    loaders already built by the parent, spawned workers build them once on start.
+
+    :param dataset_folder: Folder of the dataset with the original splits
+    """
+    global og_loaders
+    if og_loaders is None or og_loaders[0] != dataset_folder:
+        close_og_loaders()
+        og_loaders = (dataset_folder, create_og_loaders(dataset_folder), os.getpid())
+        # Pool workers exit through multiprocessing, which skips atexit but runs its own finalizers
+        multiprocessing.util.Finalize(None, close_og_loaders, exitpriority=10)
+
+
+def close_og_loaders():
+    """
+    Removes the out-of-core stores of the original-split loaders, only in the process that built them
+    (forked workers share the parent's).
+    """
+    global og_loaders
+    if og_loaders is not None and og_loaders[2] == os.getpid():
+        for loader in og_loaders[1]:
+            loader.close()
+    og_loaders = None
+
+
+def generate_qrels_and_calculate_ir(dataset):
+
+    reshuffled_dataset_folder, _, qrel_dataset_output_folder, json_dataset_output_folder = get_dataset_folders(dataset)
+
     if not pu.check_folder_existence(reshuffled_dataset_folder):
         print(f"Dataset Folder {reshuffled_dataset_folder} not found")
         return
@@ -83,58 +165,119 @@ def generate_qrels_and_calculate_ir(dataset):
 
     test_files = pu.find_test_files(reshuffled_dataset_folder)
 
-    OG_train_loader, OG_val_loader, OG_test_loader = create_og_loaders(reshuffled_dataset_folder)
+    load_og_loaders(reshuffled_dataset_folder)
     # OG_manager = TripleManager(OG_test_loader, OG_train_loader, OG_val_loader)
 
     # ent_idx_map = {e: i for i, e in enumerate(OG_manager.entities)}
 
     test_configs = generate_test_configs(thresholds_to_run, methods_to_run)
 
-    for test_file in test_files:
+    # One unit per (reshuffle, config), each one independent of the others
+    units = [(dataset, test_file, config) for test_file in test_files for config in test_configs]
 
-        reshuffle_ID = pu.get_reshuffleId(test_file, "test")
+    workers = UnitScheduler.get_worker_count(MAX_WORKERS, MEMORY_PER_WORKER_GB)
+    print(f"\tRunning {len(units)} units on {workers} worker(s)")
 
-        for config in test_configs:
-            # print(f"\nTesting {config['method']} - {config['threshold']}")
+    failed = UnitScheduler.run_units(units, process_unit, workers, MEMORY_PER_WORKER_GB,
+                                     load_og_loaders, (reshuffled_dataset_folder,), unit_label)
+    if failed:
+        print(f"\t{len(failed)} unit(s) failed: {failed}")
 
-            output_json_path = (json_dataset_output_folder
-                                + f"{str(dataset)}_{dataset_name}"
-                                + f"_{str(reshuffle_ID)}"
-                                + f"_{config['method']}({config['threshold']})"
-                                + "IR_results.json")
 
-            with open(output_json_path, "w", newline='') as f:
-                pass
+def unit_label(unit):
+    dataset, test_file, config = unit
+    return f"{dataset} {pu.get_reshuffleId(test_file, 'test')} {config['method']}({config['threshold']})"
 
-            main_loader = DataLoader(reshuffled_dataset_folder + reshuffle_ID, "test")
-            manager = TripleManager(
-                    main_loader, OG_train_loader, OG_val_loader, OG_test_loader,
-                    compatible_threshold=config["threshold"],
-                    similarity_method=config["method"],
-                    alpha=config.get("alpha", 0.5),
-                    beta=config.get("beta", 0.5)
-                ) # Very slow
-            # manager = TripleManager(main_loader) # Faster but not enough
 
-            # print("\tMain Data Loaded and Main TripleManager Created")
+def process_unit(dataset, test_file, config):
+    """
+    Generates the qrels of one reshuffle for one config and evaluates the runs against them.
 
-            output_files = pu.get_policy_output_files(dataset, test_file, qrel_dataset_output_folder)
+    :param dataset: Dataset number
+    :param test_file: Reshuffled test file
+    :param config: Compatibility config, as made by generate_test_configs
+    """
+    dataset_name = DatasetUtils.get_dataset_name(dataset)
 
-            # print(f"\tProcessing {dataset_path}")
-            # entity_path = os.path.dirname(dataset_path)
-            # print(f"\tProcessing {entity_path}")
-            # continue
+    (reshuffled_dataset_folder, run_scores_dataset_folder,
+     qrel_dataset_output_folder, json_dataset_output_folder) = get_dataset_folders(dataset)
 
-            # filename = dataset_path + "15_test2id.txt"  # e.g., "0_test2id.txt" or "test2id.txt"
-            # filename = re.sub(r"^\d+_", "", filename) # remove leading numbers + underscore
-            # print(f"Processing {filename}")
-            # sys.exit()
+    load_og_loaders(reshuffled_dataset_folder)
+    OG_train_loader, OG_val_loader, OG_test_loader = og_loaders[1]
 
+    reshuffle_ID = pu.get_reshuffleId(test_file, "test")
+
+    # Every unit gets its own stage report
+    Instrumentation.ENABLED = PROFILE_STAGES
+    Instrumentation.reset()
+    if PROFILE_STAGES and TRACE_ALLOCATIONS:
+        Instrumentation.start_tracing()
+
+    # print(f"\nTesting {config['method']} - {config['threshold']}")
+
+    output_json_path = (json_dataset_output_folder
+                        + f"{str(dataset)}_{dataset_name}"
+                        + f"_{str(reshuffle_ID)}"
+                        + f"_{config['method']}({config['threshold']})"
+                        + "IR_results.json")
+
+    output_files = pu.get_policy_output_files(dataset, test_file, qrel_dataset_output_folder,
+                                              config['method'], config['threshold'])
+
+    # Building the manager is the slow part, so skip it when every unit of this config is done
+    #   (and its qrels files are written, if they are wanted)
+    if (RESUME_FINISHED_UNITS and WRITE_JSON_TO_FILE
+            and IrMeasure.is_config_finished(test_file, run_scores_dataset_folder, output_files,
+                                             output_json_path, models, KEEP_PER_QUERY_METRICS)
+            and (not WRITE_QREL_TO_FILE or all(os.path.exists(file) for file in output_files))):
+        print(f"\tSkipping {reshuffle_ID} {config['method']}({config['threshold']}), already evaluated")
+        return
+
+    with Instrumentation.stage("load"):
+        main_loader = DataLoader(reshuffled_dataset_folder + reshuffle_ID, "test", OUT_OF_CORE_FOLDER,
+                                 int(OUT_OF_CORE_MEMORY_GB * 2 ** 30))
+
+    manager = None
+    try:
+        manager = TripleManager(
+                main_loader, OG_train_loader, OG_val_loader, OG_test_loader,
+                compatible_threshold=config["threshold"],
+                similarity_method=config["method"],
+                alpha=config.get("alpha", 0.5),
+                beta=config.get("beta", 0.5)
+            ) # Very slow
+        # manager = TripleManager(main_loader) # Faster but not enough
+
+        # print("\tMain Data Loaded and Main TripleManager Created")
+
+        if ESTIMATE_QRELS:
+            estimate = QrelsEstimator.estimate_qrels(manager)
+            QrelsEstimator.print_estimate(estimate)
+            if MEMORY_PER_WORKER_GB and estimate["memory_bytes"] > MEMORY_PER_WORKER_GB * 2 ** 30:
+                print(f"\tWarning: the qrels need more than MEMORY_PER_WORKER_GB ({MEMORY_PER_WORKER_GB} GB)")
+
+        if QRELS_BY_RELATION:
+            qrels = GenerateQrels.generate_qrels_by_relation(manager, output_files, WRITE_QREL_TO_FILE,
+                                                             workers=QRELS_WORKERS)
+        else:
             qrels = GenerateQrels.generate_qrels_tsv(manager, output_files, WRITE_QREL_TO_FILE)
 
-            IrMeasure.calculate_ir_measures(test_file, run_scores_dataset_folder, qrels, dataset_name,
-                                            output_json_path, config['threshold'], config['method'], models, WRITE_JSON_TO_FILE)
-        break
+        IrMeasure.calculate_ir_measures(test_file, run_scores_dataset_folder, qrels, dataset_name,
+                                        output_json_path, config['threshold'], config['method'], models, WRITE_JSON_TO_FILE,
+                                        TRUNCATE_RUNS_TO_MAX_CUTOFF, KEEP_PER_QUERY_METRICS,
+                                        results_store_path if WRITE_RESULTS_TO_STORE else None,
+                                        RESUME_FINISHED_UNITS)
+
+        if PROFILE_STAGES:
+            metadata = {"dataset": dataset_name, "reshuffle_id": reshuffle_ID, **config}
+            Instrumentation.print_report(metadata)
+            if WRITE_JSON_TO_FILE:
+                Instrumentation.write_report(pu.get_profile_path(output_json_path), metadata)
+    finally:
+        # The out-of-core stores of this unit are removed now instead of whenever they are garbage collected
+        if manager is not None:
+            manager.close()
+        main_loader.close()
 
 
 def find_test_files(dataset_folder):
@@ -169,9 +312,10 @@ def create_og_loaders(dataset_folder):
 
     train_file, val_file, test_file = pu.get_original_files(dataset_folder)
 
-    train_loader = DataLoader(train_file, "train")
-    val_loader = DataLoader(val_file, "valid")
-    test_loader = DataLoader(test_file, "test")
+    memory_budget = int(OUT_OF_CORE_MEMORY_GB * 2 ** 30)
+    train_loader = DataLoader(train_file, "train", OUT_OF_CORE_FOLDER, memory_budget)
+    val_loader = DataLoader(val_file, "valid", OUT_OF_CORE_FOLDER, memory_budget)
+    test_loader = DataLoader(test_file, "test", OUT_OF_CORE_FOLDER, memory_budget)
 
     return train_loader, val_loader, test_loader
 
@@ -1,8 +1,29 @@
 import numpy as np
-import random
 import sys
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from CompatibleRelationsGenerator import DataLoader
+import SetAlgebra
+
+
+def sorted_array(entities):
+    """Sorted int64 array of a set of entities."""
+    array = np.fromiter(entities, dtype=np.int64, count=len(entities))
+    array.sort()
+    return array
+
+
+def has_corruptions(pool, known):
+    """
+    Whether the candidate pool has an entity outside the known answers, without building the difference.
+
+    :param pool: Sorted array of distinct candidate entities
+    :param known: Set of known answers
+    :return: True if pool - known is not empty
+    """
+    # A pool larger than the known answers always has one left; otherwise check its (few) entities
+    return len(pool) > len(known) or not known.issuperset(pool.tolist())
 
 
 class TripleManager():
@@ -17,7 +38,7 @@ class TripleManager():
 
     # TODO Change splits for a dictionary?
     def __init__(self, path, splits, batch_size=None, neg_rate=None, use_bern=False, seed=None,
-                 corruption_mode="Global", pairing_mode="Paired"):
+                 corruption_mode="Global", pairing_mode="Paired", vectorized=False):
 
         print("Triple Manager Called")
         self.counter = 0
@@ -46,8 +67,8 @@ class TripleManager():
             #   triples in other splits.
             if len(self.tripleList) == 0:
                 self.tripleList = loader.getTriples()
-            headEntities = headEntities.union(loader.getHeadEntities())
-            tailEntities = tailEntities.union(loader.getTailEntities())
+            headEntities.update(loader.getHeadEntities())
+            tailEntities.update(loader.getTailEntities())
 
             for r in loader.relations:
                 if r in loader.getHeadDict():
@@ -56,7 +77,7 @@ class TripleManager():
                     for t in loader.getHeadDict()[r]:
                         if t not in self.headDict[r]:
                             self.headDict[r][t] = set()
-                        self.headDict[r][t] = self.headDict[r][t].union(loader.getHeadDict()[r][t])
+                        self.headDict[r][t].update(loader.getHeadDict()[r][t])
 
                 if r in loader.getTailDict():
                     if r not in self.tailDict:
@@ -64,17 +85,17 @@ class TripleManager():
                     for h in loader.getTailDict()[r]:
                         if h not in self.tailDict[r]:
                             self.tailDict[r][h] = set()
-                        self.tailDict[r][h] = self.tailDict[r][h].union(loader.getTailDict()[r][h])
+                        self.tailDict[r][h].update(loader.getTailDict()[r][h])
 
                 if r in loader.getDomain():
                     if r not in dom:
                         dom[r] = set()
-                    dom[r] = dom[r].union(loader.getDomain()[r])
+                    dom[r].update(loader.getDomain()[r])
 
                 if r in loader.getRange():
                     if r not in ran:
                         ran[r] = set()
-                    ran[r] = ran[r].union(loader.getRange()[r])
+                    ran[r].update(loader.getRange()[r])
 
         # This is domain/range
         self.triple_count_by_pred_loc = {}
@@ -111,10 +132,12 @@ class TripleManager():
                 self.headProb[r] = tph[r] / (tph[r] + hpt[r])
                 # self.tailProb[r] = hpt[r]/(tph[r]+hpt[r])
 
-        if seed is not None:
-            self.seed = seed
-            np.random.seed(seed)
-            random.seed(seed)
+        # All the randomness comes from Generators derived from this sequence, never from the global random states.
+        #   Without a seed, fresh entropy is drawn once and reused by every epoch of this manager.
+        self.seed = seed
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.epoch = 0
+        self.rng = np.random.default_rng(self.seed_sequence)
 
         # The entity set and anomalies must be the same for all
         self.entitySet = set(range(loaders[0].entityTotal))
@@ -127,13 +150,17 @@ class TripleManager():
 
         if self.batch_size != None:
             self.nbatches = math.ceil(len(self.tripleList) / self.batch_size)
-        self.randIndexes = np.array([i for i in range(0, len(self.tripleList))])
-        np.random.shuffle(self.randIndexes)
+        self.randIndexes = self.rng.permutation(len(self.tripleList))
+        self.batch_sequences = None
         self.headCorruptedDict = {}
         self.tailCorruptedDict = {}
         self.corruption_mode = corruption_mode
         self.pairing_mode = pairing_mode
 
+        # Whether batches are built by the vectorized sampler (get_batch_vectorized) instead of get_batch
+        self.vectorized = vectorized
+        self.sampler = None
+
         self.headEntities, self.tailEntities = {}, {}
         self.headEntities[-1] = list(self.entitySet - headEntities)
         self.tailEntities[-1] = list(self.entitySet - tailEntities)
@@ -163,72 +190,67 @@ class TripleManager():
                 for h in self.tailDict[r]:
                     self.tailCorruptedDict[r][h] = 0
         else:
+            # Candidate pools are sorted int arrays; the LCWA one is shared by all relations.
+            all_entities = np.arange(loaders[0].entityTotal, dtype=np.int64)
+            dom_arrays = {r: sorted_array(dom[r]) for r in dom}
+            ran_arrays = {r: sorted_array(ran[r]) for r in ran}
+
             for r in self.headDict:
                 self.headCorruptedDict[r] = {}
 
-                headEntities = set()
+                headEntities = np.zeros(0, dtype=np.int64)
                 if self.corruption_mode == "LCWA":
-                    headEntities = self.entitySet
+                    headEntities = all_entities
                 # Heads are those that are in the range but not in the domain.
                 elif self.corruption_mode == "Local":
-                    headEntities = ran[r] - dom[r]
+                    headEntities = SetAlgebra.difference(ran_arrays[r], dom_arrays[r], len(all_entities))
                 elif self.corruption_mode == "TCLCWA":
-                    headEntities = dom[r]
+                    headEntities = dom_arrays[r]
                 elif self.corruption_mode == "NLCWA":
-                    headEntities = dom[r]
                     # Compatible relations are always the same.
-                    for ri in loaders[0].domDomCompatible[r]:
-                        headEntities = headEntities.union(ran[ri])
-                        # headEntities = headEntities.union(dom[ri])
-                    for rj in loaders[0].domRanCompatible[r]:
-                        headEntities = headEntities.union(dom[rj])
-                        # headEntities = headEntities.union(ran[rj])
-                self.headEntities[r] = list(headEntities)
+                    headEntities = SetAlgebra.union_many(
+                        [dom_arrays[r]] + [ran_arrays[ri] for ri in loaders[0].domDomCompatible[r]]
+                        + [dom_arrays[rj] for rj in loaders[0].domRanCompatible[r]], len(all_entities))
+                self.headEntities[r] = headEntities
 
                 for t in self.headDict[r]:
-                    corruptedHeads = headEntities - self.headDict[r][t]
-                    if len(corruptedHeads) == 0 and self.corruption_mode == "LCWA":
-                        print("Corrupted heads were empty using LCWA")
-                        sys.exit(-1)
                     # Only add the key if there are available entities.
-                    if len(corruptedHeads) != 0:
+                    if has_corruptions(headEntities, self.headDict[r][t]):
                         self.headCorruptedDict[r][t] = 0
+                    elif self.corruption_mode == "LCWA":
+                        print("Corrupted heads were empty using LCWA")
+                        sys.exit(-1)
 
             for r in self.tailDict:
                 self.tailCorruptedDict[r] = {}
 
-                tailEntities = set()
+                tailEntities = np.zeros(0, dtype=np.int64)
                 if self.corruption_mode == "LCWA":
-                    tailEntities = self.entitySet
+                    tailEntities = all_entities
                 # Tails are those that are in the domain but not in the range.
                 elif self.corruption_mode == "Local":
-                    tailEntities = dom[r] - ran[r]
+                    tailEntities = SetAlgebra.difference(dom_arrays[r], ran_arrays[r], len(all_entities))
                 elif self.corruption_mode == "TCLCWA":
-                    tailEntities = ran[r]
+                    tailEntities = ran_arrays[r]
                 elif self.corruption_mode == "NLCWA":
-                    tailEntities = ran[r]
-                    for ri in loaders[0].ranRanCompatible[r]:
-                        tailEntities = tailEntities.union(dom[ri])
-                        # tailEntities = tailEntities.union(ran[ri])
-                    for rj in loaders[0].ranDomCompatible[r]:
-                        tailEntities = tailEntities.union(ran[rj])
-                        # tailEntities = tailEntities.union(dom[rj])
-                self.tailEntities[r] = list(tailEntities)
+                    tailEntities = SetAlgebra.union_many(
+                        [ran_arrays[r]] + [dom_arrays[ri] for ri in loaders[0].ranRanCompatible[r]]
+                        + [ran_arrays[rj] for rj in loaders[0].ranDomCompatible[r]], len(all_entities))
+                self.tailEntities[r] = tailEntities
 
                 for h in self.tailDict[r]:
-                    corruptedTails = tailEntities - self.tailDict[r][h]
-                    if len(corruptedTails) == 0 and self.corruption_mode == "LCWA":
-                        print("Corrupted tails were empty using LCWA")
-                        sys.exit(-1)
                     # Only add the key if there are available entities.
-                    if len(corruptedTails) != 0:
+                    if has_corruptions(tailEntities, self.tailDict[r][h]):
                         self.tailCorruptedDict[r][h] = 0
+                    elif self.corruption_mode == "LCWA":
+                        print("Corrupted tails were empty using LCWA")
+                        sys.exit(-1)
 
     # We use this method to restart the manager without recomputing everything.
     def restart(self):
-        if self.seed is not None:
-            np.random.seed(self.seed)
-            random.seed(self.seed)
+        self.epoch = 0
+        self.rng = np.random.default_rng(self.seed_sequence)
+        self.batch_sequences = None
 
         for r in self.headCorruptedDict.keys():
             for t in self.headCorruptedDict[r].keys():
@@ -256,7 +278,7 @@ class TripleManager():
             else:
                 # e is not in the dictionary, just pick any random entity. This 'else' branch is typically reached when
                 #   corrupting several times the same triple.
-                return all_entities[random.randint(0, len(all_entities) - 1)]
+                return all_entities[self.rng.integers(0, len(all_entities))]
 
     """ All corrupted heads or tails. """
 
@@ -264,9 +286,9 @@ class TripleManager():
         # headEntities and tailEntities point to -1 for every relation when using Global.
         corrupted = set()
         if type == "head":
-            corrupted = set(self.headEntities[r]) - self.headDict[r][t]
+            corrupted = set(np.asarray(self.headEntities[r]).tolist()) - self.headDict[r][t]
         elif type == "tail":
-            corrupted = set(self.tailEntities[r]) - self.tailDict[r][h]
+            corrupted = set(np.asarray(self.tailEntities[r]).tolist()) - self.tailDict[r][h]
         return corrupted
 
     def get_corrupted2(self, h, r, t, type='head', corruption_mode='sensical'):
@@ -284,7 +306,7 @@ class TripleManager():
         if corruption_mode == "sensical":
             # Use neighborhood-based corruption (NLCWA) to maintain semantics
             if type == "head":
-                corrupted = set(self.headEntities[r]) - self.headDict[r][t]
+                corrupted = set(np.asarray(self.headEntities[r]).tolist()) - self.headDict[r][t]
                 # Expand corruption using compatible relations
                 for r_compatible in self.domDomCompatible.get(r, []):
                     corrupted.update(self.headDict.get(r_compatible, {}).keys())
@@ -292,7 +314,7 @@ class TripleManager():
                     corrupted.update(self.tailDict.get(r_compatible, {}).keys())
 
             elif type == "tail":
-                corrupted = set(self.tailEntities[r]) - self.tailDict[r][h]
+                corrupted = set(np.asarray(self.tailEntities[r]).tolist()) - self.tailDict[r][h]
                 # Expand corruption using compatible relations
                 for r_compatible in self.ranRanCompatible.get(r, []):
                     corrupted.update(self.tailDict.get(r_compatible, {}).keys())
@@ -345,9 +367,9 @@ class TripleManager():
 
                 # If it is paired, it will corrupt either head or tail. If unpaired, it will corrupt head and tail
                 #   several times (random number between 1 and 10).
-                for corruptions in range(1 if self.pairing_mode == 'Paired' else random.randint(1, 10)):
-                    if random.random() < self.headProb[self.tripleList[self.randIndexes[i_in_batch]].r] \
-                            if self.use_bern else random.random() < 0.5:
+                for corruptions in range(1 if self.pairing_mode == 'Paired' else self.rng.integers(1, 11)):
+                    if self.rng.random() < self.headProb[self.tripleList[self.randIndexes[i_in_batch]].r] \
+                            if self.use_bern else self.rng.random() < 0.5:
                         ch = self.corrupt_head(ch, r, ct)
                     else:
                         ct = self.corrupt_tail(ch, r, ct)
@@ -365,20 +387,220 @@ class TripleManager():
             "batch_y": batch_y
         }
 
+    def _build_sampler(self):
+        """
+        Precomputes the arrays used by the vectorized sampler:
+            - the positives as h/r/t arrays,
+            - the candidate entities of every relation, concatenated into one flat array with an
+              offset and a count per relation (lists shared by several relations, as in Global, are stored once),
+            - the sorted int64 keys (h * relationTotal + r) * entityTotal + t of all known triples,
+            - the probability of corrupting the head per relation.
+        """
+        relation_count = max([self.relationTotal] + [r + 1 for r in self.relSet])
+        entity_count = self.entityTotal
+
+        def flatten(candidates):
+            chunks, offsets, counts, stored = [], np.zeros(relation_count, dtype=np.int64), \
+                np.zeros(relation_count, dtype=np.int64), {}
+            size = 0
+            for r in range(relation_count):
+                entities = candidates.get(r, [])
+                if id(entities) not in stored:
+                    stored[id(entities)] = (size, len(entities))
+                    chunks.append(np.array(entities, dtype=np.int64))
+                    size += len(entities)
+                offsets[r], counts[r] = stored[id(entities)]
+            return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64), offsets, counts
+
+        keys = [(h * relation_count + r) * entity_count + t
+                for r in self.tailDict for h in self.tailDict[r] for t in self.tailDict[r][h]]
+
+        head_prob = np.full(relation_count, 0.5)
+        if self.use_bern:
+            for r, p in self.headProb.items():
+                head_prob[r] = p
+
+        self.sampler = {
+            "h": self.tripleList.heads.astype(np.int64),
+            "r": self.tripleList.relations.astype(np.int64),
+            "t": self.tripleList.tails.astype(np.int64),
+            "head": flatten(self.headEntities),
+            "tail": flatten(self.tailEntities),
+            "known": np.unique(np.array(keys, dtype=np.int64)),
+            "head_prob": head_prob,
+            "relation_count": relation_count,
+            "entity_count": entity_count
+        }
+
+    def _draw(self, candidates, r, size, rng):
+        """Draws one candidate entity of relation r per slot, uniformly; relations without candidates get any entity."""
+        flat, offsets, counts = candidates
+        counts = counts[r]
+        picks = (rng.random(size) * np.maximum(counts, 1)).astype(np.int64)
+        drawn = flat[np.minimum(offsets[r] + picks, max(len(flat) - 1, 0))] if len(flat) else picks
+        return np.where(counts > 0, drawn, rng.integers(0, self.sampler["entity_count"], size))
+
+    def sample_negatives(self, h, r, t, neg_rate, max_rounds=10, rng=None):
+        """
+        Corrupts every positive neg_rate times in one vectorized step.
+
+        Each negative replaces the head (with probability headProb[r] if use_bern, else 0.5) or the tail with an
+        entity drawn uniformly from the candidates of the relation. Negatives that are known triples, checked with a
+        searchsorted over the sorted keys of all known triples, are redrawn in bulk. Unpaired mode corrupts a random
+        number (1 to 10) of times per negative, like get_batch, so the head, the tail or both can be replaced.
+
+        Unlike next_corrupted, which walks the candidates round-robin per entity, candidates are drawn at random.
+
+        :param h: NumPy array of the positive heads
+        :param r: NumPy array of the positive relations
+        :param t: NumPy array of the positive tails
+        :param neg_rate: Number of negatives per positive
+        :param max_rounds: Maximum number of redraws; slots still colliding after that keep their last draw
+        :param rng: numpy.random.Generator drawing the negatives (default: the manager's)
+        :return: Tuple (neg_h, neg_r, neg_t), laid out as neg_rate consecutive blocks of len(h) negatives
+        """
+        if self.sampler is None:
+            self._build_sampler()
+        rng = self.rng if rng is None else rng
+
+        neg_h, neg_r, neg_t = np.tile(h, neg_rate), np.tile(r, neg_rate), np.tile(t, neg_rate)
+        size = len(neg_r)
+        head_prob = self.sampler["head_prob"][neg_r]
+
+        if self.pairing_mode == 'Paired':
+            corrupt_head = rng.random(size) < head_prob
+            corrupt_tail = ~corrupt_head
+        else:
+            corruptions = rng.integers(1, 11, size)
+            head_corruptions = rng.binomial(corruptions, head_prob)
+            corrupt_head = head_corruptions > 0
+            corrupt_tail = head_corruptions < corruptions
+
+        slots = np.arange(size)
+        for _ in range(max_rounds + 1):
+            head_slots = slots[corrupt_head[slots]]
+            tail_slots = slots[corrupt_tail[slots]]
+            neg_h[head_slots] = self._draw(self.sampler["head"], neg_r[head_slots], len(head_slots), rng)
+            neg_t[tail_slots] = self._draw(self.sampler["tail"], neg_r[tail_slots], len(tail_slots), rng)
+
+            # Reject the negatives that are known triples and redraw only those
+            keys = (neg_h[slots] * self.sampler["relation_count"] + neg_r[slots]) * self.sampler["entity_count"] \
+                + neg_t[slots]
+            known = self.sampler["known"]
+            positions = np.minimum(np.searchsorted(known, keys), max(len(known) - 1, 0))
+            slots = slots[known[positions] == keys] if len(known) else slots[:0]
+            if len(slots) == 0:
+                break
+
+        return neg_h, neg_r, neg_t
+
+    def build_batch(self, indexes, rng):
+        """
+        Batch of the given positives (positives first, then neg_rate blocks of negatives), with all the negatives
+        drawn at once by sample_negatives.
+
+        :param indexes: NumPy array of positive triple indexes
+        :param rng: numpy.random.Generator drawing the negatives
+        :return: Dictionary with batch_h, batch_t, batch_r and batch_y
+        """
+        if self.sampler is None:
+            self._build_sampler()
+
+        h, r, t = self.sampler["h"][indexes], self.sampler["r"][indexes], self.sampler["t"][indexes]
+        neg_h, neg_r, neg_t = self.sample_negatives(h, r, t, self.neg_rate, rng=rng)
+
+        batch_y = np.full(len(indexes) * (1 + self.neg_rate), -1, dtype=np.float32)
+        batch_y[:len(indexes)] = 1
+
+        return {
+            "batch_h": np.concatenate((h, neg_h)),
+            "batch_t": np.concatenate((t, neg_t)),
+            "batch_r": np.concatenate((r, neg_r)),
+            "batch_y": batch_y
+        }
+
+    def get_batch_vectorized(self):
+        """
+        Same batches as get_batch, built by build_batch. Inside an epoch, batch i draws from the i-th stream of the
+        epoch, so the batches are the same as those of iter_batches_parallel.
+        """
+        bs = self.batch_size if self.batch_size <= len(self.randIndexes) else len(self.randIndexes)
+
+        if self.batch_sequences is not None and self.counter - 1 < len(self.batch_sequences):
+            rng = np.random.default_rng(self.batch_sequences[self.counter - 1])
+        else:
+            rng = self.rng
+        batch = self.build_batch(self.randIndexes[:bs], rng)
+
+        self.randIndexes = self.randIndexes[bs:]
+        return batch
+
+    def get_epoch_sequence(self, epoch):
+        """
+        SeedSequence of an epoch. It only depends on the seed and the epoch, and spawns one child per batch.
+
+        :param epoch: Epoch number
+        :return: numpy.random.SeedSequence
+        """
+        return np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=(epoch,))
+
+    def get_epoch_plan(self, epoch):
+        """
+        Generator, order of the positives and one SeedSequence per batch of an epoch.
+
+        :param epoch: Epoch number
+        :return: Tuple (Generator of the epoch, already used for the permutation, permutation of the triple indexes,
+            list of nbatches SeedSequences)
+        """
+        epoch_sequence = self.get_epoch_sequence(epoch)
+        rng = np.random.default_rng(epoch_sequence)
+        order = rng.permutation(len(self.tripleList))
+        return rng, order, epoch_sequence.spawn(self.nbatches)
+
+    def iter_batches_parallel(self, epoch, workers=1):
+        """
+        Batches of an epoch built by build_batch on a pool of threads, returned in order.
+
+        Every batch draws from its own stream, spawned from the SeedSequence of the epoch, so the batches are
+        bit-for-bit the same whatever the number of workers (and the same as iterating with vectorized=True).
+
+        :param epoch: Epoch number
+        :param workers: Number of threads building batches
+        :return: Generator of batches
+        """
+        if self.sampler is None:
+            self._build_sampler()
+
+        _, order, batch_sequences = self.get_epoch_plan(epoch)
+
+        def build(i):
+            return self.build_batch(order[i * self.batch_size:(i + 1) * self.batch_size],
+                                    np.random.default_rng(batch_sequences[i]))
+
+        # At most two batches per worker are built ahead of the consumer
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for i in range(self.nbatches):
+                pending.append(executor.submit(build, i))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     def __next__(self):
         # This is required by python to iterate through an object
         self.counter += 1
         if self.counter > self.nbatches:
             raise StopIteration()
 
-        return self.get_batch()
+        return self.get_batch_vectorized() if self.vectorized else self.get_batch()
 
     def __iter__(self):
         # Here at the beginning of every epoch, I am setting counter to 0
-        # And resetting randIndexes at the beginning of every epoch
+        # And resetting randIndexes at the beginning of every epoch, from the streams of that epoch
         self.counter = 0
-        self.randIndexes = np.array([i for i in range(0, len(self.tripleList))])
-        np.random.shuffle(self.randIndexes)
+        self.rng, self.randIndexes, self.batch_sequences = self.get_epoch_plan(self.epoch)
+        self.epoch += 1
         return self
 
     def __len__(self):
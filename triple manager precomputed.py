@@ -1,13 +1,15 @@
 import numpy as np
-import random
 import sys
 import math
-from DataLoader.DataLoader import DataLoader
+import queue
+import threading
+import weakref
+from CompatibleRelationsGenerator import DataLoader
 
 
 class TripleManager():
     def __init__(self, path, splits, batch_size=None, neg_rate=None, use_bern=False, seed=None,
-                 corruption_mode="Global", pairing_mode="Paired"):
+                 corruption_mode="sensical", pairing_mode="Paired"):
         """
         Initialize TripleManager and precompute corruption strategies.
 
@@ -17,7 +19,7 @@ class TripleManager():
         :param neg_rate: Negative sampling rate
         :param use_bern: Whether to use Bernoulli sampling
         :param seed: Random seed
-        :param corruption_mode: Corruption strategy
+        :param corruption_mode: Corruption strategy, 'sensical' or 'non_sensical'
         :param pairing_mode: Whether negative pairs are required
         """
         print("Triple Manager Called")
@@ -25,6 +27,13 @@ class TripleManager():
         self.batch_size = batch_size
         self.neg_rate = neg_rate
         self.corruption_mode = corruption_mode  # Default mode
+        self.pairing_mode = pairing_mode
+
+        # All the randomness comes from Generators derived from this sequence, never from the global random states.
+        #   Without a seed, fresh entropy is drawn once and reused by every epoch of this manager.
+        self.seed = seed
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
 
         self.entitySet = set()
         self.relSet = set()
@@ -40,6 +49,11 @@ class TripleManager():
 
             if len(self.tripleList) == 0:
                 self.tripleList = loader.getTriples()
+                # Compatible relations are always the same, they come from the main split
+                self.domDomCompatible = loader.domDomCompatible
+                self.domRanCompatible = loader.domRanCompatible
+                self.ranDomCompatible = loader.ranDomCompatible
+                self.ranRanCompatible = loader.ranRanCompatible
 
             for r in loader.getHeadDict():
                 if r not in self.headDict:
@@ -56,6 +70,11 @@ class TripleManager():
         # Precompute corrupted entities for different strategies
         self.precompute_corruptions()
 
+        # Array views used by the prefetching iterator, candidates are flattened on first use per mode
+        self.triple_arrays = tuple(np.array([getattr(triple, key) for triple in self.tripleList], dtype=np.int64)
+                                   for key in ("h", "r", "t"))
+        self.candidate_cache = {}
+
     def precompute_corruptions(self):
         """
         Precomputes corrupted entities for all strategies (sensical & non_sensical).
@@ -105,10 +124,23 @@ class TripleManager():
             return self.nonsensical_corruptions[r]["head"] if type == "head" else self.nonsensical_corruptions[r][
                 "tail"]
 
-    def get_batch(self, corruption_mode=None):
+    def get_batch(self, corruption_mode=None, rng=None):
         """
         Generates a batch of positive and negative triples using precomputed corruptions.
+
+        :param corruption_mode: Corruption strategy (optional override)
+        :param rng: numpy.random.Generator drawing the negatives (default: the manager's)
         """
+        rng = self.rng if rng is None else rng
+        candidates = self._candidate_arrays(corruption_mode if corruption_mode else self.corruption_mode)
+
+        def draw(side, r):
+            flat, offsets, counts = candidates[side]
+            # Relations without candidates fall back to any entity, as in fill_batch
+            if counts[r] == 0:
+                return rng.integers(len(self.entitySet))
+            return flat[offsets[r] + rng.integers(counts[r])]
+
         bs = self.batch_size if self.batch_size <= len(self.tripleList) else len(self.tripleList)
 
         batch_seq_size = bs * (1 + self.neg_rate)
@@ -129,11 +161,11 @@ class TripleManager():
                 ch, ct = triple.h, triple.t
                 r = triple.r
 
-                for _ in range(1 if self.pairing_mode == 'Paired' else random.randint(1, 10)):
-                    if random.random() < 0.5:
-                        ch = random.choice(list(self.get_corrupted(ch, r, ct, "head", corruption_mode)))
+                for _ in range(1 if self.pairing_mode == 'Paired' else int(rng.integers(1, 11))):
+                    if rng.random() < 0.5:
+                        ch = draw("head", r)
                     else:
-                        ct = random.choice(list(self.get_corrupted(ch, r, ct, "tail", corruption_mode)))
+                        ct = draw("tail", r)
 
                 batch_h[i_in_batch + last] = ch
                 batch_t[i_in_batch + last] = ct
@@ -147,3 +179,216 @@ class TripleManager():
             "batch_r": batch_r,
             "batch_y": batch_y
         }
+
+    def _candidate_arrays(self, corruption_mode):
+        """
+        The precomputed corruption sets of a mode as flat arrays, so a whole batch of negatives is one indexing step.
+
+        :param corruption_mode: 'sensical' or 'non_sensical'
+        :return: Dictionary {"head"/"tail": (flat entities, offset per relation, count per relation)}
+        """
+        if corruption_mode not in ["sensical", "non_sensical"]:
+            raise ValueError(f"No precomputed corruptions for mode {corruption_mode}")
+
+        if corruption_mode not in self.candidate_cache:
+            relation_count = max(self.relSet) + 1 if self.relSet else 0
+            arrays = {}
+            for side in ["head", "tail"]:
+                chunks, offsets, counts, stored, size = [], np.zeros(relation_count, dtype=np.int64), \
+                    np.zeros(relation_count, dtype=np.int64), {}, 0
+                for r in range(relation_count):
+                    entities = self.get_corrupted(None, r, None, side, corruption_mode) if r in self.relSet else set()
+
+                    # Sets shared by every relation (non_sensical) are stored once
+                    if id(entities) not in stored:
+                        stored[id(entities)] = (size, len(entities))
+                        chunks.append(np.fromiter(entities, dtype=np.int64, count=len(entities)))
+                        size += len(entities)
+                    offsets[r], counts[r] = stored[id(entities)]
+                arrays[side] = (np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64), offsets, counts)
+            self.candidate_cache[corruption_mode] = arrays
+        return self.candidate_cache[corruption_mode]
+
+    def fill_batch(self, indexes, rng, buffers, corruption_mode=None):
+        """
+        Writes the batch of the given positives into preallocated buffers, with the same layout as get_batch:
+        positives first, then neg_rate blocks of negatives.
+
+        :param indexes: NumPy array of positive triple indexes
+        :param rng: numpy.random.Generator drawing the negatives
+        :param buffers: Dictionary of arrays of size batch_size * (1 + neg_rate), as made by allocate_buffers
+        :param corruption_mode: 'sensical' or 'non_sensical' (optional override)
+        :return: Dictionary of views on the buffers, cut to the size of this batch
+        """
+        candidates = self._candidate_arrays(corruption_mode if corruption_mode else self.corruption_mode)
+
+        bs = len(indexes)
+        size = bs * (1 + self.neg_rate)
+        batch = {key: buffer[:size] for key, buffer in buffers.items()}
+
+        h, r, t = self.triple_arrays[0][indexes], self.triple_arrays[1][indexes], self.triple_arrays[2][indexes]
+        for key, positives in (("batch_h", h), ("batch_r", r), ("batch_t", t)):
+            batch[key][:bs] = positives
+            batch[key][bs:] = np.tile(positives, self.neg_rate)
+        batch["batch_y"][:bs] = 1
+        batch["batch_y"][bs:] = -1
+
+        neg_r = batch["batch_r"][bs:]
+        if self.pairing_mode == 'Paired':
+            corrupt_head = rng.random(len(neg_r)) < 0.5
+            corrupt_tail = ~corrupt_head
+        else:
+            corruptions = rng.integers(1, 11, len(neg_r))
+            head_corruptions = rng.binomial(corruptions, 0.5)
+            corrupt_head = head_corruptions > 0
+            corrupt_tail = head_corruptions < corruptions
+
+        for key, side, mask in (("batch_h", "head", corrupt_head), ("batch_t", "tail", corrupt_tail)):
+            flat, offsets, counts = candidates[side]
+            relations = neg_r[mask]
+            picks = (rng.random(len(relations)) * np.maximum(counts[relations], 1)).astype(np.int64)
+            # Relations without candidates fall back to any entity
+            drawn = flat[np.minimum(offsets[relations] + picks, len(flat) - 1)] if len(flat) else picks
+            batch[key][bs:][mask] = np.where(counts[relations] > 0, drawn,
+                                             rng.integers(0, len(self.entitySet), len(relations)))
+
+        return batch
+
+    def allocate_buffers(self):
+        """One set of output arrays, sized for a full batch."""
+        batch_seq_size = self.batch_size * (1 + self.neg_rate)
+        return {
+            "batch_h": np.zeros(batch_seq_size, dtype=np.int64),
+            "batch_t": np.zeros(batch_seq_size, dtype=np.int64),
+            "batch_r": np.zeros(batch_seq_size, dtype=np.int64),
+            "batch_y": np.zeros(batch_seq_size, dtype=np.float32)
+        }
+
+    def get_epoch_sequence(self, epoch):
+        """
+        SeedSequence of an epoch, derived like test_corruption's. It only depends on the seed and the epoch, so
+        every epoch is reproducible on its own.
+
+        :param epoch: Epoch number
+        :return: numpy.random.SeedSequence
+        """
+        return np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=(epoch,))
+
+    def epoch_rng(self, epoch):
+        """Generator of one epoch, see get_epoch_sequence."""
+        return np.random.default_rng(self.get_epoch_sequence(epoch))
+
+    def iter_batches(self, epoch=0, corruption_mode=None, prefetch=4):
+        """
+        Iterates over the batches of one epoch while a background thread builds the next ones.
+
+        :param epoch: Epoch number, seeds the order of the positives and the negatives
+        :param corruption_mode: 'sensical' or 'non_sensical' (optional override)
+        :param prefetch: Number of batches built ahead of the consumer
+        :return: BatchPrefetcher, usable as an iterator and as a context manager
+        """
+        return BatchPrefetcher(self, epoch, corruption_mode, prefetch)
+
+
+class BatchPrefetcher:
+    """
+    Builds the batches of one epoch on a background thread, at most `prefetch` batches ahead, so negative
+    sampling overlaps with the training step.
+
+    Batches are written into a fixed ring of preallocated buffers. A yielded batch stays valid until the next
+    one is requested; copy it if it must outlive that.
+
+    The thread only holds the buffers and queues, not the prefetcher, so dropping the prefetcher (e.g. breaking
+    out of a for loop without close) stops it too.
+    """
+
+    def __init__(self, manager, epoch=0, corruption_mode=None, prefetch=4):
+        if manager.batch_size is None or manager.neg_rate is None:
+            raise ValueError("batch_size and neg_rate are required to iterate over batches")
+
+        self.manager = manager
+        self.corruption_mode = corruption_mode if corruption_mode else manager.corruption_mode
+        # Flattens the candidates here, so an unsupported mode fails now instead of on the first batch
+        manager._candidate_arrays(self.corruption_mode)
+
+        self.rng = manager.epoch_rng(epoch)
+        self.order = self.rng.permutation(len(manager.tripleList))
+        self.nbatches = math.ceil(len(self.order) / manager.batch_size)
+
+        # prefetch batches waiting, one being built and one held by the consumer
+        self.buffers = [manager.allocate_buffers() for _ in range(prefetch + 2)]
+        self.free = queue.Queue()
+        for i in range(len(self.buffers)):
+            self.free.put(i)
+        self.ready = queue.Queue(maxsize=prefetch)
+        self.held = None
+        self.stop = threading.Event()
+
+        self.thread = threading.Thread(target=_produce, daemon=True,
+                                       args=(manager, self.order, self.rng, self.buffers, self.free, self.ready,
+                                             self.stop, self.corruption_mode))
+        self.thread.start()
+        self._finalizer = weakref.finalize(self, self.stop.set)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.held is not None:
+            self.free.put(self.held)
+            self.held = None
+
+        if self.stop.is_set():
+            raise StopIteration()
+
+        i, batch, error = self.ready.get()
+        if error is not None:
+            self.close()
+            raise error
+        if batch is None:
+            self.close()
+            raise StopIteration()
+
+        self.held = i
+        return batch
+
+    def __len__(self):
+        return self.nbatches
+
+    def close(self):
+        """Stops the background thread, e.g. when leaving an epoch early."""
+        self._finalizer()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _produce(manager, order, rng, buffers, free, ready, stop, corruption_mode):
+    # Body of the BatchPrefetcher thread, a function so the thread never keeps the prefetcher alive
+    try:
+        for start in range(0, len(order), manager.batch_size):
+            i = _wait(stop, free.get)
+            if i is None:
+                return
+            batch = manager.fill_batch(order[start:start + manager.batch_size], rng, buffers[i], corruption_mode)
+            if not _wait(stop, lambda timeout: ready.put((i, batch, None), timeout=timeout) or True):
+                return
+        _wait(stop, lambda timeout: ready.put((None, None, None), timeout=timeout) or True)
+    except Exception as error:
+        # Handed to the consumer, which raises it
+        _wait(stop, lambda timeout: ready.put((None, None, error), timeout=timeout) or True)
+
+
+def _wait(stop, blocking_call):
+    # Blocks in short steps, so close() can stop the thread at any point
+    while not stop.is_set():
+        try:
+            return blocking_call(timeout=0.1)
+        except (queue.Empty, queue.Full):
+            continue
+    return None